@@ -1,16 +1,30 @@
 #!/Volumes/MoviablesX/VMs/tools/bin/python
 import argparse
+import asyncio
 import datetime
+import hashlib
+import io
+import json
 import logging
+import math
 import os
+import re
+import shlex
 import socket
+import statistics
 import sys
-from concurrent.futures import ThreadPoolExecutor
+import tarfile
+import time
+import typing
+from collections import deque
 from functools import lru_cache
-from subprocess import run, PIPE
+from glob import glob
+from subprocess import CompletedProcess, TimeoutExpired
 from difflib import unified_diff
 
+from tools.libs.host_health import HealthStore, probe
 from tools.libs.net_utils import hosts_from_dns
+from tools.libs.ssh_transport import CONNECTION_ERROR, Timings, get_transport
 
 try:
     from tools.libs.parse_args import LoggingArgumentParser
@@ -19,13 +33,28 @@ except Exception:
 from argparse import ArgumentError
 
 APP_NAME = "BoT.All"
+DEFAULT_CONCURRENCY = 16
+DEFAULT_TIMEOUT = 30.0
+# same exit code as timeout(1)
+TIMEOUT_RETURNCODE = 124
+# commands handled locally, working on the remote copies of the files given as arguments
+FILE_MODES = ('diff', 'fetch')
 
 
 class CommandResult(object):
-    def __init__(self, stdout: str, stderr: str, returncode: int):
+    def __init__(
+        self,
+        stdout: str,
+        stderr: str,
+        returncode: int,
+        timings: typing.Optional[Timings] = None,
+        skipped: bool = False,
+    ):
         self.stdout = stdout
         self.stderr = stderr
         self.returncode = returncode
+        self.timings = timings
+        self.skipped = skipped
 
     def text(self, prefix: str = '') -> str:
         return_lines = [f'{prefix}{line}' for line in self.stdout.splitlines()]
@@ -33,54 +62,497 @@ class CommandResult(object):
         return_lines.extend([f'{prefix}{line}' for line in self.stderr.splitlines()])
         return '\n'.join(return_lines)
 
+    def digest(self) -> str:
+        digest = hashlib.sha256()
+        for part in (self.stdout, self.stderr, str(self.returncode)):
+            digest.update(part.encode('utf-8', errors='replace'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def to_json(self, host: str) -> str:
+        return json.dumps(
+            {
+                'host': host,
+                'returncode': self.returncode,
+                'stdout': self.stdout,
+                'stderr': self.stderr,
+                'timings': self.timings.to_dict() if self.timings else None,
+                'skipped': self.skipped,
+            }
+        )
+
+
+def compact_hosts(hosts: typing.Iterable[str]) -> str:
+    """
+    Collapse hosts differing only by a trailing number into ranges
+
+    >>> compact_hosts(['raspy3', 'phoenix', 'raspy2', 'raspy5', 'mini'])
+    'mini, phoenix, raspy[2-3,5]'
+    """
+    numbered: typing.Dict[str, typing.List[int]] = {}
+    labels = []
+    for host in hosts:
+        match = re.fullmatch(r'(.*?)(\d+)', host)
+        if match and not match.group(2).startswith('0'):
+            numbered.setdefault(match.group(1), []).append(int(match.group(2)))
+        else:
+            labels.append(host)
+    for name, numbers in numbered.items():
+        if len(numbers) == 1:
+            labels.append(f'{name}{numbers[0]}')
+            continue
+        ranges: typing.List[typing.List[int]] = []
+        for number in sorted(set(numbers)):
+            if ranges and number == ranges[-1][-1] + 1:
+                ranges[-1][-1] = number
+            else:
+                ranges.append([number, number])
+        labels.append(f'{name}[{",".join(f"{a}-{b}" if a != b else str(a) for a, b in ranges)}]')
+    return ', '.join(sorted(labels))
+
+
+class ResultGroups(object):
+    """
+    Group hosts by the digest of their result: only the host names are kept per distinct result,
+    the output itself is shown once, when it first arrives
+    """
+
+    def __init__(self) -> None:
+        self.groups: typing.Dict[str, typing.List[str]] = {}
+
+    def add(self, host: str, result: CommandResult) -> typing.Optional[int]:
+        """ Returns the (1-based) number of the group when ``result`` was not seen before """
+        hosts = self.groups.setdefault(result.digest(), [])
+        hosts.append(host)
+        return len(self.groups) if len(hosts) == 1 else None
+
+    def summary(self) -> typing.Iterator[str]:
+        for number, hosts in enumerate(self.groups.values(), start=1):
+            yield f'#{number} ({len(hosts)}): {compact_hosts(hosts)}'
+
+
+def is_file_mode(command: str) -> bool:
+    return command.split(' ', 1)[0] in FILE_MODES and ' ' in command.strip()
+
+
+def has_glob(path: str) -> bool:
+    return re.search(r'[*?[]', path) is not None
+
+
+def remote_patterns(paths: typing.Iterable[str]) -> str:
+    r"""
+    Paths relative to /, escaped for the remote shell except for glob characters
+
+    >>> remote_patterns(['/etc/keepalived/keepalived.d/*.conf', '/tmp/a b'])
+    'etc/keepalived/keepalived.d/*.conf tmp/a\\ b'
+    """
+    return ' '.join(re.sub(r'([^\w/.*?\[\]-])', r'\\\1', path.lstrip('/')) for path in paths)
+
+
+def untar(data: bytes) -> typing.Dict[str, bytes]:
+    """ Regular files in the tar stream ``data``, by (relative) name """
+    files: typing.Dict[str, bytes] = {}
+    if not data:
+        return files
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r:') as tar:
+        for member in tar:
+            name = os.path.normpath(member.name).lstrip('/')
+            if member.isfile() and not name.startswith('..'):
+                files[name] = tar.extractfile(member).read()
+    return files
+
+
+class ConcurrencyLimiter(object):
+    """ Bounds how many hosts run at the same time """
+
+    def __init__(self, limit: float):
+        self.limit = limit
+        self._running = 0
+        self._condition: typing.Optional[asyncio.Condition] = None
+
+    @property
+    def condition(self) -> asyncio.Condition:
+        # created lazily, to belong to the running loop
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self._running < max(int(self.limit), 1))
+            self._running += 1
+
+    async def release(self, latency: float, ok: bool = True):
+        async with self.condition:
+            self._running -= 1
+            self.observe(latency, ok)
+            self.condition.notify_all()
+
+    def observe(self, latency: float, ok: bool = True):
+        pass
+
+
+class AdaptiveLimiter(ConcurrencyLimiter):
+    """
+    Starts with a quarter of ``maximum`` parallel hosts and adds one for each host answering in
+    less than ``tolerance`` times the baseline, the median latency of the last ``window`` successful hosts;
+    a slower host (failed or not) halves the limit. Failures and skipped hosts don't count in the baseline
+    """
+
+    def __init__(self, maximum: int, minimum: int = 1, tolerance: float = 3.0, window: int = 20):
+        super().__init__(max(minimum, maximum // 4))
+        self.maximum = maximum
+        self.minimum = minimum
+        self.tolerance = tolerance
+        self.samples: typing.Deque[float] = deque(maxlen=window)
+
+    @property
+    def baseline(self) -> typing.Optional[float]:
+        return statistics.median(self.samples) if self.samples else None
+
+    def observe(self, latency: float, ok: bool = True):
+        baseline = self.baseline
+        if ok:
+            self.samples.append(latency)
+        if baseline is not None and latency > self.tolerance * baseline:
+            self.limit = max(self.minimum, self.limit / 2)
+        elif ok:
+            self.limit = min(self.maximum, self.limit + 1)
+
+
+def rollout_batches(
+    hosts: list, canary: int = 0, batch_size: int = None, batch_percent: float = None
+) -> typing.Iterator[list]:
+    """
+    Split ``hosts`` in the canary batch, followed by batches of ``batch_size`` hosts (or ``batch_percent``
+    of all the hosts)
+
+    >>> list(rollout_batches(list('abcdefg'), canary=1, batch_size=4))
+    [['a'], ['b', 'c', 'd', 'e'], ['f', 'g']]
+    >>> list(rollout_batches(list('abcde'), batch_percent=50))
+    [['a', 'b', 'c'], ['d', 'e']]
+    >>> list(rollout_batches(list('abc'), canary=1))
+    [['a'], ['b', 'c']]
+    >>> list(rollout_batches(list('ab'), canary=3, batch_size=1))
+    [['a', 'b']]
+    """
+    if canary:
+        yield hosts[:canary]
+        hosts = hosts[canary:]
+        if not hosts:
+            # all in the canary batch
+            return
+    if batch_percent:
+        batch_size = math.ceil((len(hosts) + canary) * batch_percent / 100)
+    batch_size = max(batch_size or len(hosts), 1)
+    for start in range(0, len(hosts), batch_size):
+        yield hosts[start:start + batch_size]
+
+
+def percentile(values: typing.Sequence[float], percent: float) -> float:
+    """
+    Nearest-rank percentile of the sorted ``values``
+
+    >>> percentile([1.0, 2.0, 3.0, 4.0], 50), percentile([1.0, 2.0, 3.0, 4.0], 95)
+    (2.0, 4.0)
+    """
+    return values[max(math.ceil(len(values) * percent / 100) - 1, 0)]
+
+
+def latency_summary(timings: typing.Dict[str, Timings], slowest: int = 3) -> typing.Dict[str, typing.Any]:
+    """ p50/p95/max of the completion time of each phase, and the slowest hosts """
+    summary: typing.Dict[str, typing.Any] = {'hosts': len(timings)}
+    for phase in Timings.PHASES:
+        values = sorted(v for v in (getattr(t, phase) for t in timings.values()) if v is not None)
+        if values:
+            summary[phase] = {'p50': percentile(values, 50), 'p95': percentile(values, 95), 'max': values[-1]}
+    completed = [(t.completion, host) for host, t in timings.items() if t.completion is not None]
+    summary['slowest'] = [{'host': host, 'completion': value} for value, host in sorted(completed)[::-1][:slowest]]
+    return summary
+
 
 class CommandRunner(object):
-    def __init__(self, command, verbose: bool = False):
+    def __init__(
+        self,
+        command,
+        verbose: bool = False,
+        timeout: float = DEFAULT_TIMEOUT,
+        digest_only: bool = False,
+        fetch_dir: str = '.',
+        health: HealthStore = None,
+        force_all: bool = False,
+    ):
         self.command = command
         self.verbose = verbose
+        self.timeout = timeout
+        self.digest_only = digest_only
+        self.fetch_dir = fetch_dir
+        self.health = health
+        self.force_all = force_all
+        self._local_digests: typing.Dict[str, typing.Tuple[int, str]] = {}
+        self.timings: typing.Dict[str, Timings] = {}
+        """ Per host, accumulated across all the sessions a command needs """
 
-    def run_remote_command(self, host: str) -> (str, str, str, int):
-        ssh_options = [
-            '-o', 'StrictHostKeyChecking false', '-o', 'ConnectTimeout 5', '-o', 'BatchMode yes'
-        ]
+    @property
+    def ssh_options(self) -> list:
+        ssh_options = ['-o', 'StrictHostKeyChecking false', '-o', 'BatchMode yes']
         if not self.verbose:
             ssh_options.append('-q')
-        if self.command.startswith('diff '):
-            file_name = os.path.abspath(self.command[len("diff "):])
-            result = run(
-                ['ssh'] + ssh_options + [host, f'stat -c "%y" "{file_name}" ; cat "{file_name}"'],
-                stdout=PIPE, stderr=PIPE, universal_newlines=True
+        return ssh_options
+
+    async def _run(self, host: str, command: str) -> CompletedProcess:
+        try:
+            return await get_transport().run_async(
+                host, command, self.ssh_options, timeout=self.timeout, timings=self.timings.get(host)
             )
-            remote_content = result.stdout.splitlines()
-            if remote_content:
-                with open(file_name, "r") as f:
-                    local_content = f.read().splitlines()
-                from_file = file_name
-                from_date = datetime.datetime.fromtimestamp(
-                    os.path.getmtime(file_name), tz=datetime.timezone.utc
-                ).isoformat()
-                to_file = f'{host}:{file_name}'
-                to_date = remote_content[0].replace(' ', 'T', 1)
-                result_diff = '\n'.join(
-                    unified_diff(local_content, remote_content[1:], from_file, to_file, from_date, to_date)
+        except TimeoutExpired:
+            return CompletedProcess(command, TIMEOUT_RETURNCODE, b'', f'timed out after {self.timeout:g}s'.encode())
+
+    async def _remote(self, host: str, command: str) -> CommandResult:
+        result = await self._run(host, command)
+        return CommandResult(
+            result.stdout.decode('utf-8', errors='replace'),
+            result.stderr.decode('utf-8', errors='replace'),
+            result.returncode,
+        )
+
+    def local_digest(self, file_name: str) -> typing.Tuple[int, str]:
+        """ Size and sha256 of the local ``file_name``, computed once per run """
+        if file_name not in self._local_digests:
+            digest = hashlib.sha256()
+            with open(file_name, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 16), b''):
+                    digest.update(chunk)
+            self._local_digests[file_name] = (os.path.getsize(file_name), digest.hexdigest())
+        return self._local_digests[file_name]
+
+    async def remote_diff(self, host: str, file_name: str) -> CommandResult:
+        """
+        Compare size and sha256 of the remote ``file_name`` first:
+        its content is only transferred (and diffed) when it differs from the local one
+        """
+        quoted = shlex.quote(file_name)
+        # GNU stat, or the BSD one (macOS) printing the same "<size> <date> <zone>"
+        size_date = (
+            f'{{ stat -c "%s %y" {quoted} 2>/dev/null || stat -f "%z %Sm" -t "%Y-%m-%d %H:%M:%S %z" {quoted}; }}'
+        )
+        probe = await self._remote(
+            host, f'{size_date} && {{ sha256sum {quoted} 2>/dev/null || shasum -a 256 {quoted}; }}'
+        )
+        try:
+            size_date, digest_line = probe.stdout.splitlines()[:2]
+            remote_size, remote_date = size_date.split(' ', 1)
+            remote_digest = digest_line.split()[0]
+        except ValueError:
+            return CommandResult('', probe.stderr.rstrip('\n'), probe.returncode or 1)
+        if (int(remote_size), remote_digest) == self.local_digest(file_name):
+            return CommandResult('', '', 0)
+        if self.digest_only:
+            return CommandResult(f'{host}:{file_name} differs (size {remote_size}, sha256 {remote_digest[:12]})', '', 0)
+        result = await self._remote(host, f'cat {quoted}')
+        with open(file_name, "r") as f:
+            local_content = f.read().splitlines()
+        from_date = datetime.datetime.fromtimestamp(os.path.getmtime(file_name), tz=datetime.timezone.utc).isoformat()
+        to_date = remote_date.replace(' ', 'T', 1)
+        result_diff = '\n'.join(
+            unified_diff(
+                local_content, result.stdout.splitlines(), file_name, f'{host}:{file_name}', from_date, to_date
+            )
+        )
+        return CommandResult(result_diff.rstrip('\n'), result.stderr.rstrip('\n'), result.returncode)
+
+    def local_files(self, paths: typing.Iterable[str]) -> typing.Dict[str, str]:
+        """ Local files matching ``paths``, by name relative to / """
+        files = {}
+        for path in paths:
+            for file_name in glob(path) if has_glob(path) else [path]:
+                if os.path.isfile(file_name):
+                    files[file_name.lstrip('/')] = file_name
+        return files
+
+    async def multi_diff(self, host: str, paths: typing.List[str]) -> CommandResult:
+        """
+        Diff many files (or globs) in two sessions: one listing the remote digests,
+        one streaming back, as a single tar, only the files that differ
+        """
+        probe = await self._remote(
+            host,
+            f'cd / && for f in {remote_patterns(paths)}; do [ -f "$f" ] && '
+            '{ sha256sum "$f" 2>/dev/null || shasum -a 256 "$f"; }; done; true',
+        )
+        if probe.returncode:
+            return CommandResult('', probe.stderr.rstrip('\n'), probe.returncode)
+        remote = {}
+        for line in probe.stdout.splitlines():
+            if line.strip():
+                digest, name = line.split(maxsplit=1)
+                remote[name] = digest
+        local = self.local_files(paths)
+        changed = sorted(
+            name for name, digest in remote.items() if name not in local or self.local_digest(local[name])[1] != digest
+        )
+        output = [f'Only local: /{name}' for name in sorted(set(local) - set(remote))]
+        if self.digest_only:
+            output.extend(f'{host}:/{name} differs' for name in changed)
+            return CommandResult('\n'.join(output), '', 0)
+        if changed:
+            result = await self._run(host, f'cd / && tar -cf - {" ".join(shlex.quote(name) for name in changed)}')
+            if result.returncode:
+                # a partial (or empty) stream would show the missing files as emptied
+                stderr = result.stderr.decode('utf-8', errors='replace').rstrip('\n')
+                stderr = stderr or f'Unable to read the files from {host}'
+                return CommandResult('\n'.join(output), stderr, result.returncode)
+            try:
+                remote_files = untar(result.stdout)
+            except tarfile.TarError as e:
+                return CommandResult('\n'.join(output), f'Unable to read the files from {host}: {e}', 1)
+            for name in changed:
+                if name in local:
+                    with open(local[name], 'r', errors='replace') as f:
+                        local_content = f.read().splitlines()
+                else:
+                    local_content = []
+                remote_content = remote_files.get(name, b'').decode('utf-8', errors='replace').splitlines()
+                output.extend(
+                    unified_diff(local_content, remote_content, f'/{name}', f'{host}:/{name}', lineterm='')
                 )
-            else:
-                result_diff = ''
-            return (host, CommandResult(result_diff.rstrip('\n'), result.stderr.rstrip('\n'), result.returncode))
-        result = run(['ssh'] + ssh_options + [host, self.command], stdout=PIPE, stderr=PIPE, universal_newlines=True)
+        return CommandResult('\n'.join(output), '', 0)
+
+    async def fetch(self, host: str, paths: typing.List[str]) -> CommandResult:
+        """ Copy the remote files matching ``paths`` (in a single tar stream) under ``fetch_dir``/``host`` """
+        result = await self._run(host, f'cd / && tar -cf - {remote_patterns(paths)}')
+        stderr = result.stderr.decode('utf-8', errors='replace').rstrip('\n')
+        try:
+            remote_files = untar(result.stdout)
+        except tarfile.TarError as e:
+            return CommandResult('', f'{stderr}\nUnable to read the files from {host}: {e}'.strip(), 1)
+        output = []
+        for name, content in sorted(remote_files.items()):
+            local_name = os.path.join(self.fetch_dir, host, name)
+            os.makedirs(os.path.dirname(local_name), exist_ok=True)
+            with open(local_name, 'wb') as f:
+                f.write(content)
+            output.append(f'{host}:/{name} -> {local_name}')
+        # some files may be missing or unreadable even if others were copied
+        return CommandResult('\n'.join(output), stderr, result.returncode)
+
+    async def arun_remote_command(self, host: str) -> typing.Tuple[str, CommandResult]:
+        self.timings[host] = Timings()
+        host, result = await self._arun_remote_command(host)
+        result.timings = self.timings[host]
+        return host, result
+
+    async def _arun_remote_command(self, host: str) -> typing.Tuple[str, CommandResult]:
+        if is_file_mode(self.command):
+            mode, args = self.command.split(' ', 1)
+            paths = [os.path.abspath(path) for path in shlex.split(args)]
+            if mode == 'fetch':
+                return (host, await self.fetch(host, paths))
+            if len(paths) == 1 and not has_glob(paths[0]):
+                return (host, await self.remote_diff(host, paths[0]))
+            return (host, await self.multi_diff(host, paths))
+        result = await self._remote(host, self.command)
         return (host, CommandResult(result.stdout.rstrip('\n'), result.stderr.rstrip('\n'), result.returncode))
 
+    def run_remote_command(self, host: str) -> typing.Tuple[str, CommandResult]:
+        return asyncio.run(self.arun_remote_command(host))
+
+    async def skip_if_down(self, host: str) -> typing.Optional[CommandResult]:
+        """ A skipped result if ``host`` failed recently and still does not accept connections on the ssh port """
+        if self.health is None or self.force_all or not self.health.in_backoff(host):
+            return None
+        if await probe(host):
+            self.health.log.debug(f'{host} is in backoff, but accepts connections: trying it')
+            return None
+        record = self.health.record(host, False)
+        down_since = datetime.datetime.fromtimestamp(record.down_since or time.time()).strftime('%Y-%m-%d %H:%M')
+        return CommandResult('', f'skipped (down since {down_since})', CONNECTION_ERROR, skipped=True)
+
+    def record_health(self, host: str, result: CommandResult):
+        if self.health is None:
+            return
+        # 255 may also be the exit code of the remote command, and a command may time out on a healthy host:
+        # only a session that was never established counts (the exit code alone, without timings)
+        unreachable = result.returncode in (CONNECTION_ERROR, TIMEOUT_RETURNCODE) and (
+            result.timings.connect is None if result.timings is not None else result.returncode == CONNECTION_ERROR
+        )
+        self.health.record(host, not unreachable)
+
+    async def run_all(
+        self, hosts: list, concurrency: int = DEFAULT_CONCURRENCY, limiter: ConcurrencyLimiter = None
+    ) -> typing.AsyncIterator[typing.Tuple[str, CommandResult]]:
+        """ Run on all the hosts, yielding each result as soon as its host completes """
+        if limiter is None:
+            limiter = ConcurrencyLimiter(concurrency)
+        loop = asyncio.get_running_loop()
+
+        async def bounded(host: str) -> typing.Tuple[str, CommandResult]:
+            await limiter.acquire()
+            started = loop.time()
+            ok = False
+            try:
+                skipped = await self.skip_if_down(host)
+                if skipped:
+                    return (host, skipped)
+                result = await self.arun_remote_command(host)
+                self.record_health(*result)
+                ok = not result[1].returncode
+                return result
+            except Exception as e:
+                return (host, CommandResult('', str(e), 1, self.timings.get(host)))
+            finally:
+                await limiter.release(loop.time() - started, ok)
+
+        for next_result in asyncio.as_completed([bounded(host) for host in hosts]):
+            yield await next_result
+
 
 def parse_args(argv: list) -> argparse.Namespace:
     p = LoggingArgumentParser(APP_NAME)
-    p.add_argument('command', help='Command to run (single string). Run remote diff if it starts with "diff"')
+    p.add_argument(
+        'command',
+        help='Command to run (single string). "diff PATHS..." compares local and remote files (globs allowed), '
+        '"fetch PATHS..." copies the remote files under --fetch-dir',
+    )
     p.add_argument(
         '--dns-zone', '-D', default='canne', help='DNS zone to transfer to get hosts, empty to use hardcoded data'
     )
     p.add_argument('--linux', '-l', action='store_true', help='Only Linux hosts')
     p.add_argument('--mac', '-m', action='store_true', help='Only Mac hosts')
+    p.add_argument(
+        '--tag', '-T', default=[], action='append', help='Only hosts with this TXT tag in the DNS zone (repeatable)'
+    )
     p.add_argument('--extra', '-e', default=[], nargs='*', help='Extra hosts')
     p.add_argument('--with-errors', '-E', action='store_true', help='Also show error output')
+    p.add_argument('--group', '-b', action='store_true', help='Show identical outputs once, grouping their hosts')
+    p.add_argument(
+        '--jsonl',
+        action='store_true',
+        help='One JSON object per host (with the timings of each phase), followed by a latency summary',
+    )
+    p.add_argument(
+        '--digest-only', action='store_true', help='With "diff", only report the hosts where the file differs'
+    )
+    p.add_argument('--fetch-dir', default='.', help='With "fetch", where to save the files (one dir per host)')
+    p.add_argument(
+        '--force-all',
+        action='store_true',
+        help='Also run on the hosts that recently failed to connect (by default they are skipped while in backoff, '
+        'unless they accept connections on port 22)',
+    )
+    g = p.add_argument_group(
+        'rolling execution', 'Run in batches, stopping at the first batch with a failure; concurrency adapts to latency'
+    )
+    g.add_argument('--canary', type=int, default=0, help='Number of hosts to run on first')
+    bg = g.add_mutually_exclusive_group()
+    bg.add_argument('--batch-size', type=int, help='Number of hosts in each batch after the canary')
+    bg.add_argument('--batch-percent', type=float, help='Percentage of the hosts in each batch after the canary')
+    p.add_argument(
+        '--concurrency', '-j', type=int, default=DEFAULT_CONCURRENCY, help='Maximum number of hosts run in parallel'
+    )
+    p.add_argument(
+        '--timeout', '-t', type=float, default=DEFAULT_TIMEOUT, help='Seconds before the command on a host is killed'
+    )
     try:
         p.add_argument('--verbose', '-v', action='store_true')
         p.add_argument('--quiet', '-q', action='store_true')
@@ -119,27 +591,108 @@ def extend_if_not_me(hosts, hosts_to_add: list) -> list:
     return hosts
 
 
+def show_result(cfg: argparse.Namespace, host: str, result: CommandResult):
+    if is_file_mode(cfg.command):
+        prefix = ''
+    else:
+        prefix = f'{host}: '
+    if cfg.with_errors or result.returncode == 0:
+        cfg.log.info(result.text(prefix=prefix))
+
+
+def show_grouped(cfg: argparse.Namespace, groups: ResultGroups, host: str, result: CommandResult):
+    if cfg.with_errors or result.returncode == 0:
+        number = groups.add(host, result)
+        if number is not None:
+            cfg.log.info(f'==> #{number} {host} <==')
+            if result.stdout or result.stderr:
+                cfg.log.info(result.text())
+        else:
+            cfg.log.debug(f'{host}: same as #{list(groups.groups).index(result.digest()) + 1}')
+
+
+def show_latency(cfg: argparse.Namespace, summary: typing.Dict[str, typing.Any]):
+    if cfg.jsonl:
+        cfg.log.info(json.dumps({'summary': summary}))
+        return
+    for phase in Timings.PHASES:
+        if phase in summary:
+            cfg.log.debug(
+                f'{phase}: p50 {summary[phase]["p50"]:.3f}s, p95 {summary[phase]["p95"]:.3f}s, '
+                f'max {summary[phase]["max"]:.3f}s'
+            )
+    if summary['slowest']:
+        slowest = [f"{entry['host']} ({entry['completion']:.3f}s)" for entry in summary['slowest']]
+        cfg.log.debug(f'slowest: {", ".join(slowest)}')
+
+
+async def run_and_show(cfg: argparse.Namespace, cr: CommandRunner, hosts: list) -> int:
+    groups = ResultGroups()
+    rolling = bool(cfg.canary or cfg.batch_size or cfg.batch_percent)
+    if rolling:
+        limiter: ConcurrencyLimiter = AdaptiveLimiter(cfg.concurrency)
+    else:
+        limiter = ConcurrencyLimiter(cfg.concurrency)
+    done = 0
+    returncode = 0
+    for number, batch in enumerate(rollout_batches(hosts, cfg.canary, cfg.batch_size, cfg.batch_percent)):
+        cfg.log.debug(f'Batch {number} ({compact_hosts(batch)}), up to {int(limiter.limit)} in parallel')
+        failed = []
+        async for host, result in cr.run_all(batch, limiter=limiter):
+            if result.returncode and not result.skipped:
+                failed.append(host)
+            if cfg.jsonl:
+                cfg.log.info(result.to_json(host))
+            elif result.skipped:
+                cfg.log.info(f'{host}: {result.stderr}')
+            elif cfg.group:
+                show_grouped(cfg, groups, host, result)
+            else:
+                show_result(cfg, host, result)
+        done += len(batch)
+        if rolling and failed:
+            step = 'Canary' if number == 0 and cfg.canary else f'Batch {number}'
+            cfg.log.error(f'{step} failed on {compact_hosts(failed)}: skipping the remaining {len(hosts) - done} hosts')
+            returncode = 1
+            break
+    if cfg.group and groups.groups and not cfg.jsonl:
+        cfg.log.info('==> hosts <==')
+        for line in groups.summary():
+            cfg.log.info(line)
+    if cr.timings:
+        show_latency(cfg, latency_summary(cr.timings))
+    if cr.health is not None:
+        cr.health.save()
+    return returncode
+
+
 def main(argv: list = sys.argv[1:]):
     cfg = parse_args(argv)
-    cr = CommandRunner(cfg.command, verbose=cfg.with_errors)
+    cr = CommandRunner(
+        cfg.command,
+        verbose=cfg.with_errors,
+        timeout=cfg.timeout,
+        digest_only=cfg.digest_only,
+        fetch_dir=cfg.fetch_dir,
+        health=HealthStore.load(),
+        force_all=cfg.force_all,
+    )
     all_hosts_dict = hosts_from_dns(cfg.dns_zone, cfg.log)
     hosts = list(cfg.extra)
-    if cfg.linux:
+    if cfg.tag:
+        for tag in cfg.tag:
+            if tag.lower() not in all_hosts_dict:
+                cfg.log.warning(f'No hosts tagged "{tag}"')
+            extend_if_not_me(hosts, all_hosts_dict.get(tag.lower(), ()))
+    elif cfg.linux:
         extend_if_not_me(hosts, all_hosts_dict['linux'])
     elif cfg.mac:
         extend_if_not_me(hosts, all_hosts_dict['mac'])
     else:
-        for htype, hosts_list in all_hosts_dict.items():
-            extend_if_not_me(hosts, hosts_list)
-    with ThreadPoolExecutor(16) as tpool:
-        results = tpool.map(cr.run_remote_command, hosts, timeout=5)
-    for result in results:
-        if cfg.command.startswith('diff '):
-            prefix = ''
-        else:
-            prefix = f'{result[0]}: '
-        if cfg.with_errors or result[1].returncode == 0:
-            cfg.log.info(result[1].text(prefix=prefix))
+        for htype in ('linux', 'mac'):
+            extend_if_not_me(hosts, all_hosts_dict[htype])
+    hosts = list(dict.fromkeys(hosts))
+    return asyncio.run(run_and_show(cfg, cr, hosts))
 
 
 if __name__ == '__main__':
@@ -13,47 +13,88 @@ This tool parses that file and shows:
   * a problems section flagging failing tracked scripts, degraded priorities
     (effective < configured) and instances in ``FAULT``.
 
+Use ``--cluster`` to fetch the dump from every node (the candidate hosts, or
+``--host``) over ssh, in parallel, and see them merged per VRID, flagging
+split brains (more than one ``MASTER``) and nodes that did not answer.
+
+``ka-status diff OLD NEW`` lists what changed between two dumps: state,
+priority, owner, VIP and tracked-script changes, added and removed instances.
+
 Use ``--simple`` for a compact, one-line-per-instance view
 (``NAME (VIP): owner (candidate hosts)``); the candidate-host list is read from
 the keepalived config files when available.
 
+Keepalived built with JSON support also writes ``/tmp/keepalived.json`` on
+``SIGJSON``: that dump is read instead (no text parsing) when it is newer than
+the text one, or always with ``--format json``.
+
 The path to the data file is configurable (positional argument); it defaults to
 ``/tmp/keepalived.data``. Pass ``--signal`` to have this tool send ``SIGUSR1``
 to the running keepalived first, so the dump is regenerated before it is read
 (this usually requires running as root).
 
+IPs are shown with their short hostname: all the reverse lookups of a run are
+done in parallel, each bounded by a short timeout, and the answers are cached
+in ``~/.cache/canepan.tools`` for an hour (``--no-resolve`` skips them).
+
 Dependencies: click, rich.
 """
 
+import asyncio
+import hashlib
+import http.server
+import io
 import json as _json
+import mmap
 import os
+import queue
 import re
+import shlex
 import signal
 import socket
+import sqlite3
 import subprocess
+import threading
 import time
-from glob import glob
-from typing import Callable, Dict, List, Optional
+from typing import IO, Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
 
 import attr
 import click
-from rich.console import Console
+from rich.console import Console, Group, RenderableType
+from rich.live import Live
 from rich.table import Table
 
+from tools.libs.file_utils import write_json_atomic
+from tools.libs.file_watch import FileWatcher
+from tools.libs.net_utils import CACHE_DIR, ip_if_not_local
+from tools.libs.service_index import KA_DIR, load_services
+from tools.libs.ssh_transport import get_transport
+
 APP_NAME = "keepalived-status"
 DEFAULT_DATA_FILE = "/tmp/keepalived.data"
 
 # Where keepalived commonly writes its PID file.
 PIDFILE_CANDIDATES = ("/run/keepalived.pid", "/var/run/keepalived.pid")
 
+# Seconds to wait for each node's dump in --cluster mode, and for a remote
+# keepalived to rewrite it after SIGUSR1.
+CLUSTER_TIMEOUT = 10.0
+REMOTE_SIGNAL_WAIT = 0.5
+
+# Default seconds between SIGUSR1s in --watch --signal mode.
+DEFAULT_WATCH_INTERVAL = 10.0
+
 # Per-instance keepalived config files (used by --simple to list candidate hosts).
-KA_CONFIG_DIR = "/etc/keepalived/keepalived.d"
+KA_CONFIG_DIR = KA_DIR
 
 console = Console()
 
 # An indented "Virtual IP" entry, e.g. "    192.168.19.222/24 dev eth0 scope global".
 _IP_RE = re.compile(r"^\s+(\d{1,3}(?:\.\d{1,3}){3}(?:/\d{1,2})?)\b")
 
+# The human-readable time after a "Last transition" epoch, e.g. "1782250831 (Tue Jun 23 22:40:31 2026)".
+_HUMAN_TIME_RE = re.compile(r"\((.*)\)")
+
 # A bare IPv4 address (no CIDR suffix), used to gate reverse-DNS lookups.
 _IP_ONLY_RE = re.compile(r"^\d{1,3}(?:\.\d{1,3}){3}$")
 
@@ -83,6 +124,9 @@ _STATE_COLOUR = {
 
 _GOOD_STATUSES = {"GOOD", "OK"}
 
+# Rows that changed since the previous --watch frame.
+_CHANGED_STYLE = "reverse"
+
 
 @attr.define
 class Script:
@@ -161,27 +205,137 @@ def _to_int(value: str) -> Optional[int]:
 # Type of a function that maps an IP to a short hostname (or returns the IP).
 Resolver = Callable[[str], str]
 
+# Reverse lookups are kept on disk between runs (see ReverseResolver).
+PTR_CACHE_FILE = os.path.join(CACHE_DIR, "keepalived_status_ptr.json")
+PTR_TTL = 3600.0
+PTR_NEGATIVE_TTL = 300.0
+PTR_TIMEOUT = 1.0
 
-def make_resolver(enabled: bool = True) -> Resolver:
-    """Return a cached IP -> short-hostname resolver.
 
-    When ``enabled`` is False (or a lookup fails) the IP is returned unchanged.
-    Results are memoised so each IP is looked up at most once.
+@attr.define
+class ReverseResolver:
+    """IP -> short-hostname resolver backed by an on-disk cache with expiry.
+
+    :meth:`prefetch` looks up all the IPs that are missing or expired in
+    parallel, waiting at most ``timeout`` seconds for each of them; calling the
+    resolver then only reads the cache (an IP is looked up on the spot only
+    when it was not prefetched). Expired names are still used until a new
+    answer arrives, and lookups that time out keep running in the background,
+    so a slow DNS server never holds up rendering for more than ``timeout``.
+    Failed lookups are cached for ``negative_ttl`` seconds as the IP itself.
     """
-    cache: Dict[str, str] = {}
 
-    def resolve(ip: str) -> str:
-        if not enabled or not _IP_ONLY_RE.match(ip):
-            return ip
-        if ip not in cache:
+    enabled: bool = True
+    path: Optional[str] = None
+    ttl: float = PTR_TTL
+    negative_ttl: float = PTR_NEGATIVE_TTL
+    timeout: float = PTR_TIMEOUT
+    max_workers: int = 16
+    entries: Dict[str, Tuple[str, float]] = attr.field(factory=dict)
+    _lock: threading.Lock = attr.field(factory=threading.Lock, init=False, repr=False)
+    _dirty: bool = attr.field(default=False, init=False, repr=False)
+
+    @classmethod
+    def load(cls, path: str, **kwargs: Any) -> "ReverseResolver":
+        """Return a resolver using (and saving to) the cache in ``path``; a missing or bad file is ignored."""
+        resolver = cls(path=path, **kwargs)
+        try:
+            with open(path, "r") as f:
+                resolver.entries = {ip: (name, float(expires)) for ip, (name, expires) in _json.load(f).items()}
+        except (OSError, ValueError, TypeError, AttributeError):
+            pass
+        return resolver
+
+    def save(self) -> None:
+        """Write the unexpired entries back to ``path``, if any changed."""
+        if not self.path or not self._dirty:
+            return
+        now = time.time()
+        with self._lock:
+            data = {ip: [name, expires] for ip, (name, expires) in self.entries.items() if expires > now}
+            self._dirty = False
+        try:
+            write_json_atomic(self.path, data)
+        except OSError:
+            pass
+
+    def _store(self, ip: str, name: Optional[str]) -> None:
+        expires = time.time() + (self.ttl if name else self.negative_ttl)
+        with self._lock:
+            self.entries[ip] = (name or ip, expires)
+            self._dirty = True
+
+    def _lookup(self, ips: "queue.SimpleQueue[str]") -> None:
+        while True:
+            try:
+                ip = ips.get_nowait()
+            except queue.Empty:
+                return
             try:
-                host = socket.gethostbyaddr(ip)[0]
-                cache[ip] = host.split(".")[0] or ip
-            except (OSError, socket.herror, socket.gaierror):
-                cache[ip] = ip
-        return cache[ip]
+                name: Optional[str] = socket.gethostbyaddr(ip)[0].split(".")[0]
+            except (OSError, UnicodeError):
+                name = None
+            self._store(ip, name)
+
+    def prefetch(self, ips: Iterable[str]) -> None:
+        """Resolve the missing or expired ``ips`` concurrently, then save the cache."""
+        if not self.enabled:
+            return
+        now = time.time()
+        todo = sorted(
+            {ip for ip in ips if _IP_ONLY_RE.match(ip) and (ip not in self.entries or self.entries[ip][1] <= now)}
+        )
+        if todo:
+            pending: "queue.SimpleQueue[str]" = queue.SimpleQueue()
+            for ip in todo:
+                pending.put(ip)
+            # daemon threads: a lookup that never returns must not keep the process alive either
+            workers = [
+                threading.Thread(target=self._lookup, args=(pending,), daemon=True)
+                for _ in range(min(self.max_workers, len(todo)))
+            ]
+            for worker in workers:
+                worker.start()
+            deadline = time.monotonic() + self.timeout * -(-len(todo) // len(workers))
+            for worker in workers:
+                worker.join(max(deadline - time.monotonic(), 0))
+            with self._lock:
+                for ip in todo:
+                    # still pending: show the IP for now, retry on the next prefetch
+                    self.entries.setdefault(ip, (ip, 0.0))
+        self.save()
+
+    def __call__(self, ip: str) -> str:
+        if not self.enabled or not _IP_ONLY_RE.match(ip):
+            return ip
+        if ip not in self.entries:
+            self.prefetch([ip])
+        return self.entries[ip][0]
+
+
+def make_resolver(enabled: bool = True, path: Optional[str] = None) -> ReverseResolver:
+    """Return an IP -> short-hostname resolver.
+
+    When ``enabled`` is False (or a lookup fails) the IP is returned unchanged.
+    Answers are cached in ``path`` (default :data:`PTR_CACHE_FILE`) for later runs.
+    """
+    if not enabled:
+        return ReverseResolver(enabled=False)
+    return ReverseResolver.load(path or PTR_CACHE_FILE)
 
-    return resolve
+
+def instance_ips(instances: Iterable[Instance]) -> Set[str]:
+    """The IPs a rendering of ``instances`` may need a name for."""
+    ips: Set[str] = set()
+    for inst in instances:
+        ips.update(ip for ip in (inst.owner, inst.src_ip, inst.master_router) if ip)
+    return ips
+
+
+def prefetch_names(resolver: Resolver, instances: Iterable[Instance]) -> None:
+    """Resolve all the IPs of ``instances`` at once, when ``resolver`` supports it."""
+    if isinstance(resolver, ReverseResolver):
+        resolver.prefetch(instance_ips(instances))
 
 
 def _label(ip: str, resolver: Resolver) -> str:
@@ -218,18 +372,153 @@ def parse(text: str) -> List[Instance]:
     >>> insts[0].scripts[0].name, insts[0].scripts[0].status
     ('chk_dns', 'GOOD')
     """
+    return list(iter_parse(text))
+
+
+def iter_parse(source: Union[str, bytes, IO, mmap.mmap]) -> Iterator[Instance]:
+    """Parse ``keepalived.data`` line by line, yielding each instance as its block closes.
+
+    ``source`` is the dump itself (``str``/``bytes``), a text or binary file
+    object or a memory-mapped file: only one line at a time is held in memory.
+
+    Scripts are shared :class:`Script` objects: in v2 dumps their status (and
+    the instances tracking them) come in the ``VRRP Scripts`` section, after
+    the instances, so they are only complete once the iterator is exhausted.
+    """
     ctx = _ParseContext()
-    for raw in text.splitlines():
+    for raw in _iter_lines(source):
         if raw.strip():
-            ctx.feed(raw)
-    return ctx.finalize()
+            closed = ctx.feed(raw)
+            if closed is not None:
+                yield closed
+    if ctx.cur is not None:
+        yield ctx.cur
+
+
+def parse_file(path: str) -> Iterator[Instance]:
+    """:func:`iter_parse` on the memory-mapped ``path``."""
+    with open(path, "rb") as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file: nothing to map
+            return
+        with data:
+            yield from iter_parse(data)
+
+
+# keepalived's numeric VRRP states, as found in its JSON dump.
+_JSON_STATES = {0: "INIT", 1: "BACKUP", 2: "MASTER", 3: "FAULT", 98: "STOP"}
+
+
+def json_path(data_file: str) -> str:
+    """The JSON dump next to the text one (``/tmp/keepalived.data`` -> ``/tmp/keepalived.json``)."""
+    return os.path.splitext(data_file)[0] + ".json"
+
+
+def pick_dump(data_file: str, fmt: str = "auto") -> Tuple[str, str]:
+    """The file to read for ``data_file`` and its format, ``"json"`` or ``"text"``.
+
+    With ``fmt="auto"`` a ``.json`` path is read as JSON; otherwise the JSON
+    dump next to ``data_file`` is preferred when it is not older than the text one.
+    """
+    if fmt == "text":
+        return data_file, "text"
+    if fmt == "json" or data_file.endswith(".json"):
+        return (data_file if data_file.endswith(".json") else json_path(data_file)), "json"
+    try:
+        json_mtime = os.path.getmtime(json_path(data_file))
+    except OSError:
+        return data_file, "text"
+    try:
+        if os.path.getmtime(data_file) > json_mtime:
+            return data_file, "text"
+    except OSError:
+        pass
+    return json_path(data_file), "json"
+
+
+def load_dump(data_file: str, fmt: str = "auto") -> List[Instance]:
+    """The instances in the dump :func:`pick_dump` chooses for ``data_file``.
+
+    Raises ``OSError`` if it cannot be read, ``ValueError`` if a JSON dump is malformed.
+    """
+    path, kind = pick_dump(data_file, fmt)
+    if kind == "json":
+        with open(path, "rb") as f:
+            return parse_json(f.read())
+    return list(parse_file(path))
+
+
+def parse_json(data: Union[str, bytes]) -> List[Instance]:
+    """Parse keepalived's JSON dump (``/tmp/keepalived.json``, written on ``SIGJSON``).
+
+    The dump is a list of ``{"data": {...}, "stats": {...}}`` objects, one per
+    VRRP instance, mapped straight to :class:`Instance`. Tracked scripts only
+    come with their status when the dump has it, so plain script names end up
+    in ``script_names`` alone.
+
+    >>> insts = parse_json('[{"data": {"iname": "DNS", "state": 1, "vrid": 222, "base_priority": 80, '
+    ...                    '"effective_priority": 80, "vips": ["192.168.19.222/24 dev eth0 scope global"]}}]')
+    >>> insts[0].name, insts[0].state, insts[0].vrid, insts[0].vips
+    ('DNS', 'BACKUP', 222, ['192.168.19.222/24'])
+    """
+    entries = _json.loads(data)
+    if not isinstance(entries, list):
+        raise ValueError("not a keepalived JSON dump: expected a list of instances")
+    return [_instance_from_json(entry.get("data", entry)) for entry in entries]
+
+
+def _json_ip(value: Any) -> Optional[str]:
+    ip = str(value or "").split(" ", 1)[0]
+    return ip if ip and ip not in ("0.0.0.0", "::") else None
+
+
+def _instance_from_json(data: Dict[str, Any]) -> Instance:
+    state = data.get("state", "?")
+    inst = Instance(
+        name=data["iname"],
+        state=_JSON_STATES.get(state, str(state)) if isinstance(state, int) else str(state).upper(),
+        vrid=data.get("vrid"),
+        priority=data.get("base_priority"),
+        effective_priority=data.get("effective_priority"),
+        master_router=_json_ip(data.get("master_saddr")),
+        master_priority=data.get("master_priority") if _json_ip(data.get("master_saddr")) else None,
+        src_ip=_json_ip(data.get("saddr")),
+        vips=[str(vip).split()[0] for vip in data.get("vips", ()) if str(vip).strip()],
+    )
+    last = data.get("last_transition")
+    if last:
+        inst.last_transition_epoch = int(last)
+        inst.last_transition_human = time.ctime(int(last))
+    for tracked in data.get("track_script", ()):
+        if isinstance(tracked, dict):
+            _add_script(
+                inst, Script(name=tracked["name"], status=tracked.get("status", "?"), weight=tracked.get("weight"))
+            )
+        else:
+            inst.script_names.append(str(tracked))
+    return inst
+
+
+def _iter_lines(source: Union[str, bytes, IO, mmap.mmap]) -> Iterator[str]:
+    if isinstance(source, str):
+        source = io.StringIO(source)
+    elif isinstance(source, bytes):
+        source = io.BytesIO(source)
+    readline = source.readline
+    while True:
+        line = readline()
+        if not line:
+            return
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", errors="replace")
+        yield line.rstrip("\r\n")
 
 
 @attr.define
 class _ParseContext:
-    """Mutable state machine used by :func:`parse` to handle both formats."""
+    """Mutable state machine used by :func:`iter_parse` to handle both formats."""
 
-    instances: List[Instance] = attr.field(factory=list)
     by_name: Dict[str, Instance] = attr.field(factory=dict)
     scripts: Dict[str, Script] = attr.field(factory=dict)
     section: Optional[str] = None
@@ -237,29 +526,32 @@ class _ParseContext:
     cur_script: Optional[Script] = None
     mode: Optional[str] = None  # None | "vip" | "tracked_scripts" | "tracking_instances"
 
-    def feed(self, raw: str) -> None:
+    def feed(self, raw: str) -> Optional[Instance]:
+        """Process one (non-blank) line; return the instance whose block it closed, if any."""
+        previous = self.cur
         stripped = raw.strip()
 
-        section_match = _SECTION_RE.match(stripped)
-        if section_match:
-            self._enter_section(section_match.group(1).strip())
-            return
+        if stripped[0] == "-":
+            section_match = _SECTION_RE.match(stripped)
+            if section_match:
+                self._enter_section(section_match.group(1).strip())
+                return previous if self.cur is None else None
 
         if self.mode and self._consume_block_line(raw):
-            return
+            return None
 
-        if stripped.startswith("VRRP Instance ="):
-            self._start_instance(_after_eq(stripped))
-        elif stripped.startswith("VRRP Script ="):
-            self._start_script(_after_eq(stripped))
-        elif stripped.startswith("Virtual IP"):
-            self.mode = "vip"
-        elif stripped.startswith("Tracked scripts") and stripped.endswith(":"):
-            self.mode = "tracked_scripts"
-        elif stripped.startswith("Tracking instances") and stripped.endswith(":"):
-            self.mode = "tracking_instances"
-        elif " = " in stripped:
-            self._apply_key(*(p.strip() for p in stripped.split("=", 1)))
+        if " = " in stripped:
+            key, value = stripped.split(" = ", 1)
+            handler = _ASSIGNMENT_HANDLERS.get(key.strip())
+            if handler is not None:
+                handler(self, value.strip())
+            else:
+                self._apply_key(key.strip(), value.strip())
+        elif stripped[-1] == ":":
+            handler = _BLOCK_HANDLERS.get(_block_key(stripped))
+            if handler is not None:
+                handler(self, "")
+        return previous if self.cur is not previous else None
 
     def _enter_section(self, name: str) -> None:
         self.section = name
@@ -270,17 +562,22 @@ class _ParseContext:
 
     def _start_instance(self, name: str) -> None:
         self.cur = Instance(name=name)
-        self.instances.append(self.cur)
         self.by_name[name] = self.cur
         self.cur_script = None
         self.mode = None
 
     def _start_script(self, name: str) -> None:
-        self.cur_script = self.scripts.setdefault(name, Script(name=name))
+        self.cur_script = self._script(name)
         self.mode = None
         # v1: the script block follows its instance, so link it to the current one.
         if self.section not in ("VRRP Scripts",) and self.cur is not None:
-            _add_script_name(self.cur, name)
+            _add_script(self.cur, self.cur_script)
+
+    def _script(self, name: str) -> Script:
+        script = self.scripts.get(name)
+        if script is None:
+            script = self.scripts[name] = Script(name=name)
+        return script
 
     def _consume_block_line(self, raw: str) -> bool:
         """Handle an indented sub-block line; return False to end the block."""
@@ -293,17 +590,17 @@ class _ParseContext:
             m = _TRACKED_RE.match(raw)
             if m and " = " not in raw and self.cur is not None:
                 name, weight = m.group(1), m.group(2)
-                script = self.scripts.setdefault(name, Script(name=name))
+                script = self._script(name)
                 if weight is not None and script.weight is None:
                     script.weight = _to_int(weight)
-                _add_script_name(self.cur, name)
+                _add_script(self.cur, script)
                 return True
         elif self.mode == "tracking_instances":
             m = _TRACKING_RE.match(raw)
             if m and " = " not in raw and self.cur_script is not None:
                 inst = self.by_name.get(m.group(1))
                 if inst is not None:
-                    _add_script_name(inst, self.cur_script.name)
+                    _add_script(inst, self.cur_script)
                 return True
         self.mode = None  # not a block line: end the block, reprocess below
         return False
@@ -316,21 +613,47 @@ class _ParseContext:
         if self.cur_script is not None and _apply_script_key(self.cur_script, key, value):
             return
         if self.cur is not None and self.section in _TOPOLOGY_SECTIONS:
-            _apply_instance_key(self.cur, key, value)
+            setter = _INSTANCE_KEYS.get(key)
+            if setter is not None:
+                setter(self.cur, value)
+
 
-    def finalize(self) -> List[Instance]:
-        for inst in self.instances:
-            inst.scripts = [self.scripts[n] for n in inst.script_names if n in self.scripts]
-        return self.instances
+def _block_key(line: str) -> str:
+    """Key of a block header: "Virtual IP (1):" -> "Virtual IP"."""
+    return line[:-1].split(" (", 1)[0].strip()
 
 
-def _after_eq(line: str) -> str:
-    return line.split("=", 1)[1].strip()
+def _set_vip_mode(ctx: _ParseContext, _: str) -> None:
+    ctx.mode = "vip"
 
 
-def _add_script_name(inst: Instance, name: str) -> None:
-    if name not in inst.script_names:
-        inst.script_names.append(name)
+def _set_tracked_scripts_mode(ctx: _ParseContext, _: str) -> None:
+    ctx.mode = "tracked_scripts"
+
+
+def _set_tracking_instances_mode(ctx: _ParseContext, _: str) -> None:
+    ctx.mode = "tracking_instances"
+
+
+# Dispatch tables, keyed by the text before " = " (assignments) or before the
+# trailing ":" (block headers): one dict lookup per line instead of a chain of
+# prefix tests.
+_ASSIGNMENT_HANDLERS: Dict[str, Callable[[_ParseContext, str], None]] = {
+    "VRRP Instance": _ParseContext._start_instance,
+    "VRRP Script": _ParseContext._start_script,
+    "Virtual IP": _set_vip_mode,  # v1: "Virtual IP = N"
+}
+_BLOCK_HANDLERS: Dict[str, Callable[[_ParseContext, str], None]] = {
+    "Virtual IP": _set_vip_mode,  # v2: "Virtual IP (N):"
+    "Tracked scripts": _set_tracked_scripts_mode,
+    "Tracking instances": _set_tracking_instances_mode,
+}
+
+
+def _add_script(inst: Instance, script: Script) -> None:
+    if script.name not in inst.script_names:
+        inst.script_names.append(script.name)
+        inst.scripts.append(script)
 
 
 def _apply_script_key(script: Script, key: str, value: str) -> bool:
@@ -344,27 +667,35 @@ def _apply_script_key(script: Script, key: str, value: str) -> bool:
     return True
 
 
-def _apply_instance_key(inst: Instance, key: str, value: str) -> None:
-    """Apply a key/value line to a VRRP instance."""
-    if key == "State":
-        if value.strip().upper() in _VALID_STATES:  # ignore interface/script states
-            inst.state = value.strip()
-    elif key == "Master router":
-        inst.master_router = value
-    elif key == "Master priority":
-        inst.master_priority = _to_int(value)
-    elif key == "Virtual Router ID":
-        inst.vrid = _to_int(value)
-    elif key == "Priority":
-        inst.priority = _to_int(value)
-    elif key == "Effective priority":
-        inst.effective_priority = _to_int(value)
-    elif key == "Using src_ip":
-        inst.src_ip = value
-    elif key == "Last transition":
-        inst.last_transition_epoch = _to_int(value)
-        human = re.search(r"\((.*)\)", value)
-        inst.last_transition_human = human.group(1) if human else value
+def _set_state(inst: Instance, value: str) -> None:
+    if value.upper() in _VALID_STATES:  # ignore interface/script states
+        inst.state = value
+
+
+def _set_last_transition(inst: Instance, value: str) -> None:
+    inst.last_transition_epoch = _to_int(value)
+    human = _HUMAN_TIME_RE.search(value)
+    inst.last_transition_human = human.group(1) if human else value
+
+
+def _setter(field: str, convert: Callable[[str], Any] = str) -> Callable[[Instance, str], None]:
+    def set_field(inst: Instance, value: str) -> None:
+        setattr(inst, field, convert(value))
+
+    return set_field
+
+
+# Instance keys (text before " = ") -> how to apply their value.
+_INSTANCE_KEYS: Dict[str, Callable[[Instance, str], None]] = {
+    "State": _set_state,
+    "Master router": _setter("master_router"),
+    "Master priority": _setter("master_priority", _to_int),
+    "Virtual Router ID": _setter("vrid", _to_int),
+    "Priority": _setter("priority", _to_int),
+    "Effective priority": _setter("effective_priority", _to_int),
+    "Using src_ip": _setter("src_ip"),
+    "Last transition": _set_last_transition,
+}
 
 
 def _age(epoch: Optional[int]) -> str:
@@ -397,26 +728,13 @@ def load_candidate_hosts(config_dir: str = KA_CONFIG_DIR) -> Dict[str, List[str]
 
     The candidate-host list is not present in ``keepalived.data``; it is read
     from the per-instance keepalived config files (the ``vrrp`` list in each
-    file's JSON header), reusing :class:`simple_service_map.Service`.
+    file's JSON header), through the cached index of
+    :mod:`tools.libs.service_index`.
 
-    Returns an empty mapping if the config directory or parser is unavailable,
-    so callers can degrade gracefully.
+    Returns an empty mapping if the config directory is missing, so callers can
+    degrade gracefully.
     """
-    try:
-        from tools.bin.simple_service_map import Service
-    except Exception:  # pragma: no cover - import guard for non-keepalived hosts
-        return {}
-
-    result: Dict[str, List[str]] = {}
-    for fname in sorted(glob(os.path.join(config_dir, "*.conf"))):
-        try:
-            svc = Service(fname)
-            hosts = list(svc.hosts)
-        except Exception:
-            continue
-        if hosts:
-            result[svc.name] = hosts
-    return result
+    return {svc.name: list(svc.hosts) for svc in load_services(config_dir) if svc.hosts}
 
 
 def render_simple(
@@ -447,11 +765,26 @@ def render(instances: List[Instance], local_ip: Optional[str], resolver: Optiona
     ``resolver`` maps an IP to a short hostname (see :func:`make_resolver`);
     when omitted, IPs are shown unchanged.
     """
+    console.print(render_tables(instances, local_ip, resolver))
+
+
+def render_tables(
+    instances: List[Instance],
+    local_ip: Optional[str],
+    resolver: Optional[Resolver] = None,
+    changed: Optional[Set[str]] = None,
+) -> Group:
+    """Build the tables shown by :func:`render`.
+
+    Rows of the instances named in ``changed`` are highlighted (used by
+    ``--watch`` for the instances whose state or owner just changed).
+    """
     if resolver is None:
         resolver = lambda ip: ip  # noqa: E731 - trivial identity default
     if not instances:
-        console.print("[yellow]No VRRP instances found in the data file.[/]")
-        return
+        return Group("[yellow]No VRRP instances found in the data file.[/]")
+    changed = changed or set()
+    parts: List[RenderableType] = []
 
     masters = [i for i in instances if i.is_master]
     backups = [i for i in instances if i.state.upper() == "BACKUP"]
@@ -486,8 +819,9 @@ def render(instances: List[Instance], local_ip: Optional[str], resolver: Optiona
             "\n".join(inst.vips) or "[dim]-[/]",
             scripts,
             last,
+            style=_CHANGED_STYLE if inst.name in changed else None,
         )
-    console.print(table)
+    parts.append(table)
 
     # ---- Distribution -------------------------------------------------------
     by_owner: Dict[str, List[Instance]] = {}
@@ -504,7 +838,7 @@ def render(instances: List[Instance], local_ip: Optional[str], resolver: Optiona
             label = f"[bold green]{label} (this node)[/]"
         names = sorted(i.name for i in by_owner[owner])
         dist.add_row(label, str(len(names)), ", ".join(names))
-    console.print(dist)
+    parts.append(dist)
 
     # ---- Summary ------------------------------------------------------------
     summary = (
@@ -512,16 +846,17 @@ def render(instances: List[Instance], local_ip: Optional[str], resolver: Optiona
     )
     if others:
         summary += f", [red]{len(others)} other[/]"
-    console.print(summary)
+    parts.append(summary)
 
     # ---- Problems -----------------------------------------------------------
     problems = _collect_problems(instances)
     if problems:
-        console.print("\n[bold underline]Problems[/]")
+        parts.append("\n[bold underline]Problems[/]")
         for p in problems:
-            console.print(f"  {p}")
+            parts.append(f"  {p}")
     else:
-        console.print("[green]No problems detected.[/]")
+        parts.append("[green]No problems detected.[/]")
+    return Group(*parts)
 
 
 def _collect_problems(instances: List[Instance]) -> List[str]:
@@ -539,62 +874,146 @@ def _collect_problems(instances: List[Instance]) -> List[str]:
     return problems
 
 
-def find_keepalived_pid() -> Optional[int]:
+# PID of keepalived found by the last find_keepalived_pid(), reused while it is still keepalived's.
+_keepalived_pid: Optional[int] = None
+
+# Seconds the dump size must stay the same for it to be considered completely written.
+DUMP_SETTLE = 0.02
+
+
+def _process_name(pid: int) -> Optional[str]:
+    """The command name of ``pid``, ``None`` if it is not running (or there is no /proc to tell)."""
+    try:
+        with open(f"/proc/{pid}/comm") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def find_keepalived_pid(use_cache: bool = True) -> Optional[int]:
     """Locate the main keepalived process PID.
 
     Tries the standard PID files first, then falls back to ``pgrep -o`` (the
     oldest matching process, i.e. the parent). Returns ``None`` if not found.
+    The PID is remembered, and returned again without a lookup as long as that
+    process is still keepalived (unless ``use_cache`` is False): after a restart
+    the PID may belong to another process, which SIGUSR1 would terminate.
     """
+    global _keepalived_pid
+    if use_cache and _keepalived_pid is not None and _process_name(_keepalived_pid) == "keepalived":
+        return _keepalived_pid
+    _keepalived_pid = None
     for pidfile in PIDFILE_CANDIDATES:
         try:
             with open(pidfile) as f:
-                return int(f.read().strip())
+                _keepalived_pid = int(f.read().strip())
+                return _keepalived_pid
         except (OSError, ValueError):
             continue
     try:
         out = subprocess.check_output(["pgrep", "-o", "keepalived"], universal_newlines=True)
-        return int(out.split()[0])
+        _keepalived_pid = int(out.split()[0])
     except (OSError, subprocess.CalledProcessError, ValueError, IndexError):
-        return None
+        pass
+    return _keepalived_pid
 
 
-def refresh_data_file(path: str, wait: float = 2.0) -> bool:
-    """Send ``SIGUSR1`` to keepalived so it (re)writes its data dump.
+def _dump_complete(path: str, settle: float = DUMP_SETTLE) -> bool:
+    """Whether ``path`` looks completely written.
 
-    Waits up to ``wait`` seconds for ``path`` to be updated. Returns True if the
-    signal was delivered (even if the file update was not observed in time),
-    False if keepalived could not be found or signalled.
+    Keepalived's last section differs between versions, so the dump is taken as
+    complete when it ends with a newline and its size does not change for
+    ``settle`` seconds.
     """
-    pid = find_keepalived_pid()
-    if pid is None:
-        console.print("[red]Could not find a running keepalived process.[/]")
+    try:
+        size = os.path.getsize(path)
+        if not size:
+            return False
+        with open(path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                return False
+        time.sleep(settle)
+        return os.path.getsize(path) == size
+    except OSError:
         return False
 
+
+def _signal_name(signum: int) -> str:
     try:
-        before = os.path.getmtime(path)
-    except OSError:
-        before = 0.0
+        return signal.Signals(signum).name
+    except ValueError:  # real-time signals have no name
+        return f"signal {signum}"
+
+
+def json_signal() -> Optional[int]:
+    """The signal asking keepalived for its JSON dump (``keepalived --signum=JSON``).
 
+    Returns ``None`` when keepalived is not installed or was built without JSON support.
+    """
     try:
-        os.kill(pid, signal.SIGUSR1)
-    except PermissionError:
-        console.print(
-            f"[red]Permission denied sending SIGUSR1 to keepalived (pid {pid}).[/]\n"
-            f"  Try: [bold]sudo kill -USR1 {pid}[/]"
+        out = subprocess.check_output(
+            ["keepalived", "--signum=JSON"], universal_newlines=True, stderr=subprocess.DEVNULL
         )
+        return int(out.split()[0])
+    except (OSError, subprocess.CalledProcessError, ValueError, IndexError):
+        return None
+
+
+def refresh_dump(data_file: str, fmt: str = "auto") -> bool:
+    """:func:`refresh_data_file` for the dump in format ``fmt`` (``SIGJSON`` for ``"json"``)."""
+    path, kind = pick_dump(data_file, "json" if fmt == "json" else "text")
+    if kind == "text":
+        return refresh_data_file(path)
+    signum = json_signal()
+    if signum is None:
+        console.print("[red]keepalived has no JSON support (keepalived --signum=JSON failed).[/]")
         return False
-    except OSError as e:
-        console.print(f"[red]Failed to signal keepalived (pid {pid}): {e}[/]")
+    return refresh_data_file(path, signum=signum)
+
+
+def refresh_data_file(path: str, wait: float = 2.0, signum: int = signal.SIGUSR1) -> bool:
+    """Send ``signum`` (``SIGUSR1``) to keepalived so it (re)writes its data dump.
+
+    Waits up to ``wait`` seconds for ``path`` to be rewritten: the file is
+    watched with inotify (polled where not available) from before the signal is
+    sent, so this returns as soon as the complete dump is there. Returns True if
+    the signal was delivered (even if the file update was not observed in time),
+    False if keepalived could not be found or signalled.
+    """
+    pid = find_keepalived_pid()
+    if pid is None:
+        console.print("[red]Could not find a running keepalived process.[/]")
         return False
 
-    deadline = time.time() + wait
-    while time.time() < deadline:
+    with FileWatcher(path, poll_interval=0.05) as watcher:
         try:
-            if os.path.getmtime(path) > before:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                # keepalived restarted since the PID was cached
+                pid = find_keepalived_pid(use_cache=False)
+                if pid is None:
+                    console.print("[red]Could not find a running keepalived process.[/]")
+                    return False
+                os.kill(pid, signum)
+        except PermissionError:
+            console.print(
+                f"[red]Permission denied sending {_signal_name(signum)} to keepalived (pid {pid}).[/]\n"
+                f"  Try: [bold]sudo kill -s {signum} {pid}[/]"
+            )
+            return False
+        except OSError as e:
+            console.print(f"[red]Failed to signal keepalived (pid {pid}): {e}[/]")
+            return False
+
+        deadline = time.monotonic() + wait
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if watcher.wait(remaining) and _dump_complete(path):
                 return True
-        except OSError:
-            pass
-        time.sleep(0.1)
     console.print(f"[yellow]Signalled keepalived (pid {pid}); {path} did not update within {wait:g}s.[/]")
     return True
 
@@ -610,7 +1029,803 @@ def _to_jsonable(instances: List[Instance], resolver: Resolver) -> list:
     return out
 
 
-@click.command(name=APP_NAME)
+def _read_instances(data_file: str, fmt: str = "auto") -> Tuple[List[Instance], Optional[str]]:
+    """Parse the dump for ``data_file``, returning the instances or the reason it could not be read."""
+    try:
+        return load_dump(data_file, fmt), None
+    except OSError as e:
+        return [], f"Cannot read {data_file}: {e}"
+    except ValueError as e:
+        return [], f"Cannot parse {pick_dump(data_file, fmt)[0]}: {e}"
+
+
+def watch(
+    data_file: str,
+    resolver: Resolver,
+    signal_interval: Optional[float] = None,
+    watcher: Optional[FileWatcher] = None,
+    fmt: str = "auto",
+    history: Optional["History"] = None,
+) -> int:
+    """Redraw the tables in place each time ``data_file`` is rewritten, until interrupted.
+
+    The file is only re-parsed when ``watcher`` reports a change; between
+    changes the process sleeps in the watcher. With ``signal_interval``,
+    keepalived is also asked for a fresh dump every ``signal_interval`` seconds.
+    Rows that changed since the previous frame (see :func:`diff_instances`) are highlighted.
+    Each new dump is also recorded in ``history``, if given.
+    """
+    watcher = watcher or FileWatcher(pick_dump(data_file, fmt)[0])
+    previous: List[Instance] = []
+    next_signal = time.monotonic()
+    changed_file = True
+    try:
+        with watcher, Live(console=console, auto_refresh=False) as live:
+            while True:
+                if signal_interval is not None and time.monotonic() >= next_signal:
+                    refresh_dump(data_file, fmt)
+                    next_signal = time.monotonic() + signal_interval
+                if changed_file:
+                    instances, error = _read_instances(data_file, fmt)
+                    if error:
+                        live.update(f"[red]{error}[/]", refresh=True)
+                    else:
+                        changed = {
+                            c.name for c in diff_instances(previous, instances) if previous and c.kind != "removed"
+                        }
+                        local_ip = next((i.src_ip for i in instances if i.src_ip), None)
+                        prefetch_names(resolver, instances)
+                        if history is not None:
+                            _record(history, instances)
+                        live.update(render_tables(instances, local_ip, resolver, changed), refresh=True)
+                        previous = instances
+                timeout = None if signal_interval is None else max(next_signal - time.monotonic(), 0)
+                changed_file = watcher.wait(timeout)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+# ---- Cluster view -------------------------------------------------------------
+
+# Remote command asking keepalived for a fresh dump before reading it (as simple_service_map does).
+_REMOTE_SIGNAL = "killall -USR1 keepalived && sleep {wait:g}; "
+_REMOTE_JSON_SIGNAL = "killall -s $(keepalived --signum=JSON) keepalived && sleep {wait:g}; "
+
+
+@attr.define
+class ClusterRow:
+    """One VRRP group (same VRID) as seen by every node that answered."""
+
+    key: str
+    vrid: Optional[int] = None
+    names: List[str] = attr.field(factory=list)
+    vips: List[str] = attr.field(factory=list)
+    members: Dict[str, Instance] = attr.field(factory=dict)
+
+    @property
+    def masters(self) -> List[str]:
+        return sorted(node for node, inst in self.members.items() if inst.is_master)
+
+    @property
+    def is_split_brain(self) -> bool:
+        """More than one node claims to be MASTER for the same VRID."""
+        return len(self.masters) > 1
+
+
+@attr.define
+class ClusterView:
+    """The dumps of every node, merged per VRRP group."""
+
+    rows: List[ClusterRow] = attr.field(factory=list)
+    nodes: List[str] = attr.field(factory=list)
+    errors: Dict[str, str] = attr.field(factory=dict)
+
+    @property
+    def split_brains(self) -> List[ClusterRow]:
+        return [row for row in self.rows if row.is_split_brain]
+
+
+def merge_cluster(dumps: Dict[str, List[Instance]], errors: Optional[Dict[str, str]] = None) -> ClusterView:
+    """Merge the instances parsed on each node into one row per VRID (per name when it is missing)."""
+    rows: Dict[str, ClusterRow] = {}
+    for node in sorted(dumps):
+        for inst in dumps[node]:
+            key = f"vrid:{inst.vrid}" if inst.vrid is not None else f"name:{inst.name}"
+            row = rows.setdefault(key, ClusterRow(key=key, vrid=inst.vrid))
+            row.members[node] = inst
+            if inst.name not in row.names:
+                row.names.append(inst.name)
+            row.vips.extend(vip for vip in inst.vips if vip not in row.vips)
+    ordered = sorted(rows.values(), key=lambda row: (row.names[0], row.vrid or 0))
+    return ClusterView(ordered, sorted(dumps), dict(errors or {}))
+
+
+def cluster_hosts(candidate_hosts: Dict[str, List[str]]) -> List[str]:
+    """Every host appearing in the candidate lists, in first-seen order."""
+    return list(dict.fromkeys(host for hosts in candidate_hosts.values() for host in hosts))
+
+
+def _is_local(host: str) -> bool:
+    try:
+        return ip_if_not_local(host) is None
+    except OSError:
+        return False
+
+
+async def _fetch_dump(
+    host: str, data_file: str, do_signal: bool, timeout: float, fmt: str = "auto"
+) -> Tuple[str, Union[List[Instance], str]]:
+    """The instances in ``host``'s dump, or why they could not be read."""
+    loop = asyncio.get_running_loop()
+    if await loop.run_in_executor(None, _is_local, host):
+        if do_signal:
+            await loop.run_in_executor(None, refresh_dump, data_file, fmt)
+        instances, error = await loop.run_in_executor(None, _read_instances, data_file, fmt)
+        return host, error or instances
+    # the remote files cannot be compared: "auto" means text unless DATA_FILE is a JSON dump
+    path, kind = pick_dump(data_file, "text" if fmt == "auto" and not data_file.endswith(".json") else fmt)
+    command = f"cat {shlex.quote(path)}"
+    if do_signal:
+        command = (_REMOTE_JSON_SIGNAL if kind == "json" else _REMOTE_SIGNAL).format(wait=REMOTE_SIGNAL_WAIT) + command
+    try:
+        result = await get_transport().run_async(host, command, ["-o", "BatchMode yes"], timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return host, f"no answer within {timeout:g}s"
+    if result.returncode:
+        return host, result.stderr.decode("utf-8", errors="replace").strip() or f"exit code {result.returncode}"
+    if kind == "json":
+        try:
+            return host, parse_json(result.stdout)
+        except ValueError as e:
+            return host, f"Cannot parse {path}: {e}"
+    return host, parse(result.stdout.decode("utf-8", errors="replace"))
+
+
+def fetch_cluster(
+    hosts: List[str], data_file: str, do_signal: bool = False, timeout: float = CLUSTER_TIMEOUT, fmt: str = "auto"
+) -> ClusterView:
+    """Fetch and parse the dump of every host concurrently, then merge them."""
+
+    async def fetch_all() -> List[Tuple[str, Union[List[Instance], str]]]:
+        return await asyncio.gather(*(_fetch_dump(host, data_file, do_signal, timeout, fmt) for host in hosts))
+
+    dumps: Dict[str, List[Instance]] = {}
+    errors: Dict[str, str] = {}
+    for host, answer in asyncio.run(fetch_all()):
+        if isinstance(answer, str):
+            errors[host] = answer
+        else:
+            dumps[host] = answer
+    return merge_cluster(dumps, errors)
+
+
+def render_cluster(view: ClusterView) -> Group:
+    """One row per VRRP group, one column per node ("STATE prio"), then the problems."""
+    parts: List[RenderableType] = []
+    table = Table(title="Keepalived cluster", header_style="bold")
+    table.add_column("Instance")
+    table.add_column("VRID", justify="right")
+    table.add_column("VIP")
+    for node in view.nodes:
+        table.add_column(node)
+    for row in view.rows:
+        cells = []
+        for node in view.nodes:
+            inst = row.members.get(node)
+            cells.append(f"{_state_text(inst.state)} {_priority_text(inst)}" if inst else "[dim]-[/]")
+        table.add_row(
+            ", ".join(row.names),
+            str(row.vrid if row.vrid is not None else "?"),
+            "\n".join(row.vips) or "[dim]-[/]",
+            *cells,
+            style="bold red" if row.is_split_brain else None,
+        )
+    parts.append(table)
+    problems = [
+        f"[red]✗[/] {', '.join(row.names)}: split brain, MASTER on {', '.join(row.masters)}"
+        for row in view.split_brains
+    ]
+    problems += [f"[red]✗[/] {', '.join(row.names)}: no MASTER" for row in view.rows if not row.masters]
+    problems += [f"[yellow]![/] {node}: did not answer ({error})" for node, error in sorted(view.errors.items())]
+    if problems:
+        parts.append("\n[bold underline]Problems[/]")
+        parts.extend(f"  {p}" for p in problems)
+    else:
+        parts.append("[green]No problems detected.[/]")
+    return Group(*parts)
+
+
+def _cluster_to_jsonable(view: ClusterView) -> dict:
+    return {
+        "rows": [
+            {
+                "names": row.names,
+                "vrid": row.vrid,
+                "vips": row.vips,
+                "split_brain": row.is_split_brain,
+                "masters": row.masters,
+                "members": {
+                    node: {
+                        "state": inst.state,
+                        "priority": inst.priority,
+                        "effective_priority": inst.effective_priority,
+                    }
+                    for node, inst in row.members.items()
+                },
+            }
+            for row in view.rows
+        ],
+        "nodes": view.nodes,
+        "errors": view.errors,
+    }
+
+
+# ---- Snapshot diff ------------------------------------------------------------
+
+
+@attr.define
+class InstanceChange:
+    """How an instance differs between two dumps: ``kind`` is ``added``, ``removed`` or ``changed``.
+
+    ``changes`` maps what changed (``state``, ``priority``, ``effective_priority``,
+    ``owner``, ``vips`` or ``script:NAME``) to its old and new value.
+    """
+
+    name: str
+    vrid: Optional[int]
+    kind: str
+    changes: Dict[str, Tuple[Any, Any]] = attr.field(factory=dict)
+
+
+def _instance_key(inst: Instance) -> Tuple[str, Optional[int]]:
+    return inst.name, inst.vrid
+
+
+def _compare(old: Instance, new: Instance) -> Dict[str, Tuple[Any, Any]]:
+    changes: Dict[str, Tuple[Any, Any]] = {}
+    for field in ("state", "priority", "effective_priority", "owner"):
+        before, after = getattr(old, field), getattr(new, field)
+        if before != after:
+            changes[field] = (before, after)
+    if set(old.vips) != set(new.vips):
+        changes["vips"] = (old.vips, new.vips)
+    old_scripts = {script.name: script.status for script in old.scripts}
+    for script in new.scripts:
+        before = old_scripts.pop(script.name, None)
+        if before != script.status:
+            changes[f"script:{script.name}"] = (before, script.status)
+    for name, before in old_scripts.items():
+        changes[f"script:{name}"] = (before, None)
+    return changes
+
+
+def diff_instances(old: Iterable[Instance], new: Iterable[Instance]) -> List[InstanceChange]:
+    """The instances that differ between two dumps, matched by name and VRID.
+
+    One pass over each dump (a keyed merge): the changed and added instances in
+    the order of ``new``, then the removed ones in the order of ``old``.
+
+    >>> before = [Instance(name="DNS", state="BACKUP", vrid=222), Instance(name="www", vrid=66)]
+    >>> after = [Instance(name="DNS", state="MASTER", vrid=222)]
+    >>> [(c.name, c.kind, c.changes) for c in diff_instances(before, after)]
+    [('DNS', 'changed', {'state': ('BACKUP', 'MASTER'), 'owner': ('unknown', 'local')}), ('www', 'removed', {})]
+    """
+    remaining = {_instance_key(inst): inst for inst in old}
+    result: List[InstanceChange] = []
+    for inst in new:
+        before = remaining.pop(_instance_key(inst), None)
+        if before is None:
+            result.append(InstanceChange(inst.name, inst.vrid, "added"))
+        else:
+            changes = _compare(before, inst)
+            if changes:
+                result.append(InstanceChange(inst.name, inst.vrid, "changed", changes))
+    result.extend(InstanceChange(inst.name, inst.vrid, "removed") for inst in remaining.values())
+    return result
+
+
+def _change_text(what: str, before: Any, after: Any) -> str:
+    if what == "vips":
+        moved = [f"[green]+{vip}[/]" for vip in after if vip not in before]
+        moved += [f"[red]-{vip}[/]" for vip in before if vip not in after]
+        return f"VIPs {' '.join(moved)}"
+    if what.endswith("priority") and before is not None and after is not None:
+        return f"{what.replace('_', ' ')} {before} → {after} ({after - before:+d})"
+    if what == "state":
+        return f"state {_state_text(before)} → {_state_text(after)}"
+    if what.startswith("script:"):
+        return f"script {what[7:]} {before or 'new'} → {after or 'removed'}"
+    return f"{what.replace('_', ' ')} {before} → {after}"
+
+
+def render_diff(changes: List[InstanceChange]) -> RenderableType:
+    """A table with one row per changed instance, or a note that the dumps match."""
+    if not changes:
+        return "[green]No differences.[/]"
+    table = Table(title="Keepalived changes", header_style="bold")
+    table.add_column("Instance")
+    table.add_column("VRID", justify="right")
+    table.add_column("Change")
+    for change in changes:
+        if change.kind == "changed":
+            text = "\n".join(_change_text(what, *values) for what, values in change.changes.items())
+        else:
+            text = f"[{'green' if change.kind == 'added' else 'red'}]{change.kind}[/]"
+        table.add_row(change.name, str(change.vrid if change.vrid is not None else "?"), text)
+    return table
+
+
+def _diff_to_jsonable(changes: List[InstanceChange]) -> list:
+    return [
+        {
+            "name": change.name,
+            "vrid": change.vrid,
+            "kind": change.kind,
+            "changes": {what: {"old": before, "new": after} for what, (before, after) in change.changes.items()},
+        }
+        for change in changes
+    ]
+
+
+# ---- Transition history -------------------------------------------------------
+
+HISTORY_FILE = os.path.join(CACHE_DIR, "keepalived_history.sqlite")
+DEFAULT_RETENTION_DAYS = 30.0
+# Transitions within the --history window from which an instance is reported as flapping.
+FLAP_THRESHOLD = 3
+
+_HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS latest (
+    name TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    seen REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS transitions (
+    name TEXT NOT NULL,
+    ts REAL NOT NULL,
+    state TEXT NOT NULL,
+    priority INTEGER,
+    effective_priority INTEGER,
+    degraded INTEGER NOT NULL,
+    owner TEXT,
+    changed INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transitions_name_ts ON transitions (name, ts);
+"""
+
+
+def _digest(inst: Instance) -> str:
+    """What makes two snapshots of an instance different, in a few bytes."""
+    key = (inst.state, inst.priority, inst.effective_priority, inst.owner, inst.last_transition_epoch)
+    return hashlib.blake2b(repr(key).encode(), digest_size=8).hexdigest()
+
+
+@attr.define
+class History:
+    """Per-instance state and priority transitions, kept in a SQLite file.
+
+    :meth:`record` only writes the instances that changed since the previous
+    snapshot (compared by digest), timestamped with keepalived's last
+    transition when the state changed. Rows older than ``retention_days`` are
+    dropped, except the latest of each instance, so the file stays small.
+    """
+
+    path: str = HISTORY_FILE
+    retention_days: float = DEFAULT_RETENTION_DAYS
+    _db: Optional[sqlite3.Connection] = attr.field(default=None, init=False, repr=False)
+    # --serve records from its follow thread: one connection, used by one thread at a time
+    _lock: threading.Lock = attr.field(factory=threading.Lock, init=False, repr=False)
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            if self.path != ":memory:":
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.executescript(_HISTORY_SCHEMA)
+        return self._db
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _query(self, sql: str, params: Tuple[Any, ...] = ()) -> List[Tuple[Any, ...]]:
+        with self._lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def __enter__(self) -> "History":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def record(self, instances: Iterable[Instance], now: Optional[float] = None) -> int:
+        """Append the instances that changed since the last snapshot; returns how many."""
+        now = now or time.time()
+        written = 0
+        with self._lock, self.db as db:
+            for inst in instances:
+                digest = _digest(inst)
+                row = db.execute("SELECT digest FROM latest WHERE name = ?", (inst.name,)).fetchone()
+                db.execute(
+                    "INSERT OR REPLACE INTO latest (name, digest, seen) VALUES (?, ?, ?)", (inst.name, digest, now)
+                )
+                if row is not None and row[0] == digest:
+                    continue
+                last = db.execute(
+                    "SELECT state, ts FROM transitions WHERE name = ? ORDER BY ts DESC, rowid DESC LIMIT 1",
+                    (inst.name,),
+                ).fetchone()
+                # a new last transition with the same state: it went away and came back in between
+                changed = (
+                    last is None
+                    or last[0] != inst.state
+                    or bool(inst.last_transition_epoch and inst.last_transition_epoch > last[1])
+                )
+                ts = now
+                if changed and inst.last_transition_epoch and (last is None or inst.last_transition_epoch > last[1]):
+                    ts = float(inst.last_transition_epoch)
+                db.execute(
+                    "INSERT INTO transitions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        inst.name,
+                        ts,
+                        inst.state,
+                        inst.priority,
+                        inst.effective_priority,
+                        int(inst.is_degraded),
+                        inst.owner,
+                        int(changed and last is not None),
+                    ),
+                )
+                written += 1
+        self.prune(now)
+        return written
+
+    def prune(self, now: Optional[float] = None) -> None:
+        """Apply the retention policy."""
+        cutoff = (now or time.time()) - self.retention_days * 86400
+        with self._lock, self.db as db:
+            db.execute(
+                "DELETE FROM transitions WHERE ts < ? AND rowid NOT IN "
+                "(SELECT MAX(rowid) FROM transitions GROUP BY name)",
+                (cutoff,),
+            )
+            gone = [name for (name,) in db.execute("SELECT name FROM latest WHERE seen < ?", (cutoff,))]
+            db.executemany("DELETE FROM transitions WHERE name = ?", [(name,) for name in gone])
+            db.executemany("DELETE FROM latest WHERE name = ?", [(name,) for name in gone])
+
+    def flaps(self, hours: float, now: Optional[float] = None) -> Dict[str, int]:
+        """State transitions of each instance in the last ``hours``."""
+        since = (now or time.time()) - hours * 3600
+        counts = {name: 0 for (name,) in self._query("SELECT name FROM latest ORDER BY name")}
+        for name, count in self._query(
+            "SELECT name, SUM(changed) FROM transitions WHERE ts >= ? GROUP BY name", (since,)
+        ):
+            counts[name] = count
+        return counts
+
+    def degraded_time(self, hours: float, now: Optional[float] = None) -> Dict[str, float]:
+        """Seconds each instance spent with a degraded priority in the last ``hours``."""
+        now = now or time.time()
+        since = now - hours * 3600
+        totals: Dict[str, float] = {}
+        start: Dict[str, Optional[float]] = {}
+        # each row lasts until the next one of the same instance (or now)
+        for name, ts, degraded in self._query("SELECT name, ts, degraded FROM transitions ORDER BY name, ts, rowid"):
+            begin = start.get(name)
+            totals[name] = totals.get(name, 0.0) + (max(min(ts, now) - max(begin, since), 0.0) if begin else 0.0)
+            start[name] = ts if degraded else None
+        for name, begin in start.items():
+            if begin is not None:
+                totals[name] += max(now - max(begin, since), 0.0)
+        return totals
+
+
+def _duration(seconds: float) -> str:
+    if not seconds:
+        return "-"
+    for unit, secs in (("d", 86400), ("h", 3600), ("m", 60)):
+        if seconds >= secs:
+            return f"{seconds / secs:.1f}{unit}"
+    return f"{seconds:.0f}s"
+
+
+def _record(history: History, instances: List[Instance]) -> None:
+    try:
+        history.record(instances)
+    except (sqlite3.Error, OSError) as e:
+        console.print(f"[yellow]Cannot record the history in {history.path}: {e}[/]")
+
+
+def render_history(history: History, hours: float, threshold: int = FLAP_THRESHOLD) -> Tuple[Group, List[str]]:
+    """Flaps and time degraded per instance over the last ``hours``, and the flapping instances."""
+    flaps = history.flaps(hours)
+    degraded = history.degraded_time(hours)
+    table = Table(title=f"Keepalived history (last {hours:g}h)", header_style="bold")
+    table.add_column("Instance")
+    table.add_column("Flaps", justify="right")
+    table.add_column("Degraded", justify="right")
+    flapping = [name for name, count in flaps.items() if count >= threshold]
+    for name, count in flaps.items():
+        table.add_row(
+            name, str(count), _duration(degraded.get(name, 0.0)), style="bold red" if name in flapping else None
+        )
+    parts: List[RenderableType] = [table]
+    if flapping:
+        parts.append("\n[bold underline]Problems[/]")
+        parts.extend(f"  [red]✗[/] {name}: flapping ({flaps[name]} transitions in {hours:g}h)" for name in flapping)
+    return Group(*parts), flapping
+
+
+# ---- Metrics exporter ---------------------------------------------------------
+
+DEFAULT_METRICS_PORT = 9650
+# Scrapes served at the same time; more get a 503 instead of piling up threads.
+MAX_SCRAPES = 4
+_OPENMETRICS_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+def parse_listen(address: str) -> Tuple[str, int]:
+    """``[HOST]:PORT`` (or just ``PORT``) -> ``(host, port)``; an empty host listens on all addresses.
+
+    >>> parse_listen(":9650"), parse_listen("127.0.0.1:9100"), parse_listen("[::1]:9650"), parse_listen("9650")
+    (('', 9650), ('127.0.0.1', 9100), ('::1', 9650), ('', 9650))
+    """
+    host, _, port = address.rpartition(":")
+    return host.strip("[]"), int(port or DEFAULT_METRICS_PORT)
+
+
+def _labels(**labels: Any) -> str:
+    def escape(value: Any) -> str:
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def _metric(lines: List[str], name: str, kind: str, help_text: str, samples: Iterable[Tuple[str, Any]]) -> None:
+    lines.append(f"# TYPE {name} {kind}")
+    lines.append(f"# HELP {name} {help_text}")
+    lines.extend(f"{name}{labels} {value}" for labels, value in samples)
+
+
+def metrics_text(instances: List[Instance], now: Optional[float] = None) -> List[str]:
+    """The OpenMetrics samples for ``instances``, except the ones depending on the time of the scrape.
+
+    The VRRP instance goes in the ``vrrp_instance`` label: ``instance`` is the
+    scrape target's in Prometheus.
+    """
+    lines: List[str] = []
+    _metric(
+        lines,
+        "keepalived_vrrp_state",
+        "gauge",
+        "1 for the current VRRP state of the instance.",
+        (
+            (_labels(vrrp_instance=inst.name, vrid=inst.vrid, state=state), int(inst.state.upper() == state))
+            for inst in instances
+            for state in sorted(_VALID_STATES)
+        ),
+    )
+    _metric(
+        lines,
+        "keepalived_vrrp_priority",
+        "gauge",
+        "Configured priority.",
+        ((_labels(vrrp_instance=i.name, vrid=i.vrid), i.priority) for i in instances if i.priority is not None),
+    )
+    _metric(
+        lines,
+        "keepalived_vrrp_effective_priority",
+        "gauge",
+        "Priority after the weights of the tracked scripts.",
+        (
+            (_labels(vrrp_instance=i.name, vrid=i.vrid), i.effective_priority)
+            for i in instances
+            if i.effective_priority is not None
+        ),
+    )
+    _metric(
+        lines,
+        "keepalived_vrrp_script_ok",
+        "gauge",
+        "1 if the tracked script is passing.",
+        (
+            (_labels(vrrp_instance=i.name, script=s.name, status=s.status), int(s.is_ok))
+            for i in instances
+            for s in i.scripts
+        ),
+    )
+    owners: Dict[str, int] = {}
+    for inst in instances:
+        owners[inst.owner] = owners.get(inst.owner, 0) + len(inst.vips)
+    _metric(
+        lines,
+        "keepalived_vips",
+        "gauge",
+        "VIPs held by each node.",
+        ((_labels(owner=owner), count) for owner, count in sorted(owners.items())),
+    )
+    return lines
+
+
+@attr.frozen
+class _MetricsSnapshot:
+    """What a scrape renders, replaced as a whole when the dump is read again."""
+
+    static: str = ""
+    transitions: Tuple[Tuple[str, int], ...] = ()
+    up: int = 0
+    loaded: float = 0.0
+
+
+@attr.define
+class MetricsExporter:
+    """Keeps the metrics of the dump for ``data_file`` ready for scrapes.
+
+    The dump is only parsed again by :meth:`follow` when it changes, so a
+    scrape just joins the cached lines with the seconds since each transition.
+    """
+
+    data_file: str
+    fmt: str = "auto"
+    history: Optional[History] = None
+    max_scrapes: int = MAX_SCRAPES
+    _snapshot: _MetricsSnapshot = attr.field(factory=_MetricsSnapshot, init=False)
+    _slots: threading.BoundedSemaphore = attr.field(init=False)
+
+    @_slots.default
+    def _make_slots(self) -> threading.BoundedSemaphore:
+        return threading.BoundedSemaphore(self.max_scrapes)
+
+    def reload(self) -> Optional[str]:
+        """Parse the dump again; returns why it could not be read, if so (the previous metrics are kept)."""
+        instances, error = _read_instances(self.data_file, self.fmt)
+        if error:
+            self._snapshot = attr.evolve(self._snapshot, up=0)
+            return error
+        if self.history is not None:
+            _record(self.history, instances)
+        # a single assignment: scrapes running in other threads see either the old or the new dump
+        self._snapshot = _MetricsSnapshot(
+            "\n".join(metrics_text(instances)) + "\n",
+            tuple((i.name, i.last_transition_epoch) for i in instances if i.last_transition_epoch),
+            1,
+            time.time(),
+        )
+        return None
+
+    def render(self, now: Optional[float] = None) -> str:
+        now = now or time.time()
+        snapshot = self._snapshot
+        lines: List[str] = []
+        _metric(
+            lines, "keepalived_status_up", "gauge", "1 if the last read of the dump succeeded.", [("", snapshot.up)]
+        )
+        _metric(
+            lines,
+            "keepalived_status_last_reload_timestamp_seconds",
+            "gauge",
+            "When the dump was last parsed.",
+            [("", snapshot.loaded)],
+        )
+        _metric(
+            lines,
+            "keepalived_vrrp_last_transition_seconds",
+            "gauge",
+            "Seconds since the last state transition.",
+            ((_labels(vrrp_instance=name), max(now - epoch, 0)) for name, epoch in snapshot.transitions),
+        )
+        return snapshot.static + "\n".join(lines) + "\n# EOF\n"
+
+    def follow(self, watcher: FileWatcher, signal_interval: Optional[float] = None) -> None:
+        """Reload whenever ``watcher`` sees a new dump, asking for one every ``signal_interval`` seconds."""
+        next_signal = time.monotonic() + (signal_interval or 0)
+        with watcher:
+            while True:
+                timeout = None if signal_interval is None else max(next_signal - time.monotonic(), 0)
+                if watcher.wait(timeout):
+                    self.reload()
+                if signal_interval is not None and time.monotonic() >= next_signal:
+                    refresh_dump(self.data_file, self.fmt)
+                    next_signal = time.monotonic() + signal_interval
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    server: "_MetricsServer"
+
+    def do_GET(self) -> None:
+        if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        exporter = self.server.exporter
+        if not exporter._slots.acquire(blocking=False):
+            self.send_error(503, "Too many concurrent scrapes")
+            return
+        try:
+            body = exporter.render().encode()
+        finally:
+            exporter._slots.release()
+        self.send_response(200)
+        self.send_header("Content-Type", _OPENMETRICS_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+class _MetricsServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], exporter: MetricsExporter) -> None:
+        self.exporter = exporter
+        if ":" in address[0]:
+            self.address_family = socket.AF_INET6
+        super().__init__(address, _MetricsHandler)
+
+
+def serve(
+    address: str,
+    data_file: str,
+    fmt: str = "auto",
+    signal_interval: Optional[float] = None,
+    history: Optional[History] = None,
+) -> int:
+    """Serve the metrics of ``data_file`` on ``address`` (``[HOST]:PORT``) until interrupted."""
+    exporter = MetricsExporter(data_file, fmt, history)
+    server = _MetricsServer(parse_listen(address), exporter)
+    # watching before the first read, not to miss a dump written in between
+    watcher = FileWatcher(pick_dump(data_file, fmt)[0])
+    if signal_interval is not None:
+        refresh_dump(data_file, fmt)
+    error = exporter.reload()
+    if error:
+        console.print(f"[yellow]{error}[/]")
+    threading.Thread(target=exporter.follow, args=(watcher, signal_interval), daemon=True).start()
+    host = parse_listen(address)[0]
+    console.print(f"Serving keepalived metrics on http://{host or '*'}:{server.server_port}/metrics")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+class _DefaultGroup(click.Group):
+    """Runs the ``status`` command when the first argument is not a command name,
+    so ``ka-status [DATA_FILE] [OPTIONS]`` keeps working next to ``ka-status diff``.
+    """
+
+    def parse_args(self, ctx: click.Context, args: List[str]) -> List[str]:
+        if not args or (args[0] not in self.commands and args[0] not in ctx.help_option_names):
+            args = ["status"] + list(args)
+        return super().parse_args(ctx, args)
+
+
+_FORMAT_OPTION = click.option(
+    "--format",
+    "-f",
+    "fmt",
+    type=click.Choice(["auto", "json", "text"]),
+    default="auto",
+    show_default=True,
+    help="Dump to read: keepalived.json (SIGJSON), keepalived.data (SIGUSR1) or the newest of the two.",
+)
+
+
+@click.group(name=APP_NAME, cls=_DefaultGroup)
+def main() -> None:
+    """Show the keepalived status (the default command) or compare two dumps."""
+
+
+@main.command(name="status")
 @click.argument("data_file", default=DEFAULT_DATA_FILE, type=click.Path())
 @click.option("--json", "as_json", is_flag=True, help="Emit parsed data as JSON instead of tables.")
 @click.option("--no-resolve", "no_resolve", is_flag=True, help="Do not reverse-resolve node IPs to hostnames.")
@@ -627,25 +1842,157 @@ def _to_jsonable(instances: List[Instance], resolver: Resolver) -> list:
     is_flag=True,
     help="Send SIGUSR1 to keepalived to regenerate DATA_FILE before reading it.",
 )
-def main(data_file: str, as_json: bool, no_resolve: bool, simple: bool, do_signal: bool) -> int:
+@click.option(
+    "--watch",
+    "-w",
+    "do_watch",
+    is_flag=True,
+    help="Keep running, updating the tables whenever DATA_FILE changes.",
+)
+@click.option(
+    "--interval",
+    "-i",
+    type=float,
+    default=DEFAULT_WATCH_INTERVAL,
+    show_default=True,
+    help="With --watch --signal, seconds between SIGUSR1s to keepalived.",
+)
+@click.option(
+    "--cluster",
+    "-c",
+    "cluster",
+    is_flag=True,
+    help="Fetch DATA_FILE from every candidate host (or --host) in parallel and merge them per VRID.",
+)
+@click.option(
+    "--host",
+    "-H",
+    "hosts",
+    multiple=True,
+    help="With --cluster, the nodes to query (default: the hosts in the keepalived configs).",
+)
+@click.option(
+    "--record",
+    "record",
+    is_flag=True,
+    help="Append the instances that changed to the transition history (on each update with --watch).",
+)
+@click.option(
+    "--history",
+    "history_hours",
+    type=float,
+    metavar="HOURS",
+    help="Show flaps and time degraded per instance over the last HOURS; exits 1 if an instance is flapping.",
+)
+@click.option(
+    "--db",
+    "db",
+    type=click.Path(dir_okay=False),
+    help="Transition history file (default: ~/.cache/canepan.tools/keepalived_history.sqlite).",
+)
+@click.option(
+    "--retention",
+    type=float,
+    default=DEFAULT_RETENTION_DAYS,
+    show_default=True,
+    help="Days of transition history to keep.",
+)
+@click.option(
+    "--serve",
+    "listen",
+    metavar="[HOST]:PORT",
+    help=f"Serve the dump as OpenMetrics on http://HOST:PORT/metrics (e.g. :{DEFAULT_METRICS_PORT}), "
+    "parsing it again only when it changes.",
+)
+@_FORMAT_OPTION
+def status(
+    data_file: str,
+    as_json: bool,
+    no_resolve: bool,
+    simple: bool,
+    do_signal: bool,
+    do_watch: bool,
+    interval: float,
+    cluster: bool,
+    hosts: Tuple[str, ...],
+    record: bool,
+    history_hours: Optional[float],
+    db: Optional[str],
+    retention: float,
+    listen: Optional[str],
+    fmt: str,
+) -> int:
     """Read DATA_FILE (a keepalived.data dump) and show keepalived status.
 
     DATA_FILE defaults to /tmp/keepalived.data. With --signal, keepalived is
     asked to regenerate the dump first (usually requires running as root).
+    With --watch, the tables are redrawn in place each time the dump changes.
+    With --cluster, the dumps of all the nodes are shown side by side.
+    The JSON dump next to DATA_FILE (keepalived.json) is read instead when it
+    is newer, or always with --format json.
+    With --record, the transitions are kept in a history file (run it from
+    cron, or along with --watch) that --history reports flapping from.
+    With --serve, the status is exported as Prometheus/OpenMetrics metrics.
     """
-    if do_signal and not refresh_data_file(data_file):
+    history = History(db or HISTORY_FILE, retention) if record or history_hours is not None else None
+    if history is not None and history_hours is not None:
+        with history:
+            group, flapping = render_history(history, history_hours)
+            if as_json:
+                flaps, degraded = history.flaps(history_hours), history.degraded_time(history_hours)
+                data = {
+                    name: {"flaps": count, "degraded_seconds": degraded.get(name, 0.0), "flapping": name in flapping}
+                    for name, count in flaps.items()
+                }
+                click.echo(_json.dumps(data, indent=2))
+            else:
+                console.print(group)
+        if flapping:
+            raise SystemExit(1)
+        return 0
+
+    if cluster:
+        node_list = list(hosts) or cluster_hosts(load_candidate_hosts())
+        if not node_list:
+            console.print("[red]No hosts to query: pass --host or check the keepalived configs.[/]")
+            raise SystemExit(1)
+        view = fetch_cluster(node_list, data_file, do_signal, fmt=fmt)
+        if as_json:
+            click.echo(_json.dumps(_cluster_to_jsonable(view), indent=2))
+        else:
+            console.print(render_cluster(view))
+        return 0
+
+    if listen:
+        if history is not None:
+            with history:
+                return serve(listen, data_file, fmt, interval if do_signal else None, history)
+        return serve(listen, data_file, fmt, interval if do_signal else None, history)
+
+    if do_watch:
+        return watch(
+            data_file,
+            make_resolver(enabled=not no_resolve),
+            interval if do_signal else None,
+            fmt=fmt,
+            history=history,
+        )
+
+    if do_signal and not refresh_dump(data_file, fmt):
         raise SystemExit(1)
 
-    try:
-        with open(data_file, "r") as f:
-            text = f.read()
-    except OSError as e:
-        console.print(f"[red]Cannot read {data_file}: {e}[/]")
+    instances, error = _read_instances(data_file, fmt)
+    if error:
+        console.print(f"[red]{error}[/]")
         raise SystemExit(1)
 
-    instances = parse(text)
+    if history is not None:
+        with history:
+            _record(history, instances)
+
     local_ip = next((i.src_ip for i in instances if i.src_ip), None)
     resolver = make_resolver(enabled=not no_resolve)
+    prefetch_names(resolver, instances)
 
     if as_json:
         click.echo(_json.dumps(_to_jsonable(instances, resolver), indent=2))
@@ -656,5 +2003,34 @@ def main(data_file: str, as_json: bool, no_resolve: bool, simple: bool, do_signa
     return 0
 
 
+@main.command(name="diff")
+@click.argument("old", type=click.Path())
+@click.argument("new", type=click.Path())
+@click.option("--json", "as_json", is_flag=True, help="Emit the changes as JSON instead of a table.")
+@_FORMAT_OPTION
+def diff(old: str, new: str, as_json: bool, fmt: str) -> int:
+    """Show what changed between the dumps OLD and NEW.
+
+    Instances are matched by name and VRID; state, priority, owner, VIP and
+    tracked-script changes are listed, as well as added and removed instances.
+    Exits 1 if the dumps differ, like diff(1).
+    """
+    dumps = []
+    for path in (old, new):
+        instances, error = _read_instances(path, fmt)
+        if error:
+            console.print(f"[red]{error}[/]")
+            raise SystemExit(2)
+        dumps.append(instances)
+    changes = diff_instances(*dumps)
+    if as_json:
+        click.echo(_json.dumps(_diff_to_jsonable(changes), indent=2))
+    else:
+        console.print(render_diff(changes))
+    if changes:
+        raise SystemExit(1)
+    return 0
+
+
 if __name__ == "__main__":
     main()
@@ -11,6 +11,8 @@ import sys
 import typing
 from abc import ABC, abstractmethod
 
+from tools.libs.ssh_transport import get_transport
+
 ORIG_MODE = stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH
 DEFAULTS = {
     'minecraft_ctl': {
@@ -44,6 +46,10 @@ DEFAULTS = {
         'signal': '9',
     },
 }
+FIREWALL_HOST = 'manage_internet@mt'
+FIREWALL_SSH_ARGS = ('-i', '/Users/nicola/.ssh/mt_remote')
+PROXY_HOST = 'phoenix'
+PROXY_SSH_ARGS = ('-t', '-i', '/Users/nicola/.ssh/id_rsa')
 
 
 def parse_args(argv: list, prog_name: str = sys.argv[0]) -> argparse.Namespace:
@@ -95,47 +101,28 @@ class FirewallManager(AllowDenyManager):
     pretend = attr.ib(default=True)
     timeout: int = attr.ib(default=None)
 
+    def _run(self, command: str) -> str:
+        if self.pretend:
+            return f'Would execute {get_transport().ssh_args(FIREWALL_HOST, command, FIREWALL_SSH_ARGS)}'
+        return self._status(command)
+
+    def _status(self, command: str) -> str:
+        return get_transport().check_output(
+            FIREWALL_HOST, command, FIREWALL_SSH_ARGS, stderr=subprocess.PIPE
+        ).decode('utf-8')
+
     def allow(self):
-        command = [
-            'ssh',
-            '-i',
-            '/Users/nicola/.ssh/mt_remote',
-            'manage_internet@mt',
-        ]
         if self.timeout is None:
-            command.append(f'/ip firewall address-list disable numbers={self.rules}')
-        else:
-            command.append(
-                f'/ip firewall address-list add list=KidsTemporaryAllow'
-                f' address=192.168.19.137 timeout={self.timeout}m')
-        if self.pretend:
-            return f'Would execute {command}'
-        return subprocess.check_output(command, stderr=subprocess.PIPE).decode('utf-8')
+            return self._run(f'/ip firewall address-list disable numbers={self.rules}')
+        return self._run(
+            f'/ip firewall address-list add list=KidsTemporaryAllow address=192.168.19.137 timeout={self.timeout}m'
+        )
 
     def deny(self):
-        command = [
-            'ssh',
-            '-i',
-            '/Users/nicola/.ssh/mt_remote',
-            'manage_internet@mt',
-            f'/ip firewall address-list enable numbers={self.rules}',
-        ]
-        if self.pretend:
-            return f'Would execute {command}'
-        return subprocess.check_output(command, stderr=subprocess.PIPE).decode('utf-8')
+        return self._run(f'/ip firewall address-list enable numbers={self.rules}')
 
     def status(self):
-        output = subprocess.check_output(
-            [
-                'ssh',
-                '-i',
-                '/Users/nicola/.ssh/mt_remote',
-                'manage_internet@mt',
-                f'/ip firewall address-list print from={",".join([str(i) for i in self.rules])}',
-            ],
-            stderr=subprocess.PIPE,
-        ).decode('utf-8')
-        return output
+        return self._status(f'/ip firewall address-list print from={",".join([str(i) for i in self.rules])}')
 
 
 @attr.s
@@ -221,12 +208,12 @@ class PermsManager(AllowDenyManager):
 class Executor(object):
     pretend: bool = attr.ib(True)
 
-    def exec(self, *args, **kwargs) -> str:
+    def remote_exec(self, host: str, command: str, extra_args: typing.Sequence[str] = (), **kwargs) -> str:
         if 'stderr' not in kwargs:
             kwargs['stderr'] = subprocess.PIPE
         if self.pretend:
-            return f'Would execute {args} {kwargs}'
-        return subprocess.check_output(*args, **kwargs).decode('utf-8')
+            return f'Would execute {get_transport().ssh_args(host, command, extra_args)} {kwargs}'
+        return get_transport().check_output(host, command, extra_args, **kwargs).decode('utf-8')
 
 
 @attr.s
@@ -235,26 +222,20 @@ class ProxyManager(Executor, AllowDenyManager):
     proxy_commands: dict = attr.ib(dict())
     pretend: bool = attr.ib(True)
 
-    def allow(self):
+    def _run(self, action: str) -> str:
         results = []
-        for command in self.proxy_commands.get('enable', []):
-            command = ['ssh', '-t', '-i', '/Users/nicola/.ssh/id_rsa', 'phoenix', command + ' || true']
-            results.append(self.exec(command))
+        for command in self.proxy_commands.get(action, []):
+            results.append(self.remote_exec(PROXY_HOST, command + ' || true', PROXY_SSH_ARGS))
         return '\n'.join(results)
 
+    def allow(self):
+        return self._run('enable')
+
     def deny(self):
-        results = []
-        for command in self.proxy_commands.get('disable', []):
-            command = ['ssh', '-t', '-i', '/Users/nicola/.ssh/id_rsa', 'phoenix', command + ' || true']
-            results.append(self.exec(command))
-        return '\n'.join(results)
+        return self._run('disable')
 
     def status(self):
-        results = []
-        for command in self.proxy_commands.get('status', []):
-            command = ['ssh', '-t', '-i', '/Users/nicola/.ssh/id_rsa', 'phoenix', command + ' || true']
-            results.append(self.exec(command))
-        return '\n'.join(results)
+        return self._run('status')
 
 
 def main(argv: list = sys.argv[1:], prog_name: str = sys.argv[0]) -> int:
@@ -1,9 +1,8 @@
 #!/mnt/opt/nicola/tools/bin/python
 import os
-from glob import glob
 from subprocess import check_output
 
-from tools.bin.simple_service_map import Service
+from tools.libs.service_index import load_services
 
 
 def get_ip_map():
@@ -29,10 +28,8 @@ def get_ip_map():
 
 def main():
     ip_map = get_ip_map()
-    services = [Service(f) for f in glob("/etc/keepalived/keepalived.d/*.conf")]
-
-    for svc in services:
-        ip = svc.service_dict["ip"]
+    for svc in load_services():
+        ip = svc.ip
         host = ip_map.get(ip, "no active host")
         print(f"{svc.name} ({ip}): {host} ({', '.join(svc.hosts)})")
 
@@ -1,10 +1,13 @@
 #!/mnt/opt/nicola/tools/bin/python
+import shlex
 import socket
 import subprocess
 import sys
 
+from ..libs.net_utils import resolver
 from ..libs.stools_defaults import HOSTS
 from ..libs.parse_args import LoggingArgumentParser
+from ..libs.ssh_transport import get_transport
 
 APP_NAME = 'SSHDiff'
 
@@ -25,26 +28,31 @@ def main(argv: list = sys.argv[1:]):
     _other_hosts = args.hosts
 
     _myhn = socket.gethostname()
-    args.log.debug('Resolving {}'.format(_myhn))
-    _myip = socket.gethostbyname(_myhn)
+    # one parallel round for all the hosts (and this one)
+    addresses = resolver.resolve_many([_myhn] + [_hn for _hn in _other_hosts if _hn != _myhn])
+    args.log.debug('Resolver stats: %s', resolver.stats)
+    _myip = addresses[_myhn]
     for _fn in args.filename:
         for _hn in _other_hosts:
             if _hn != _myhn:
-                args.log.debug('Resolving {}'.format(_hn))
                 try:
-                    _ip = socket.gethostbyname(_hn)
+                    _ip = addresses[_hn]
+                    if isinstance(_ip, socket.gaierror):
+                        raise _ip
                     if _ip != _myip:
-                        result = subprocess.check_output(
-                            'ssh {0} "cat \'{1}\'" | {2} "{1}" - ; ' 'exit 0'.format(_hn, _fn, args.diff),
+                        remote_content = get_transport().check_output(_hn, f"cat '{_fn}'", stderr=subprocess.PIPE)
+                        result = subprocess.run(
+                            shlex.split(args.diff) + [_fn, '-'],
+                            input=remote_content,
+                            stdout=subprocess.PIPE,
                             stderr=subprocess.STDOUT,
-                            shell=True,
-                        )
+                        ).stdout
                         if result.decode():
                             args.log.info('Diff between local and %s:%s\n%s', _hn, _fn, result.decode())
                         else:
                             args.log.info('%s is the same on %s', _fn, _hn)
                 except subprocess.CalledProcessError as e:
-                    args.log.error(e.output.decode())
+                    args.log.error((e.stderr or e.output).decode())
                     args.log.debug('Exit code: %s', e.returncode)
                 except socket.gaierror as e:
                     args.log.error('Error resolving %s: %s', _hn, e)
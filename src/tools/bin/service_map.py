@@ -13,6 +13,7 @@ from click_loglevel import LogLevel
 
 from tools.libs.net_utils import ip_if_not_local
 from tools.libs.parse_args import LoggingArgumentParser
+from tools.libs.ssh_transport import get_transport
 from tools.libs.text_utils import CompareContents
 
 SERVICE_CONFIGS = {
@@ -206,7 +207,7 @@ class ServiceCatalog(object):
 
 def remote_command(host: str, cmd: list):
     if host:
-        cmd = ['ssh', host] + cmd
+        return get_transport().check_output(host, cmd).decode('utf-8')
     return subprocess.check_output(cmd).decode('utf-8')
 
 
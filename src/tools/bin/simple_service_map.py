@@ -3,38 +3,98 @@ import enum
 import json
 import logging
 import os
-import re
+import shlex
 import sys
+import time
 import typing
 from collections import defaultdict
+from collections.abc import MutableMapping
 from concurrent.futures import ThreadPoolExecutor
-from functools import lru_cache
 from getpass import getuser
-from glob import glob
 from subprocess import check_output, CalledProcessError, STDOUT
 
 import attr
 import click
 
-from tools.libs.net_utils import ip_if_not_local
-
-KA_DIR = "/etc/keepalived/keepalived.d"
-KA_CONFIG_DIR = "/etc/keepalived"
-KA_CHECKS_DIR = os.path.join(KA_CONFIG_DIR, "bin")
-LOCAL_SUBNET_TEMPLATE = "192.168.19.{}/24"
+from tools.libs.file_utils import locked, write_json_atomic
+from tools.libs.memoize import ttl_cache
+from tools.libs.net_utils import CACHE_DIR, ip_if_not_local, resolver
+from tools.libs.reachability import Reachability, probe, probe_many
+from tools.libs.service_index import (
+    KA_DIR,
+    DecodeFirstLineException,
+    ServiceEntry,
+    load_services,
+    parse_service,
+)
+from tools.libs.ssh_transport import CONNECTION_ERROR, get_transport
+
+# starts the lines delimiting the records in the output of probe_script
+PROBE_MARKER = "@@service-map@@"
+STATUS_CACHE_FILE = os.path.join(CACHE_DIR, "service_map_status.json")
+# seconds a cached result is used for, per probe type (see probe_type)
+DEFAULT_MAX_AGE = {"ping": 60.0, "state": 30.0, "check": 120.0}
+# cached results older than this are dropped from the file
+CACHE_RETENTION = 86400.0
 
 
 def remote_command(host: str, cmd: list) -> str:
     return _remote_command(host, " ".join(cmd))
 
 
-@lru_cache(maxsize=50)
+# the output of a check is reused for the whole run, a failure is retried after a few seconds
+@ttl_cache(ttl=60.0, error_ttl=5.0, maxsize=512, errors=(CalledProcessError,))
 def _remote_command(host: str, cmd: str) -> str:
     if host:
-        run_cmd = ['ssh', '-o', 'ConnectTimeout=2', host, cmd]
-    else:
-        run_cmd = ['bash', "-c", cmd]
-    return check_output(run_cmd, universal_newlines=True, stderr=STDOUT)
+        return get_transport().check_output(
+            host, cmd, ['-o', 'ConnectTimeout=2'], universal_newlines=True, stderr=STDOUT
+        )
+    return check_output(['bash', "-c", cmd], universal_newlines=True, stderr=STDOUT)
+
+
+def probe_script(services: typing.Iterable["Service"]) -> str:
+    """
+    Shell snippet printing, for each service, its state file and the exit code of its check script:
+    each record starts with a "PROBE_MARKER <kind> <name>" line and ends with "PROBE_MARKER rc <exit code>"
+    """
+    lines = []
+    for service in services:
+        state_header = shlex.quote(f"{PROBE_MARKER} state {service.name}")
+        check_header = shlex.quote(f"{PROBE_MARKER} check {service.name}")
+        lines.append(
+            f"echo {state_header}; cat {shlex.quote(f'/tmp/{service.name}.state')} 2>/dev/null; rc=$?; echo; "
+            f"echo \"{PROBE_MARKER} rc $rc\""
+        )
+        lines.append(
+            f"echo {check_header}; ({service.check_script}) >/dev/null 2>&1 </dev/null; echo \"{PROBE_MARKER} rc $?\""
+        )
+    return "\n".join(lines)
+
+
+def parse_probe_output(output: str) -> typing.Dict[typing.Tuple[str, str], typing.Tuple[int, str]]:
+    """ {(kind, service name): (exit code, output)} from the output of probe_script """
+    results = {}
+    key = None
+    body: typing.List[str] = []
+    for line in output.splitlines():
+        if not line.startswith(f"{PROBE_MARKER} "):
+            body.append(line)
+            continue
+        kind, _, rest = line[len(PROBE_MARKER) + 1:].partition(" ")
+        if kind != "rc":
+            key, body = (kind, rest), []
+        elif key is not None:
+            try:
+                results[key] = (int(rest), "\n".join(body).strip())
+            except ValueError:
+                pass
+            key = None
+    return results
+
+
+def is_master_state(state: str) -> bool:
+    """ Whether the content of a "/tmp/<service>.state" file ("<timestamp> - <state> - <type>") is MASTER """
+    return state.split("-")[1].strip() == "MASTER"
 
 
 def active(name: str) -> str:
@@ -72,6 +132,134 @@ def is_failed(name: str) -> bool:
 STATES = {f(""): f for f in (active, failed, running, usurper)}
 
 
+def probe_type(key: str) -> str:
+    """ The status cache keys are "ping", "+<service>" (its state file) or "<service>" (its check script) """
+    if key == "ping":
+        return "ping"
+    return "state" if key.startswith("+") else "check"
+
+
+def format_age(seconds: float) -> str:
+    for unit, secs in (("h", 3600), ("m", 60)):
+        if seconds >= secs:
+            return f"{seconds // secs:.0f}{unit}"
+    return f"{seconds:.0f}s"
+
+
+class HostStatus(MutableMapping):
+    """ The results for one host in a StatusCache: expired entries are missing """
+
+    def __init__(self, cache: "StatusCache", host: str):
+        self._cache = cache
+        self._host = host
+
+    def _valid(self, key: str) -> typing.Optional[list]:
+        entry = self._cache.entries.get(self._host, {}).get(key)
+        if entry is None or self._cache.is_expired(key, entry[1]):
+            return None
+        return entry
+
+    def __getitem__(self, key: str):
+        entry = self._valid(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry[0]
+
+    def __setitem__(self, key: str, value) -> None:
+        self._cache.entries[self._host][key] = [value, time.time()]
+        self._cache.dirty = True
+
+    def __delitem__(self, key: str) -> None:
+        del self._cache.entries[self._host][key]
+
+    def __iter__(self) -> typing.Iterator[str]:
+        return (key for key in list(self._cache.entries.get(self._host, {})) if self._valid(key) is not None)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+@attr.s
+class StatusCache(object):
+    """
+    Results of the probes, {host: {key: [value, timestamp]}}, shared with the other runs through ``path``.
+    A result is used for ``max_age[probe_type(key)]`` seconds, never with ``refresh``
+    """
+    path: typing.Optional[str] = attr.ib(default=None)
+    max_age: typing.Dict[str, float] = attr.ib(factory=lambda: dict(DEFAULT_MAX_AGE))
+    refresh: bool = attr.ib(default=False)
+    entries: typing.Dict[str, typing.Dict[str, list]] = attr.ib(factory=lambda: defaultdict(dict))
+    started: float = attr.ib(factory=time.time)
+    dirty: bool = attr.ib(default=False)
+
+    def __attrs_post_init__(self):
+        self.log = logging.getLogger(__name__)
+
+    def __getitem__(self, host: str) -> HostStatus:
+        return HostStatus(self, host)
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+    def is_expired(self, key: str, timestamp: float, now: float = None) -> bool:
+        if self.refresh and timestamp < self.started:
+            return True
+        return (now or time.time()) - timestamp > self.max_age.get(probe_type(key), 0)
+
+    def age(self, host: str, key: str) -> typing.Optional[float]:
+        """ Seconds since ``key`` was probed for ``host`` by an earlier run, None if it was probed by this one """
+        entry = self.entries.get(host, {}).get(key)
+        if entry is None or entry[1] >= self.started or self.is_expired(key, entry[1]):
+            return None
+        return time.time() - entry[1]
+
+    def service_age(self, host: str, service: str) -> typing.Optional[float]:
+        """ The age of the oldest cached result shown for ``service`` on ``host`` """
+        ages = [age for key in (f"+{service}", service) if (age := self.age(host, key)) is not None]
+        return max(ages) if ages else None
+
+    @staticmethod
+    def _read(path: str) -> typing.Dict[str, typing.Dict[str, list]]:
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+            return {host: dict(entries) for host, entries in data.items()}
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            logging.getLogger(__name__).warning(f"Ignoring unreadable status cache {path}: {e}")
+            return {}
+
+    @classmethod
+    def load(cls, path: str = None, **kwargs) -> "StatusCache":
+        path = path or STATUS_CACHE_FILE
+        cache = cls(path, **kwargs)
+        cache.entries.update(cls._read(path))
+        return cache
+
+    def save(self) -> None:
+        """ Merge the results into ``path`` (the newest result of each probe wins), under a lock """
+        if not self.path or not self.dirty:
+            return
+        try:
+            with locked(f"{self.path}.lock"):
+                merged = self._read(self.path)
+                for host, entries in self.entries.items():
+                    for key, entry in entries.items():
+                        if key not in merged.setdefault(host, {}) or merged[host][key][1] < entry[1]:
+                            merged[host][key] = entry
+                oldest = time.time() - max(CACHE_RETENTION, *self.max_age.values())
+                merged = {
+                    host: kept
+                    for host, entries in merged.items()
+                    if (kept := {key: entry for key, entry in entries.items() if entry[1] >= oldest})
+                }
+                write_json_atomic(self.path, merged)
+            self.dirty = False
+        except OSError as e:
+            self.log.warning(f"Unable to save the status cache to {self.path}: {e}")
+
+
 def add_color(text: str) -> str:
     if is_failed(text):
         return click.style(text, "red", bold=True)
@@ -89,32 +277,58 @@ class Host(object):
     Class to represent an host, wits its reachability status
     """
     name: str = attr.ib()
-    status_cache = defaultdict(dict)  # {host: {service: True/False}}
+    status_cache = StatusCache()  # {host: {service: True/False}}, see main for the persistent one
 
     def __attrs_post_init__(self):
         self._is_reachable = None
+        self.reachability: typing.Optional[Reachability] = None
+        """ RTT and loss of the probe, set by HostChecker for all the hosts at once (or probed when needed) """
         self.log = logging.getLogger(__name__)
 
     @property
     def is_reachable(self) -> bool:
+        """ Whether the host answers to ping (or on the ssh port): ssh itself is proved by the services probe """
         if self._is_reachable is None:
             try:
                 self._is_reachable = self.status_cache[self.name]["ping"]
             except KeyError:
-                self._is_reachable = False
-                try:
-                    check_output(["ping", "-c", "3", "-W", "1", self.name], universal_newlines=True)
-                    remote_command(ip_if_not_local(self.name), ["hostname"])
-                    self._is_reachable = True
-                except CalledProcessError as e:
-                    self.log.debug(f"Problem with {self}: {e}.\n{e.output}")
-                except Exception as e:
-                    self.log.debug(f"Problem with {self}: {e}.\n{vars(e)}")
+                if self.reachability is None:
+                    self.reachability = probe(self.name)
+                self.log.debug(f"{self.reachability}")
+                self._is_reachable = self.reachability.reachable
                 self.status_cache[self.name]["ping"] = self._is_reachable
         return self._is_reachable
 
+    def set_unreachable(self) -> None:
+        self._is_reachable = False
+        self.status_cache[self.name]["ping"] = False
+
+    def probe_services(self, services: typing.Iterable["Service"]) -> bool:
+        """
+        Fetch the state and check result of all the services expected on this host in a single session,
+        filling the status cache used by ``Service.is_active_on`` and ``Service.is_running_on``.
+        Returns False (and marks the host unreachable) if ssh could not connect
+        """
+        cached = self.status_cache[self.name]
+        todo = [
+            s for s in services if s.should_run_on(self) and (f"+{s.name}" not in cached or s.name not in cached)
+        ]
+        if not todo:
+            return True
+        try:
+            results = parse_probe_output(remote_command(ip_if_not_local(self.name), [probe_script(todo)]))
+        except CalledProcessError as e:
+            self.log.debug(f"Problem probing {self}: {e}.\n{e.output}")
+            if e.returncode == CONNECTION_ERROR:
+                self.set_unreachable()
+                return False
+            results = {}
+        for service in todo:
+            service.set_probe_result(self, results)
+        return True
+
     def check_active_services(self, services: list) -> typing.Optional[list]:
-        if services is None:
+        if services is None or not self.probe_services(services):
             return None
         result = []
         for service in services:
@@ -161,6 +375,7 @@ class Host(object):
                         ka_data[service_name][key] = value
         click.echo(ka_data)
 
+        self.probe_services(s for s in services if s.name in ka_data)
         legend = set()
         for service in services:
             self.log.debug(f"Check {service} on {self}")
@@ -181,10 +396,6 @@ class Host(object):
         return result
 
 
-class DecodeFirstLineException(Exception):
-    pass
-
-
 def decode_first_line(filename: str) -> dict:
     with open(filename, 'r') as f:
         try:
@@ -217,15 +428,21 @@ class Service(object):
       * should_run_on(host): if the host has highest priority in config
       * _status: dict of {'fqdn': ServiceStatus}
     """
-    def __init__(self, filename: str):
-        if os.path.exists(filename):
+    def __init__(self, filename: str, entry: typing.Optional[ServiceEntry] = None):
+        """ ``entry``, if given, is the already parsed config (see ``tools.libs.service_index``) """
+        self._check_script = None
+        self._service_dict = None
+        if entry is not None:
+            self._filename = entry.filename
+            self._name = entry.name
+            self._check_script = entry.check_script
+            self._service_dict = entry.config
+        elif os.path.exists(filename):
             self._filename = filename
             self._name = None
         else:
             self._name = filename
             self._filename = os.path.join(KA_DIR, f"{filename}.conf")
-        self._check_script = None
-        self._service_dict = None
         self._hosts = None
         self._status = defaultdict(ServiceStatus)
         self.log = logging.getLogger(__name__)
@@ -266,8 +483,7 @@ class Service(object):
             except KeyError:
                 try:
                     output = remote_command(ip_if_not_local(host.name), [f"cat '/tmp/{self.name}.state'"])
-                    state = output.split("-")[1].strip()
-                    self._status[host].active = state == "MASTER"
+                    self._status[host].active = is_master_state(output)
                 except CalledProcessError as e:
                     self.log.debug(f"{e}\n{e.stdout}")
                     self._status[host].active = False
@@ -295,34 +511,26 @@ class Service(object):
                 Host.status_cache[host.name][self.name] = self._status[host].available
         return self._status[host].available
 
+    def set_probe_result(
+        self, host: Host, results: typing.Dict[typing.Tuple[str, str], typing.Tuple[int, str]]
+    ) -> None:
+        """ Store what ``Host.probe_services`` found about this service (missing results count as failures) """
+        rc, output = results.get(("state", self.name), (1, ""))
+        try:
+            self._status[host].active = rc == 0 and is_master_state(output)
+        except IndexError:
+            self.log.debug(f"Unexpected state for {self.name} on {host.name}: {output}")
+            self._status[host].active = False
+        rc, _ = results.get(("check", self.name), (1, ""))
+        self._status[host].available = rc == 0
+        Host.status_cache[host.name][f"+{self.name}"] = self._status[host].active
+        Host.status_cache[host.name][self.name] = self._status[host].available
+
     def parse_config(self) -> dict:
-        with open(self.filename, 'r') as f:
-            self._name = re.sub(r'\.conf$', '', os.path.basename(self.filename))
-            self._check_script = os.path.join(KA_CHECKS_DIR, f"check_{self._name}.sh")
-            full_config = {}
-            first_line = f.readline()
-            try:
-                full_config = json.loads(first_line.lstrip('#').strip())
-                if "id" in full_config:
-                    full_config["ip"] = LOCAL_SUBNET_TEMPLATE.format(full_config["id"])
-            except json.decoder.JSONDecodeError as e:
-                raise DecodeFirstLineException(f'Error while decoding {self.filename} ("{first_line}")') from e
-            next_is_ip = False
-            # cl contains the line with "#" comments removed and no leading/trailing spaces
-            for line in [cl for ln in f if (cl := ln.split("#")[0].strip())]:
-                if next_is_ip:
-                    full_config["ip"] = line.split()[0].strip('"')
-                    next_is_ip = False
-                elif line.startswith("script "):
-                    self._check_script = line.split()[1].strip('"')
-                elif line.startswith("vrrp_instance "):
-                    self._name = line.split()[1].strip('"')
-                elif line.startswith("virtual_router_id "):
-                    full_config["id"] = line.split()[1].strip('"')
-                    self.log.debug(f"Found id={full_config['id']} from {line}")
-                elif line.startswith("virtual_ipaddress "):
-                    next_is_ip = True
-            return full_config
+        entry = parse_service(self.filename)
+        self._name = entry.name
+        self._check_script = entry.check_script
+        return entry.config
 
     def should_run_on(self, host: Host) -> bool:
         if self._status[host].expected is None:
@@ -373,12 +581,15 @@ class ValuesDisplay(object):
         return ", ".join(self.display(v) for v in self.values)
 
 
-def items_displayer(items: typing.Iterable):
+def items_displayer(items: typing.Iterable, age_of: typing.Callable[[str, str], typing.Optional[float]] = None):
+    """ ``age_of(key, value)``, if given, returns how old the cached result shown as ``value`` is """
     legend = set()
     for key, values in ((k, v) for (k, v) in sorted(items) if v):
         colored_values = list()
         for value in sorted(values or []):
-            colored_values.append(add_color(value))
+            age = age_of(key, value) if age_of else None
+            suffix = "" if age is None else click.style(f" (cached {format_age(age)})", dim=True)
+            colored_values.append(add_color(value) + suffix)
             if value[0] in STATES:
                 legend.add(add_color(f"{value[0]}{STATES[value[0]].__name__}"))
             else:
@@ -388,12 +599,18 @@ def items_displayer(items: typing.Iterable):
         yield f"Legend: {', '.join(sorted(legend))}"
 
 
-def show_services_by_host(active_services: dict) -> typing.Iterator[str]:
-    for line in items_displayer(active_services.items()):
+def _strip_state(name: str) -> str:
+    """ The service name without the state prefix added by ``active``, ``failed`` or ``usurper`` """
+    return name[1:] if name[:1] and name[:1] in STATES else name
+
+
+def show_services_by_host(active_services: dict, cache: StatusCache = None) -> typing.Iterator[str]:
+    age_of = (lambda host, service: cache.service_age(host, _strip_state(service))) if cache else None
+    for line in items_displayer(active_services.items(), age_of):
         yield line
 
 
-def show_services(active_services: dict) -> typing.Iterator[str]:
+def show_services(active_services: dict, cache: StatusCache = None) -> typing.Iterator[str]:
     services_dict = defaultdict(list)
     legend = set()
     for host, services in active_services.items():
@@ -410,7 +627,8 @@ def show_services(active_services: dict) -> typing.Iterator[str]:
             else:
                 services_dict[service].append(running(host))
                 legend.add(running("running"))
-    for line in items_displayer(services_dict.items()):
+    age_of = (lambda service, host: cache.service_age(_strip_state(host), service)) if cache else None
+    for line in items_displayer(services_dict.items(), age_of):
         yield line
 
 
@@ -442,12 +660,19 @@ class HostChecker(object):
 
     def __attrs_post_init__(self):
         self.log = logging.getLogger(__name__)
-        self.service_list = {Service(fname) for fname in glob(os.path.join(KA_DIR, "*.conf"))}
+        self.service_list = {Service(entry.filename, entry) for entry in load_services(KA_DIR)}
         if self.hostnames:
-            self.hosts = (Host(hostname) for hostname in self.hostnames)
+            self.hosts = tuple(Host(hostname) for hostname in self.hostnames)
         else:
             self.hosts = tuple(Host(hostname) for s in self.service_list for hostname in s.hosts)
             self.log.debug(f"Detected hosts: {', '.join(h.name for h in self.hosts)}")
+        # resolve them all in one parallel round, so the checks hit the resolver cache
+        resolver.resolve_many(h.name for h in self.hosts)
+        self.log.debug(f"Resolver stats: {resolver.stats}")
+        # and ping them all at once too (but those still in the status cache)
+        reachability = probe_many(h.name for h in self.hosts if "ping" not in Host.status_cache[h.name])
+        for host in self.hosts:
+            host.reachability = reachability.get(host.name)
 
     def check_host(self, host: Host):
         if host.is_reachable:
@@ -465,9 +690,27 @@ class HostChecker(object):
 @click.option("--by-service", "-s", default=False, is_flag=True)
 @click.option("--no-parallel", "-n", default=False, is_flag=True)
 @click.option("--query-daemon", "-D", default=False, is_flag=True, help="Root only")
+@click.option(
+    "--max-age",
+    type=float,
+    help=f"Use the results of earlier runs up to this many seconds old (default: {DEFAULT_MAX_AGE})",
+)
+@click.option("--refresh", "-r", default=False, is_flag=True, help="Probe everything again, ignoring earlier runs")
 @click.option("--verbose/--quiet", "-v/-q", default=None)
-def main(hostnames: set, no_parallel: bool, by_service: bool, query_daemon: bool, verbose: typing.Optional[bool]):
+def main(
+    hostnames: set,
+    no_parallel: bool,
+    by_service: bool,
+    query_daemon: bool,
+    max_age: typing.Optional[float],
+    refresh: bool,
+    verbose: typing.Optional[bool],
+):
     log = setup_logging(verbose)
+    Host.status_cache = StatusCache.load(
+        max_age=dict.fromkeys(DEFAULT_MAX_AGE, max_age) if max_age is not None else dict(DEFAULT_MAX_AGE),
+        refresh=refresh,
+    )
 
     log.debug(f"Starting with {hostnames}")
     try:
@@ -479,19 +722,24 @@ def main(hostnames: set, no_parallel: bool, by_service: bool, query_daemon: bool
         active_services = defaultdict(list)
         with click.progressbar(hc.hosts) as hosts:
             for host in hosts:
+                services = None
                 if host.is_reachable:
                     log.debug(f"{host} is reachable: checking {hc.service_list}")
-                    active_services[host.name].extend(host.check_active_services(hc.service_list))
+                    services = host.check_active_services(hc.service_list)
+                if services is not None:
+                    active_services[host.name].extend(services)
                 else:
                     active_services[host.name] = None
     else:
         log.debug(f"Checking {hc.hosts}")
         with ThreadPoolExecutor(min(50, len(hc.hosts))) as tpool:
             active_services = dict(tpool.map(hc.check_host, hc.hosts))
+    log.debug(f"Remote command cache stats: {_remote_command.stats}")
+    Host.status_cache.save()
     if by_service:
-        output_lines = show_services(active_services)
+        output_lines = show_services(active_services, Host.status_cache)
     else:
-        output_lines = show_services_by_host(active_services)
+        output_lines = show_services_by_host(active_services, Host.status_cache)
     log.debug(f"Unreachable: {', '.join(h for h, s in active_services.items() if s is None)}")
     for line in output_lines:
         click.echo(line)
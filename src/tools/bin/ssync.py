@@ -1,8 +1,11 @@
 #!/mnt/opt/nicola/tools/bin/python3
+import shlex
 import subprocess
 import sys
 
-from ..libs.stools_defaults import hosts_if_not_me, parse_args
+from ..libs.net_utils import hosts_if_not_me
+from ..libs.ssh_transport import get_transport
+from ..libs.stools_defaults import parse_args
 
 
 def main(argv: list = sys.argv[1:]):
@@ -11,18 +14,20 @@ def main(argv: list = sys.argv[1:]):
     for _host in hosts_if_not_me(args.hosts):
         for _fn in args.filenames:
             try:
-                result = subprocess.check_output(
-                    'ssh {0} "cat \'{1}\'" | {2} "{1}" - ; ' 'exit 0'.format(_host.hostname, _fn, args.diff),
+                remote_content = get_transport().check_output(_host.hostname, f"cat '{_fn}'", stderr=subprocess.PIPE)
+                result = subprocess.run(
+                    shlex.split(args.diff) + [_fn, '-'],
+                    input=remote_content,
+                    stdout=subprocess.PIPE,
                     stderr=subprocess.STDOUT,
-                    shell=True,
-                )
+                ).stdout
                 if result.decode():
                     args.log.info('Diff between local and {}:{}'.format(_host.hostname, _fn))
                     args.log.info(result.decode())
                 else:
                     args.log.info('{} is the same on {}'.format(_fn, _host.hostname))
             except subprocess.CalledProcessError as e:
-                args.log.error(e.output.decode())
+                args.log.error((e.stderr or e.output).decode())
                 args.log.debug('Exit code: {}'.format(e.returncode))
             except Exception as e:
                 args.log.error(e)
@@ -11,6 +11,7 @@ if os.path.abspath(os.path.dirname(os.path.dirname(__file__))) not in sys.path:
 from tools.libs.parse_args import LoggingArgumentParser
 from tools.libs.total_block_config import config
 from tools.libs.net_utils import ip_if_not_local
+from tools.libs.ssh_transport import get_transport
 
 APP_NAME = 'LockDown'
 
@@ -34,8 +35,9 @@ def user_if_not_me(user) -> typing.Optional[str]:
 
 def run(host_user, cmd, unsafe):
     user, host = host_user.split('@')
-    if ip_if_not_local(host):
-        full_cmd = ['ssh', host_user, cmd]
+    remote = ip_if_not_local(host)
+    if remote:
+        full_cmd = get_transport().ssh_args(host_user, cmd)
     elif user_if_not_me(user):
         full_cmd = ['sudo', '-u', user, cmd]
     else:
@@ -43,7 +45,10 @@ def run(host_user, cmd, unsafe):
     if unsafe:
         glue = '" "'
         log.debug(f'Running {glue.join(full_cmd)}')
-        subprocess.run(full_cmd)
+        if remote:
+            get_transport().run(host_user, cmd)
+        else:
+            subprocess.run(full_cmd)
     else:
         full_cmd = '" "'.join(full_cmd)
         log.info(f'"{cmd}" on {host} (as {user}): "{full_cmd}"')
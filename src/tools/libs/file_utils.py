@@ -0,0 +1,32 @@
+import contextlib
+import fcntl
+import json
+import os
+import tempfile
+import typing
+
+
+def write_json_atomic(path: str, data: typing.Any, **kwargs) -> None:
+    """ Dump ``data`` to a temporary file next to ``path``, then rename it: readers never see half a file """
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f'.{os.path.basename(path)}.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, **kwargs)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+@contextlib.contextmanager
+def locked(path: str) -> typing.Iterator[None]:
+    """ Hold an exclusive lock on ``path`` (created if missing), to serialize read-modify-write cycles """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
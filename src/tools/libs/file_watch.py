@@ -0,0 +1,123 @@
+"""
+Wait for a file to be rewritten: inotify (through ctypes, no extra dependency) on Linux,
+polling its mtime/size elsewhere.
+"""
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+import typing
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+# a rewritten file is closed after writing, a replaced one is moved (or created) in place
+DEFAULT_MASK = IN_CLOSE_WRITE | IN_MOVED_TO
+
+_EVENT = struct.Struct('iIII')
+_log = logging.getLogger(__name__)
+
+
+def _load_libc() -> typing.Optional[ctypes.CDLL]:
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+_libc = _load_libc()
+
+
+def _stat(path: str) -> typing.Optional[typing.Tuple[int, int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+class FileWatcher(object):
+    """
+    Wait until ``path`` changes. Its directory is watched, so the file may also be deleted and recreated.
+    Without inotify (or with ``poll=True``) the file is checked every ``poll_interval`` seconds
+    """
+
+    def __init__(self, path: str, mask: int = DEFAULT_MASK, poll_interval: float = 0.5, poll: bool = False):
+        self.path = os.path.abspath(path)
+        self.mask = mask
+        self.poll_interval = poll_interval
+        self._name = os.fsencode(os.path.basename(self.path))
+        self._fd: typing.Optional[int] = None
+        if _libc is not None and not poll:
+            self._fd = self._inotify(os.path.dirname(self.path))
+        self._last = _stat(self.path)
+
+    @property
+    def uses_inotify(self) -> bool:
+        return self._fd is not None
+
+    def _inotify(self, directory: str) -> typing.Optional[int]:
+        fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            _log.debug(f'inotify_init1 failed: {os.strerror(ctypes.get_errno())}, polling {self.path}')
+            return None
+        if _libc.inotify_add_watch(fd, os.fsencode(directory), self.mask) < 0:
+            _log.debug(f'Unable to watch {directory}: {os.strerror(ctypes.get_errno())}, polling {self.path}')
+            os.close(fd)
+            return None
+        return fd
+
+    def _read_events(self) -> bool:
+        """ Drain the pending events, returns True if one was about our file """
+        matched = False
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return matched
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = _EVENT.unpack_from(data, offset)
+                name = data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0')
+                offset += _EVENT.size + length
+                if name == self._name and mask & self.mask:
+                    matched = True
+
+    def wait(self, timeout: typing.Optional[float] = None) -> bool:
+        """ Block until the file changes (True) or ``timeout`` seconds pass (False) """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if self._fd is not None:
+                ready, _, _ = select.select([self._fd], [], [], remaining)
+                if ready and self._read_events():
+                    self._last = _stat(self.path)
+                    return True
+            else:
+                time.sleep(self.poll_interval if remaining is None else min(self.poll_interval, remaining))
+                current = _stat(self.path)
+                if current != self._last:
+                    self._last = current
+                    return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self) -> 'FileWatcher':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
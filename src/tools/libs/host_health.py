@@ -0,0 +1,101 @@
+"""
+Persistent per-host health records, so fleet tools can skip hosts known to be down
+instead of waiting for the connection timeout every time.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+import typing
+
+import attr
+
+from .file_utils import write_json_atomic
+from .net_utils import CACHE_DIR
+
+HEALTH_FILE = os.path.join(CACHE_DIR, 'host_health.json')
+BASE_BACKOFF = 60.0
+MAX_BACKOFF = 3600.0
+SSH_PORT = 22
+
+
+@attr.s
+class HostHealth(object):
+    last_success: typing.Optional[float] = attr.ib(default=None)
+    consecutive_failures: int = attr.ib(default=0)
+    down_since: typing.Optional[float] = attr.ib(default=None)
+    """ Time of the first failure of the current streak """
+    backoff_until: typing.Optional[float] = attr.ib(default=None)
+
+
+@attr.s
+class HealthStore(object):
+    """
+    Health of each host, loaded from and saved to ``path``: after a failure a host is in backoff
+    for ``base_backoff`` seconds, doubling on each consecutive failure up to ``max_backoff``
+    """
+    path: str = attr.ib(default=HEALTH_FILE)
+    base_backoff: float = attr.ib(default=BASE_BACKOFF)
+    max_backoff: float = attr.ib(default=MAX_BACKOFF)
+    hosts: typing.Dict[str, HostHealth] = attr.ib(factory=dict)
+
+    def __attrs_post_init__(self) -> None:
+        self.log = logging.getLogger(__name__)
+
+    @classmethod
+    def load(cls, path: str = None, **kwargs) -> 'HealthStore':
+        path = path or HEALTH_FILE
+        store = cls(path, **kwargs)
+        try:
+            with open(path, 'r') as f:
+                store.hosts = {host: HostHealth(**record) for host, record in json.load(f).items()}
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError) as e:
+            store.log.warning(f'Ignoring unreadable host health file {path}: {e}')
+        return store
+
+    def save(self) -> None:
+        try:
+            write_json_atomic(self.path, {host: attr.asdict(record) for host, record in self.hosts.items()})
+        except OSError as e:
+            self.log.warning(f'Unable to save host health to {self.path}: {e}')
+
+    def get(self, host: str) -> HostHealth:
+        return self.hosts.setdefault(host, HostHealth())
+
+    def in_backoff(self, host: str, now: float = None) -> bool:
+        record = self.hosts.get(host)
+        return bool(record and record.backoff_until and record.backoff_until > (now or time.time()))
+
+    def record(self, host: str, ok: bool, now: float = None) -> HostHealth:
+        now = now or time.time()
+        record = self.get(host)
+        if ok:
+            record.last_success = now
+            record.consecutive_failures = 0
+            record.down_since = None
+            record.backoff_until = None
+        else:
+            record.consecutive_failures += 1
+            if record.down_since is None:
+                record.down_since = now
+            backoff = min(self.base_backoff * 2 ** (record.consecutive_failures - 1), self.max_backoff)
+            record.backoff_until = now + backoff
+            self.log.debug(f'{host} failed {record.consecutive_failures} times in a row, backing off {backoff:g}s')
+        return record
+
+
+async def probe(host: str, port: int = SSH_PORT, timeout: float = 1.0) -> bool:
+    """ Whether a TCP connection to ``host``:``port`` succeeds within ``timeout`` seconds """
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return True
@@ -0,0 +1,121 @@
+"""
+Memoization for slow calls (remote commands, lookups) from many threads: results expire after ``ttl`` seconds,
+the cache is bounded (least recently used entries go first), some exceptions are cached too (for a shorter time)
+and concurrent calls with the same arguments wait for the one in flight instead of repeating it.
+"""
+import functools
+import logging
+import threading
+import time
+import typing
+from collections import OrderedDict
+from concurrent.futures import Future
+
+_log = logging.getLogger(__name__)
+
+
+class TTLCache(object):
+    """ Wraps ``func``: see ``ttl_cache`` """
+
+    def __init__(
+        self,
+        func: typing.Callable,
+        ttl: float,
+        error_ttl: float,
+        maxsize: int,
+        errors: typing.Tuple[typing.Type[BaseException], ...],
+    ):
+        self.func = func
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.maxsize = maxsize
+        self.errors = errors
+        self._lock = threading.Lock()
+        # key -> (expiry, result or the exception it raised)
+        self._cache: typing.OrderedDict[typing.Hashable, typing.Tuple[float, typing.Any]] = OrderedDict()
+        self._inflight: typing.Dict[typing.Hashable, Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        """ Calls which waited for the same call in flight in another thread """
+        functools.update_wrapper(self, func)
+
+    @staticmethod
+    def _key(args: tuple, kwargs: dict) -> typing.Hashable:
+        return args + tuple(sorted(kwargs.items())) if kwargs else args
+
+    def _store(self, key: typing.Hashable, outcome: typing.Any, ttl: float) -> None:
+        self._cache[key] = (time.monotonic() + ttl, outcome)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    @staticmethod
+    def _result(outcome: typing.Any) -> typing.Any:
+        if isinstance(outcome, BaseException):
+            # don't pile up the tracebacks of each time it is raised again
+            raise outcome.with_traceback(None)
+        return outcome
+
+    def __call__(self, *args, **kwargs) -> typing.Any:
+        key = self._key(args, kwargs)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self._result(entry[1])
+            future = self._inflight.get(key)
+            leader = future is None
+            if future is None:
+                self.misses += 1
+                future = self._inflight[key] = Future()
+            else:
+                self.waits += 1
+        if not leader:
+            return future.result()
+        try:
+            outcome = self.func(*args, **kwargs)
+        except BaseException as e:
+            with self._lock:
+                if isinstance(e, self.errors):
+                    _log.debug(f'Caching {e!r} for {args} for {self.error_ttl:g}s')
+                    self._store(key, e, self.error_ttl)
+                del self._inflight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._store(key, outcome, self.ttl)
+            del self._inflight[key]
+        future.set_result(outcome)
+        return outcome
+
+    @property
+    def stats(self) -> typing.Dict[str, int]:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'waits': self.waits,
+            'in_flight': len(self._inflight),
+            'entries': len(self._cache),
+        }
+
+    def cache_clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+            self.hits = self.misses = self.waits = 0
+
+
+def ttl_cache(
+    ttl: float = 60.0,
+    error_ttl: float = 5.0,
+    maxsize: int = 256,
+    errors: typing.Tuple[typing.Type[BaseException], ...] = (),
+) -> typing.Callable[[typing.Callable], TTLCache]:
+    """
+    Decorator memoizing a function for ``ttl`` seconds (the exceptions in ``errors`` for ``error_ttl``),
+    keeping at most ``maxsize`` results; the arguments must be hashable
+    """
+    def decorator(func: typing.Callable) -> TTLCache:
+        return TTLCache(func, ttl, error_ttl, maxsize, errors)
+    return decorator
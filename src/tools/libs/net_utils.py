@@ -1,19 +1,34 @@
+import ipaddress
+import json
 import logging
+import os
 import socket
+import threading
+import time
 import typing
-from functools import lru_cache
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import attr
 try:
+    import dns.exception
     import dns.query
     import dns.rdataclass
     import dns.rdatatype
     import dns.resolver
+    import dns.xfr
     import dns.zone
 except ModuleNotFoundError:
     dns = None
+try:
+    import netifaces
+except ModuleNotFoundError:
+    netifaces = None
+
+from .file_utils import write_json_atomic
 
 APP_NAME = 'canepan.tools'
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', APP_NAME)
 _log = logging.getLogger(APP_NAME)
 
 
@@ -23,28 +38,159 @@ class Host(object):
     ip = attr.ib(type=str)
 
 
-@lru_cache(maxsize=5)
+@attr.s
+class Resolver(object):
+    """
+    ``socket.gethostbyname`` with a bounded cache of answers (``ttl`` seconds) and failures (``negative_ttl``),
+    resolving many names at once in a thread pool.
+    The system resolver (which honours /etc/hosts and the search domains) doesn't expose record TTLs
+    """
+    ttl: float = attr.ib(default=300.0)
+    negative_ttl: float = attr.ib(default=30.0)
+    max_entries: int = attr.ib(default=1024)
+    max_workers: int = attr.ib(default=16)
+
+    def __attrs_post_init__(self) -> None:
+        self._lock = threading.Lock()
+        # name -> (expiry, address or the error it raised)
+        self._cache: typing.OrderedDict[str, typing.Tuple[float, typing.Union[str, OSError]]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _cached(self, name: str) -> typing.Union[str, OSError, None]:
+        with self._lock:
+            entry = self._cache.get(name)
+            if entry is None or entry[0] <= time.monotonic():
+                self.misses += 1
+                return None
+            self._cache.move_to_end(name)
+            self.hits += 1
+            return entry[1]
+
+    def _store(self, name: str, answer: typing.Union[str, OSError]) -> None:
+        ttl = self.negative_ttl if isinstance(answer, OSError) else self.ttl
+        with self._lock:
+            self._cache[name] = (time.monotonic() + ttl, answer)
+            self._cache.move_to_end(name)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def _resolve_uncached(self, name: str) -> typing.Union[str, OSError]:
+        _log.debug(f'Resolving {name}')
+        try:
+            answer: typing.Union[str, OSError] = socket.gethostbyname(name)
+        except socket.gaierror as e:
+            answer = e
+        self._store(name, answer)
+        return answer
+
+    def resolve(self, name: str) -> str:
+        """ The IPv4 address of ``name``; raises ``socket.gaierror`` (possibly a cached one) when it doesn't resolve """
+        answer = self._cached(name)
+        if answer is None:
+            answer = self._resolve_uncached(name)
+        if isinstance(answer, OSError):
+            raise answer
+        return answer
+
+    def resolve_many(self, names: typing.Iterable[str]) -> typing.Dict[str, typing.Union[str, OSError]]:
+        """ Address (or resolution error) of each of ``names``, looking up the ones not in cache in parallel """
+        names = list(dict.fromkeys(names))
+        answers = {name: self._cached(name) for name in names}
+        missing = [name for name, answer in answers.items() if answer is None]
+        if len(missing) > 1:
+            with ThreadPoolExecutor(min(self.max_workers, len(missing))) as pool:
+                answers.update(zip(missing, pool.map(self._resolve_uncached, missing)))
+        elif missing:
+            answers[missing[0]] = self._resolve_uncached(missing[0])
+        return typing.cast(typing.Dict[str, typing.Union[str, OSError]], answers)
+
+    @property
+    def stats(self) -> typing.Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._cache)}
+
+    def cache_clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+            self.hits = self.misses = 0
+
+
+resolver = Resolver()
+
+
 def gethostbyname(hn: str) -> str:
-    return socket.gethostbyname(hn)
+    return resolver.resolve(hn)
+
+
+@attr.s
+class LocalAddresses(object):
+    """
+    All the IPv4/IPv6 addresses of this host's interfaces (secondary ones and VIPs included), re-read when
+    the list of interfaces changes or after ``ttl`` seconds
+    """
+    ttl: float = attr.ib(default=10.0)
+
+    def __attrs_post_init__(self) -> None:
+        self._lock = threading.Lock()
+        self._addresses: typing.FrozenSet[str] = frozenset()
+        self._interfaces: typing.Optional[typing.List[typing.Tuple[int, str]]] = None
+        self._expires = 0.0
+
+    @staticmethod
+    def _read() -> typing.FrozenSet[str]:
+        addresses = set()
+        for interface in netifaces.interfaces():
+            for family in (netifaces.AF_INET, netifaces.AF_INET6):
+                for address in netifaces.ifaddresses(interface).get(family, []):
+                    # link-local IPv6 addresses come with their scope (fe80::1%eth0)
+                    addresses.add(address['addr'].split('%')[0])
+        return frozenset(addresses)
+
+    @property
+    def addresses(self) -> typing.FrozenSet[str]:
+        # cheaper than reading the addresses: one netlink/ioctl call
+        interfaces = socket.if_nameindex()
+        with self._lock:
+            if interfaces != self._interfaces or self._expires <= time.monotonic():
+                self._addresses = self._read()
+                self._interfaces = interfaces
+                self._expires = time.monotonic() + self.ttl
+                _log.debug(f'Local addresses: {", ".join(sorted(self._addresses))}')
+            return self._addresses
+
+    def is_local(self, ip: str) -> bool:
+        try:
+            if ipaddress.ip_address(ip).is_loopback:
+                return True
+        except ValueError:
+            return False
+        return ip in self.addresses
+
+
+local_addresses = LocalAddresses()
 
 
 def ip_if_not_local(host: str) -> typing.Optional[str]:
-    """ return the resolved IP if it's not the local IP """
-    _ip = gethostbyname(host)
+    """ return the resolved IP if it's not one of the local IPs """
+    _ip = resolver.resolve(host)
     my_host = socket.gethostname()
-    if my_host != host and _ip != gethostbyname(my_host):
-        return _ip
+    if my_host == host:
+        return None
+    if netifaces is None:
+        return _ip if _ip != resolver.resolve(my_host) else None
+    return None if local_addresses.is_local(_ip) else _ip
 
 
-def hosts_if_not_me(hosts: list) -> typing.List[Host]:
+def hosts_if_not_me(hosts: list) -> typing.Iterator[Host]:
+    """ The hosts other than this one, resolved in parallel """
     _myhn = socket.gethostname()
-    _log.debug('Resolving {}'.format(_myhn))
-    for _hn in [oh for oh in hosts if oh != _myhn]:
-        _log.debug('Resolving {}'.format(_hn))
-        try:
-            yield Host(_hn, gethostbyname(_hn))
-        except socket.gaierror as e:
-            _log.error(f'Error resolving {_hn}: {e}')
+    others = [oh for oh in hosts if oh != _myhn]
+    answers = resolver.resolve_many(others)
+    for _hn in others:
+        if isinstance(answers[_hn], OSError):
+            _log.error(f'Error resolving {_hn}: {answers[_hn]}')
+        else:
+            yield Host(_hn, typing.cast(str, answers[_hn]))
 
 
 HOSTS = {
@@ -53,19 +199,109 @@ HOSTS = {
 }
 
 
-def hosts_from_dns(dns_zone: typing.Optional[str], log: logging.Logger) -> dict:
+@attr.s
+class Inventory(object):
+    """ The hosts of a DNS zone indexed by the strings in their TXT records, as of the zone's SOA ``serial`` """
+    zone: str = attr.ib()
+    serial: int = attr.ib()
+    zone_text: str = attr.ib(repr=False)
+    tags: typing.Dict[str, typing.Set[str]] = attr.ib(factory=dict)
+
+    @classmethod
+    def from_zone(cls, dns_zone: str, zone) -> 'Inventory':
+        tags: typing.Dict[str, typing.Set[str]] = {}
+        serial = 0
+        for record_name, dns_record in zone.items():
+            soa_rdata = dns_record.get_rdataset(dns.rdataclass.IN, dns.rdatatype.SOA)
+            if soa_rdata:
+                serial = soa_rdata[0].serial
+            txt_rdata = dns_record.get_rdataset(dns.rdataclass.IN, dns.rdatatype.TXT)
+            if txt_rdata:
+                for record_text in [s.decode('utf-8').lower() for t in txt_rdata for s in t.strings]:
+                    tags.setdefault(record_text, set()).add(record_name.to_text().lower())
+        return cls(dns_zone, serial, zone.to_text(), tags)
+
+    def to_zone(self):
+        return dns.zone.from_text(self.zone_text, origin=self.zone, relativize=True)
+
+    def hosts(self, *tags: str) -> typing.Set[str]:
+        """ Hosts with any of ``tags`` """
+        return set().union(*(self.tags.get(tag.lower(), set()) for tag in tags))
+
+    @classmethod
+    def load(cls, path: str) -> typing.Optional['Inventory']:
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            return cls(data['zone'], data['serial'], data['zone_text'], {k: set(v) for k, v in data['tags'].items()})
+        except (OSError, ValueError, KeyError) as e:
+            _log.debug(f'No usable inventory in {path}: {e}')
+            return None
+
+    def save(self, path: str) -> None:
+        data = {
+            'zone': self.zone,
+            'serial': self.serial,
+            'zone_text': self.zone_text,
+            'tags': {k: sorted(v) for k, v in self.tags.items()},
+        }
+        write_json_atomic(path, data)
+
+
+def inventory_path(dns_zone: str, cache_dir: str = CACHE_DIR) -> str:
+    return os.path.join(cache_dir, f'inventory-{dns_zone.strip(".")}.json')
+
+
+def load_inventory(dns_zone: str, log: logging.Logger, cache_dir: typing.Optional[str] = CACHE_DIR) -> Inventory:
+    """
+    Inventory of ``dns_zone``, from the cache in ``cache_dir`` while the SOA serial is unchanged.
+    When the serial moved, the cached zone is brought up to date with IXFR (the server may answer with a full
+    transfer); without a cache, the whole zone is transferred
+    """
+    path = inventory_path(dns_zone, cache_dir) if cache_dir else None
+    cached = Inventory.load(path) if path else None
+    try:
+        soa = dns.resolver.resolve(dns_zone, 'SOA')[0]
+    except dns.exception.DNSException as e:
+        if cached is None:
+            raise
+        log.warning(f'Unable to get the SOA of {dns_zone} ({e}), using the cached inventory (serial {cached.serial})')
+        return cached
+    if cached is not None and cached.serial == soa.serial:
+        log.debug(f'Inventory of {dns_zone} is current (serial {soa.serial})')
+        return cached
+    master = dns.resolver.resolve(soa.mname, 'A')[0].address
+    zone = None
+    if cached is not None:
+        log.debug(f'Updating the inventory of {dns_zone} from serial {cached.serial} to {soa.serial} with IXFR')
+        try:
+            zone = cached.to_zone()
+            query, _ = dns.xfr.make_query(zone, serial=cached.serial)
+            dns.query.inbound_xfr(master, zone, query)
+        except dns.exception.DNSException as e:
+            log.info(f'IXFR of {dns_zone} failed ({e}), transferring the whole zone')
+            zone = None
+    if zone is None:
+        zone = dns.zone.Zone(dns_zone)
+        query, _ = dns.xfr.make_query(zone, serial=None)
+        dns.query.inbound_xfr(master, zone, query)
+    inventory = Inventory.from_zone(dns_zone, zone)
+    if path:
+        try:
+            inventory.save(path)
+        except OSError as e:
+            log.warning(f'Unable to cache the inventory in {path}: {e}')
+    return inventory
+
+
+def hosts_from_dns(
+    dns_zone: typing.Optional[str], log: logging.Logger, cache_dir: typing.Optional[str] = CACHE_DIR
+) -> dict:
+    """ Hosts by TXT tag (always including ``linux`` and ``mac``), falling back to ``HOSTS`` without a zone """
     if dns_zone:
         try:
-            soa_answer = dns.resolver.resolve(dns_zone, 'SOA')
-            full_zone = dns.zone.from_xfr(
-                dns.query.xfr(dns.resolver.resolve(soa_answer[0].mname, 'A')[0].address, dns_zone))
-            all_hosts = {'linux': set(), 'mac': set()}
-            for record_name, dns_record in full_zone.items():
-                txt_rdata = dns_record.get_rdataset(dns.rdataclass.IN, dns.rdatatype.TXT)
-                if txt_rdata:
-                    for record_text in [s.decode('utf-8').lower() for t in txt_rdata for s in t.strings]:
-                        if record_text in all_hosts.keys():
-                            all_hosts[record_text].add(record_name.to_text().lower())
+            all_hosts: typing.Dict[str, typing.Set[str]] = {'linux': set(), 'mac': set()}
+            all_hosts.update(load_inventory(dns_zone, log, cache_dir).tags)
             return all_hosts
         except AttributeError:
             log.info('Using hardcoded hosts as requested')
@@ -0,0 +1,98 @@
+"""
+Is a host up? A single ICMP echo (through ``ping3``) by default, or up to ``count`` stopping at the first reply,
+falling back to a TCP connection to the ssh port where ICMP is not allowed or not answered.
+"""
+import logging
+import socket
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+import attr
+
+try:
+    import ping3
+except ImportError:  # pragma: no cover - ping3 is a declared dependency
+    ping3 = None
+
+SSH_PORT = 22
+_log = logging.getLogger(__name__)
+
+
+@attr.s
+class Reachability(object):
+    host: str = attr.ib()
+    rtt: typing.Optional[float] = attr.ib(default=None)
+    """ Seconds to the first reply, None if there was none """
+    sent: int = attr.ib(default=0)
+    lost: int = attr.ib(default=0)
+    method: str = attr.ib(default='icmp')
+    """ 'icmp' or 'tcp' """
+
+    @property
+    def reachable(self) -> bool:
+        return self.rtt is not None
+
+    @property
+    def loss(self) -> float:
+        """ Fraction of the probes without a reply """
+        return self.lost / self.sent if self.sent else 0.0
+
+    def __str__(self) -> str:
+        if not self.reachable:
+            return f'{self.host}: unreachable ({self.method}, {self.sent} sent)'
+        return f'{self.host}: {self.rtt * 1000:.1f}ms ({self.method}, {self.loss:.0%} loss)'
+
+
+def icmp_probe(host: str, count: int = 1, timeout: float = 1.0) -> typing.Optional[Reachability]:
+    """ Up to ``count`` echo requests, stopping at the first reply; None if ICMP cannot be used here """
+    if ping3 is None:
+        return None
+    result = Reachability(host)
+    for _ in range(count):
+        result.sent += 1
+        try:
+            rtt = ping3.ping(host, timeout=timeout)
+        except OSError as e:
+            _log.debug(f'Unable to ping {host}: {e}')
+            return None
+        if rtt is False:
+            # ping3 reports errors (no permission for ICMP sockets, unknown host...) as False
+            return None
+        if rtt is not None:
+            result.rtt = rtt
+            return result
+        result.lost += 1
+    return result
+
+
+def tcp_probe(host: str, port: int = SSH_PORT, timeout: float = 1.0) -> Reachability:
+    """ Time to connect to ``host``:``port`` """
+    result = Reachability(host, sent=1, method='tcp')
+    start = time.monotonic()
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            result.rtt = time.monotonic() - start
+    except OSError as e:
+        _log.debug(f'Unable to connect to {host}:{port}: {e}')
+        result.lost = 1
+    return result
+
+
+def probe(host: str, count: int = 1, timeout: float = 1.0, port: int = SSH_PORT) -> Reachability:
+    """ ICMP first, then the TCP ``port`` if ICMP is not available or got no reply (it may be filtered) """
+    result = icmp_probe(host, count, timeout)
+    if result is None or not result.reachable:
+        result = tcp_probe(host, port, timeout)
+    return result
+
+
+def probe_many(
+    hosts: typing.Iterable[str], count: int = 1, timeout: float = 1.0, port: int = SSH_PORT, max_workers: int = 32
+) -> typing.Dict[str, Reachability]:
+    """ ``probe`` all the ``hosts`` concurrently """
+    names = list(dict.fromkeys(hosts))
+    if not names:
+        return {}
+    with ThreadPoolExecutor(min(max_workers, len(names))) as pool:
+        return dict(zip(names, pool.map(lambda host: probe(host, count, timeout, port), names)))
@@ -0,0 +1,184 @@
+"""
+The keepalived services configured in /etc/keepalived/keepalived.d (one ``*.conf`` per VRRP instance, starting
+with a JSON header like ``# {"vrrp": ["host1", "host2"], "id": 69}``), parsed once into an index cached under
+``~/.cache/canepan.tools``: next runs only stat the files and re-parse the ones whose mtime or size changed.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import stat
+import typing
+
+import attr
+
+from .file_utils import write_json_atomic
+from .net_utils import CACHE_DIR
+
+KA_CONFIG_DIR = '/etc/keepalived'
+KA_DIR = os.path.join(KA_CONFIG_DIR, 'keepalived.d')
+KA_CHECKS_DIR = os.path.join(KA_CONFIG_DIR, 'bin')
+LOCAL_SUBNET_TEMPLATE = '192.168.19.{}/24'
+INDEX_DIR = os.path.join(CACHE_DIR, 'service_index')
+INDEX_VERSION = 1
+
+_log = logging.getLogger(__name__)
+
+
+class DecodeFirstLineException(Exception):
+    pass
+
+
+@attr.s
+class ServiceEntry(object):
+    filename: str = attr.ib()
+    name: str = attr.ib()
+    check_script: str = attr.ib()
+    config: dict = attr.ib(factory=dict)
+    """ The JSON header, plus the "id" (VRID) and "ip" (VIP) found in the config """
+
+    @property
+    def vrid(self) -> typing.Optional[str]:
+        return self.config.get('id')
+
+    @property
+    def ip(self) -> typing.Optional[str]:
+        return self.config.get('ip')
+
+    @property
+    def hosts(self) -> typing.List[str]:
+        return self.config.get('vrrp', [])
+
+
+def parse_service(filename: str) -> ServiceEntry:
+    """ Read a keepalived config file; raises DecodeFirstLineException if its first line is not a JSON header """
+    with open(filename, 'r') as f:
+        name = re.sub(r'\.conf$', '', os.path.basename(filename))
+        check_script = os.path.join(KA_CHECKS_DIR, f'check_{name}.sh')
+        first_line = f.readline()
+        try:
+            config = json.loads(first_line.lstrip('#').strip())
+            if 'id' in config:
+                config['ip'] = LOCAL_SUBNET_TEMPLATE.format(config['id'])
+        except json.decoder.JSONDecodeError as e:
+            raise DecodeFirstLineException(f'Error while decoding {filename} ("{first_line}")') from e
+        next_is_ip = False
+        # cl contains the line with "#" comments removed and no leading/trailing spaces
+        for line in [cl for ln in f if (cl := ln.split('#')[0].strip())]:
+            if next_is_ip:
+                config['ip'] = line.split()[0].strip('"')
+                next_is_ip = False
+            elif line.startswith('script '):
+                check_script = line.split()[1].strip('"')
+            elif line.startswith('vrrp_instance '):
+                name = line.split()[1].strip('"')
+            elif line.startswith('virtual_router_id '):
+                config['id'] = line.split()[1].strip('"')
+                _log.debug(f'Found id={config["id"]} from {line}')
+            elif line.startswith('virtual_ipaddress '):
+                next_is_ip = True
+    return ServiceEntry(filename, name, check_script, config)
+
+
+def scan(config_dir: str) -> typing.Dict[str, typing.List[int]]:
+    """ [mtime_ns, size] of each ``*.conf`` file in ``config_dir`` (empty if it doesn't exist) """
+    manifest = {}
+    try:
+        with os.scandir(config_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') or not entry.name.endswith('.conf'):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    manifest[entry.path] = [st.st_mtime_ns, st.st_size]
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    return manifest
+
+
+def index_path(config_dir: str) -> str:
+    digest = hashlib.sha1(os.path.abspath(config_dir).encode()).hexdigest()[:12]
+    return os.path.join(INDEX_DIR, f'{digest}.json')
+
+
+@attr.s
+class ServiceIndex(object):
+    """ The services in ``config_dir``, with the ``manifest`` of the files they were parsed from """
+    config_dir: str = attr.ib(default=KA_DIR)
+    path: typing.Optional[str] = attr.ib(default=None)
+    manifest: typing.Dict[str, typing.List[int]] = attr.ib(factory=dict)
+    services: typing.Dict[str, ServiceEntry] = attr.ib(factory=dict)
+    errors: typing.Dict[str, str] = attr.ib(factory=dict)
+    """ Files which could not be parsed (they are retried when they change) """
+
+    def __attrs_post_init__(self) -> None:
+        self.log = logging.getLogger(__name__)
+        if self.path is None:
+            self.path = index_path(self.config_dir)
+
+    @classmethod
+    def load(cls, config_dir: str = KA_DIR, path: str = None) -> 'ServiceIndex':
+        index = cls(config_dir, path)
+        try:
+            with open(index.path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == INDEX_VERSION:
+                index.manifest = data['manifest']
+                index.services = {fname: ServiceEntry(**entry) for fname, entry in data['services'].items()}
+                index.errors = data['errors']
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError, KeyError, AttributeError) as e:
+            index.log.warning(f'Rebuilding the unreadable service index {index.path}: {e}')
+            index.manifest, index.services, index.errors = {}, {}, {}
+        return index
+
+    def save(self) -> None:
+        data = {
+            'version': INDEX_VERSION,
+            'config_dir': self.config_dir,
+            'manifest': self.manifest,
+            'services': {fname: attr.asdict(entry) for fname, entry in self.services.items()},
+            'errors': self.errors,
+        }
+        try:
+            write_json_atomic(typing.cast(str, self.path), data)
+        except OSError as e:
+            self.log.warning(f'Unable to save the service index to {self.path}: {e}')
+
+    def update(self) -> bool:
+        """ Re-parse the files changed since the index was built, returns whether anything changed """
+        current = scan(self.config_dir)
+        if current == self.manifest:
+            return False
+        for fname in set(self.manifest) - set(current):
+            self.services.pop(fname, None)
+            self.errors.pop(fname, None)
+        for fname, signature in current.items():
+            if self.manifest.get(fname) == signature:
+                continue
+            self.services.pop(fname, None)
+            self.errors.pop(fname, None)
+            try:
+                self.services[fname] = parse_service(fname)
+            except (OSError, UnicodeDecodeError, DecodeFirstLineException) as e:
+                self.log.warning(f'Skipping {fname}: {e}')
+                self.errors[fname] = str(e)
+        self.log.debug(f'Service index of {self.config_dir} updated: {len(self.services)} services')
+        self.manifest = current
+        self.save()
+        return True
+
+    def entries(self) -> typing.List[ServiceEntry]:
+        return [self.services[fname] for fname in sorted(self.services)]
+
+
+def load_services(config_dir: str = KA_DIR, path: str = None) -> typing.List[ServiceEntry]:
+    """ The services configured in ``config_dir`` (sorted by file name), through the index at ``path`` """
+    index = ServiceIndex.load(config_dir, path)
+    index.update()
+    return index.entries()
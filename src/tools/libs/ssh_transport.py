@@ -0,0 +1,286 @@
+"""
+Shared ``ssh`` transport, multiplexing every command over a per-host master connection.
+
+The first command to a host starts an OpenSSH master (``ControlMaster=auto``) that stays
+around for ``persist`` idle seconds (``ControlPersist``): later commands to the same host
+reuse its socket and cost a single round trip instead of a full TCP + key exchange.
+"""
+import asyncio
+import logging
+import os
+import re
+import subprocess
+import socket
+import threading
+import time
+import typing
+import weakref
+
+import attr
+
+CONTROL_DIR = os.path.join(os.path.expanduser('~'), '.ssh', 'cm')
+# ssh exits with 255 when the connection (not the remote command) failed
+CONNECTION_ERROR = 255
+# what ssh prints when the master connection could not open a session: the command was never sent
+MUX_ERROR = re.compile(
+    rb'^(mux_client_hello_exchange|mux_client_request_session|master hello exchange failed|control socket connect)',
+    re.M | re.I,
+)
+
+# written to stderr by the remote shell before the command, to tell when the session was established
+SESSION_MARKER = b'\x1e'
+# what ``ssh -O check`` prints when there is no master connection yet
+NO_MASTER = b'No such file or directory'
+
+TCommand = typing.Union[str, typing.Sequence[str], None]
+
+
+@attr.s
+class Timings(object):
+    """ Seconds from ``start`` to the end of each phase of a remote command (None if it was not reached) """
+    PHASES = ('resolution', 'connect', 'first_byte', 'completion')
+
+    start: float = attr.ib(factory=time.monotonic)
+    resolution: typing.Optional[float] = attr.ib(default=None)
+    connect: typing.Optional[float] = attr.ib(default=None)
+    first_byte: typing.Optional[float] = attr.ib(default=None)
+    completion: typing.Optional[float] = attr.ib(default=None)
+
+    def mark(self, phase: str, overwrite: bool = False) -> None:
+        """ Record the end of ``phase`` now; only the first time, unless ``overwrite`` """
+        if overwrite or getattr(self, phase) is None:
+            setattr(self, phase, time.monotonic() - self.start)
+
+    def to_dict(self) -> typing.Dict[str, typing.Optional[float]]:
+        return {phase: getattr(self, phase) for phase in self.PHASES}
+
+
+@attr.s
+class SSHTransport(object):
+    control_dir: str = attr.ib(default=CONTROL_DIR)
+    persist: int = attr.ib(default=60)
+    """ Seconds an idle master connection is kept alive """
+    max_sessions: int = attr.ib(default=8)
+    """ Concurrent sessions per host (sshd's MaxSessions defaults to 10) """
+    connect_timeout: int = attr.ib(default=5)
+    retries: int = attr.ib(default=1)
+    """ How many times a command is retried after dropping a stale master (see ``mux_failed``) """
+    multiplex: bool = attr.ib(default=True)
+
+    def __attrs_post_init__(self) -> None:
+        self.log = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._slots: typing.Dict[str, threading.BoundedSemaphore] = {}
+        # asyncio semaphores belong to the loop they were first used in
+        self._async_slots: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self._control_dir_ready = False
+
+    @property
+    def control_path(self) -> str:
+        # %C is a hash of local host, remote host, port and user: short enough for a unix socket
+        return os.path.join(self.control_dir, '%C')
+
+    def _ensure_control_dir(self) -> bool:
+        if not self._control_dir_ready:
+            try:
+                os.makedirs(self.control_dir, mode=0o700, exist_ok=True)
+                self._control_dir_ready = True
+            except OSError as e:
+                self.log.debug(f'Unable to create {self.control_dir}, not multiplexing: {e}')
+                self.multiplex = False
+        return self.multiplex
+
+    def _control_args(self) -> typing.List[str]:
+        if self.multiplex and self._ensure_control_dir():
+            return [
+                '-o', 'ControlMaster=auto',
+                '-o', f'ControlPath={self.control_path}',
+                '-o', f'ControlPersist={self.persist}',
+            ]
+        return []
+
+    def ssh_args(self, host: str, command: TCommand = None, extra_args: typing.Sequence[str] = ()) -> typing.List[str]:
+        """
+        Build the ``ssh`` command line for ``host``.
+        ``extra_args`` come first, so they override the transport defaults (ssh keeps the first value it sees)
+        """
+        args = ['ssh'] + list(extra_args) + self._control_args() + ['-o', f'ConnectTimeout={self.connect_timeout}']
+        args.append(host)
+        if isinstance(command, str):
+            args.append(command)
+        elif command:
+            args.extend(command)
+        return args
+
+    def _slot(self, host: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            if host not in self._slots:
+                self._slots[host] = threading.BoundedSemaphore(self.max_sessions)
+            return self._slots[host]
+
+    def _async_slot(self, host: str) -> asyncio.Semaphore:
+        slots = self._async_slots.setdefault(asyncio.get_running_loop(), {})
+        if host not in slots:
+            slots[host] = asyncio.Semaphore(self.max_sessions)
+        return slots[host]
+
+    def reset(self, host: str, extra_args: typing.Sequence[str] = ()) -> bool:
+        """ Ask the master connection for ``host`` to exit; returns True if there was one """
+        if not self.multiplex:
+            return False
+        result = subprocess.run(
+            ['ssh'] + list(extra_args) + ['-o', f'ControlPath={self.control_path}', '-O', 'exit', host],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        return result.returncode == 0
+
+    def stale(self, host: str, extra_args: typing.Sequence[str] = ()) -> bool:
+        """ Whether the master connection for ``host`` exists but does not answer (``ssh -O check``) """
+        if not self.multiplex:
+            return False
+        result = subprocess.run(
+            ['ssh'] + list(extra_args) + ['-o', f'ControlPath={self.control_path}', '-O', 'check', host],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        # no socket at all is fine: the command will start a new master
+        return self.mux_failed(result.returncode, result.stderr) and NO_MASTER not in (result.stderr or b'')
+
+    @staticmethod
+    def mux_failed(returncode: int, *outputs: typing.Union[bytes, str, None]) -> bool:
+        """
+        Whether ssh failed because a stale master could not open a session, so the command never reached the host.
+        Any other exit code 255 may come from the remote command itself, which must not run twice
+        """
+        if returncode != CONNECTION_ERROR:
+            return False
+        for output in outputs:
+            if isinstance(output, str):
+                output = output.encode(errors='replace')
+            if isinstance(output, bytes) and MUX_ERROR.search(output):
+                return True
+        return False
+
+    def run(
+        self, host: str, command: TCommand, extra_args: typing.Sequence[str] = (), **kwargs
+    ) -> subprocess.CompletedProcess:
+        """
+        Like ``subprocess.run``, reconnecting once if an existing master connection went stale.
+        That can only be told from ssh's errors: when the stderr of the command is not captured,
+        the master is checked (and dropped if stale) before running it instead
+        """
+        captured = kwargs.get('capture_output') or kwargs.get('stderr') in (subprocess.PIPE, subprocess.STDOUT)
+        with self._slot(host):
+            attempt = 0
+            if not captured and self.retries and self.stale(host, extra_args):
+                self.reset(host, extra_args)
+                self.log.debug(f'Dropped stale master connection to {host}')
+            while True:
+                result = subprocess.run(self.ssh_args(host, command, extra_args), **kwargs)
+                merged = result.stdout if kwargs.get('stderr') == subprocess.STDOUT else None
+                if attempt >= self.retries or not self.mux_failed(result.returncode, result.stderr, merged):
+                    return result
+                attempt += 1
+                self.reset(host, extra_args)
+                self.log.debug(f'Dropped stale master connection to {host}, retrying')
+
+    async def run_async(
+        self,
+        host: str,
+        command: TCommand,
+        extra_args: typing.Sequence[str] = (),
+        timeout: float = None,
+        timings: Timings = None,
+    ) -> subprocess.CompletedProcess:
+        """
+        ``run`` for asyncio callers, capturing stdout and stderr as bytes.
+        The child is killed, and ``subprocess.TimeoutExpired`` raised, if it is still running after ``timeout`` seconds.
+        ``timings``, if given, is filled in as the command goes through resolution, connect, first byte and completion
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        if timings is not None:
+            try:
+                await loop.getaddrinfo(host, 22, type=socket.SOCK_STREAM)
+            except (OSError, UnicodeError) as e:
+                # maybe just an alias from ssh_config
+                self.log.debug(f'Unable to resolve {host}: {e}')
+            timings.mark('resolution')
+            command = self._with_marker(command)
+        async with self._async_slot(host):
+            attempt = 0
+            while True:
+                args = self.ssh_args(host, command, extra_args)
+                proc = await asyncio.create_subprocess_exec(
+                    *args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+                )
+                try:
+                    remaining = None if deadline is None else max(deadline - loop.time(), 0)
+                    stdout, stderr = await asyncio.wait_for(self._communicate(proc, timings), remaining)
+                except asyncio.TimeoutError:
+                    proc.kill()
+                    await proc.wait()
+                    raise subprocess.TimeoutExpired(args, timeout)
+                finally:
+                    if timings is not None:
+                        timings.mark('completion', overwrite=True)
+                if attempt >= self.retries or not self.mux_failed(proc.returncode, stderr):
+                    return subprocess.CompletedProcess(args, proc.returncode, stdout, stderr)
+                attempt += 1
+                await loop.run_in_executor(None, self.reset, host, tuple(extra_args))
+                self.log.debug(f'Dropped stale master connection to {host}, retrying')
+
+    @staticmethod
+    def _with_marker(command: TCommand) -> TCommand:
+        marker = f"printf '\\{SESSION_MARKER[0]:03o}' >&2;"
+        if isinstance(command, str):
+            return f'{marker} {command}'
+        return [marker] + list(command or ())
+
+    @staticmethod
+    async def _communicate(
+        proc: asyncio.subprocess.Process, timings: typing.Optional[Timings]
+    ) -> typing.Tuple[bytes, bytes]:
+        """ ``proc.communicate()``, marking the first byte of stdout and the session marker on stderr """
+        if timings is None:
+            return await proc.communicate()
+
+        async def read(stream: asyncio.StreamReader, marker: bytes = None) -> bytes:
+            chunks: typing.List[bytes] = []
+            while True:
+                chunk = await stream.read(1 << 16)
+                if not chunk:
+                    return b''.join(chunks)
+                if marker is None:
+                    timings.mark('first_byte')
+                    timings.mark('connect')
+                elif marker in chunk:
+                    chunk = chunk.replace(marker, b'', 1)
+                    marker = None
+                    timings.mark('connect')
+                chunks.append(chunk)
+
+        assert proc.stdout is not None and proc.stderr is not None
+        stdout, stderr, _ = await asyncio.gather(read(proc.stdout), read(proc.stderr, SESSION_MARKER), proc.wait())
+        return stdout, stderr
+
+    def check_output(self, host: str, command: TCommand, extra_args: typing.Sequence[str] = (), **kwargs):
+        """ Like ``subprocess.check_output``, but for a command run on ``host`` """
+        result = self.run(host, command, extra_args, stdout=subprocess.PIPE, **kwargs)
+        if result.returncode:
+            raise subprocess.CalledProcessError(
+                result.returncode, result.args, output=result.stdout, stderr=result.stderr
+            )
+        return result.stdout
+
+
+_transport: typing.Optional[SSHTransport] = None
+
+
+def get_transport() -> SSHTransport:
+    """ The process-wide transport, so all the tools share the same master connections """
+    global _transport
+    if _transport is None:
+        _transport = SSHTransport()
+    return _transport
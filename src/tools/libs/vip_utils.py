@@ -1,19 +1,16 @@
 import json
 import logging
-import subprocess
 import socket
 from collections import defaultdict
 
 import attr
 
+from .net_utils import local_addresses
+
 
 def is_proxy() -> bool:
-    _proxy_ip = socket.gethostbyname('proxy')
-    out = subprocess.check_output(['/sbin/ip', '-o', 'addr']).decode('utf-8')
-    for line in out.splitlines():
-        if _proxy_ip in line:
-            return True
-    return False
+    """ Whether the proxy VIP is currently on one of our interfaces """
+    return local_addresses.is_local(socket.gethostbyname('proxy'))
 
 
 class DecodeFirstLineException(Exception):
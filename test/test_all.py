@@ -1,20 +1,88 @@
+import asyncio
+import fnmatch
+import hashlib
+import io
+import json
+import shlex
+import subprocess
+import tarfile
 from unittest import mock
 
 import pytest
 
-from tools.bin.all import gethostname, main
+from tools.bin.all import (
+    TIMEOUT_RETURNCODE,
+    AdaptiveLimiter,
+    CommandResult,
+    CommandRunner,
+    ResultGroups,
+    gethostname,
+    latency_summary,
+    main,
+)
 from tools.libs.net_utils import HOSTS
+from tools.libs.ssh_transport import Timings
+
+
+class FakeTransport(object):
+    """ Replies to every host with `stdout`/`stderr`, after the delay configured for that host """
+
+    def __init__(self, stdout=b'my output', stderr=b'', returncode=0, delays=None):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = returncode
+        self.delays = delays or {}
+        self.responder = None
+        self.returncodes = {}
+        self.unreachable = set()
+        """ Hosts ssh cannot connect to: they fail with 255 before the session starts """
+        self.calls = []
+
+    async def run_async(self, host, command, extra_args=(), timeout=None, timings=None):
+        self.calls.append((host, command))
+        delay = self.delays.get(host, 0)
+        if timings is not None:
+            timings.mark('resolution')
+        if host in self.unreachable:
+            return subprocess.CompletedProcess(['ssh', host, command], 255, b'', b'ssh: connect to host: No route')
+        if timings is not None:
+            timings.mark('connect')
+        if timeout is not None and delay > timeout:
+            raise subprocess.TimeoutExpired(command, timeout)
+        await asyncio.sleep(delay)
+        if timings is not None:
+            timings.mark('first_byte')
+            timings.mark('completion', overwrite=True)
+        if self.responder:
+            reply = self.responder(host, command)
+            if isinstance(reply, subprocess.CompletedProcess):
+                return reply
+            return subprocess.CompletedProcess(['ssh', host, command], 0, reply, b'')
+        returncode = self.returncodes.get(host, self.returncode)
+        return subprocess.CompletedProcess(['ssh', host, command], returncode, self.stdout, self.stderr)
 
 
 @pytest.fixture
-def mock_run(monkeypatch):
-    mock_obj = mock.MagicMock(name='run')
-    mock_obj.return_value.returncode = 0
-    mock_obj.return_value.stdout = 'my output'
-    mock_obj.return_value.stderr = ''
-    monkeypatch.setattr('tools.bin.all.run', mock_obj)
+def mock_transport(monkeypatch):
+    transport = FakeTransport()
+    monkeypatch.setattr('tools.bin.all.get_transport', lambda: transport)
+    yield transport
+    print(transport.calls)
+
+
+@pytest.fixture(autouse=True)
+def health_file(monkeypatch, tmp_path):
+    path = tmp_path / 'host_health.json'
+    monkeypatch.setattr('tools.libs.host_health.HEALTH_FILE', str(path))
+    yield path
+
+
+@pytest.fixture
+def mock_hosts_from_dns(monkeypatch):
+    mock_obj = mock.Mock(name='hosts_from_dns')
+    mock_obj.return_value = HOSTS
+    monkeypatch.setattr('tools.bin.all.hosts_from_dns', mock_obj)
     yield mock_obj
-    print(mock_obj.mock_calls)
 
 
 @pytest.fixture
@@ -27,47 +95,375 @@ def mock_socket(monkeypatch):
     print(mock_obj.mock_calls)
 
 
-def call_for(hname, cmd):
-    return mock.call(
-        ['ssh', '-q', '-o StrictHostKeyChecking false', '-o ConnectTimeout 5', hname, cmd],
-        stderr=-1,
-        stdout=-1,
-        universal_newlines=True,
-    )
-
-
-@pytest.mark.skip(reason='Need to mock DNS calls')
-def test_main(mock_run, mock_socket):
+def test_main(mock_transport, mock_hosts_from_dns, mock_socket):
     cmd = 'ls -l'
     main([cmd])
-    mock_run.assert_has_calls(
-        [call_for(hname, cmd) for hname in HOSTS['linux'] | HOSTS['mac'] if hname != 'phoenix'], any_order=True
+    assert sorted(mock_transport.calls) == sorted(
+        (hname, cmd) for hname in HOSTS['linux'] | HOSTS['mac'] if hname != 'phoenix'
     )
-    assert call_for('phoenix', cmd) not in mock_run.call_args_list
-
     mock_socket.gethostname.assert_called_once_with()
 
 
-@pytest.mark.skip(reason='Need to mock DNS calls')
-def test_main_mac(mock_run, mock_socket, capsys):
+def test_main_mac(mock_transport, mock_hosts_from_dns, mock_socket, capsys):
     cmd = 'ls -l'
-    mock_run.return_value.stderr = 'errors'
+    mock_transport.stderr = b'errors'
     main([cmd, '--mac'])
 
     mock_socket.gethostname.assert_called_once_with()
-    mock_run.assert_has_calls([call_for(hname, cmd) for hname in HOSTS['mac']], any_order=True)
-    expected = '\n'.join(f'{hname}: my output\n{hname}: (err) errors' for hname in HOSTS['mac'])
-    assert capsys.readouterr().out.rstrip('\n') == expected
+    assert sorted(mock_transport.calls) == sorted((hname, cmd) for hname in HOSTS['mac'])
+    out = capsys.readouterr().out.splitlines()
+    for hname in HOSTS['mac']:
+        assert f'{hname}: my output' in out
+        assert f'{hname}: (err) errors' in out
 
 
-@pytest.mark.skip(reason='Need to mock DNS calls')
-def test_main_linux(mock_run, mock_socket, capsys):
+def test_main_linux(mock_transport, mock_hosts_from_dns, mock_socket, capsys):
     cmd = 'ls -l'
     # it works also if remote command returns an error, but produces no output
-    mock_run.return_value.returncode = 1
+    mock_transport.returncode = 1
     main([cmd, '--linux'])
 
     mock_socket.gethostname.assert_called_once_with()
-    mock_run.assert_has_calls([call_for(hname, cmd) for hname in HOSTS['linux'] if hname != 'phoenix'], any_order=True)
-    assert call_for('phoenix', cmd) not in mock_run.call_args_list
+    assert ('phoenix', cmd) not in mock_transport.calls
+    assert len(mock_transport.calls) == len(HOSTS['linux']) - 1
     assert capsys.readouterr().out == ''
+
+
+def test_main_streams_in_completion_order(mock_transport, mock_hosts_from_dns, mock_socket, capsys):
+    mock_transport.delays = {'mini': 0.2, 'quark': 0.1}
+    main(['uptime', '--mac'])
+    assert capsys.readouterr().out.splitlines() == ['bigmac: my output', 'quark: my output', 'mini: my output']
+
+
+def test_run_all_timeout(mock_transport):
+    mock_transport.delays = {'hung': 10}
+    cr = CommandRunner('uptime', timeout=0.1)
+
+    async def collect():
+        return [result async for result in cr.run_all(['hung', 'ok'], concurrency=1)]
+
+    results = dict(asyncio.run(collect()))
+    assert results['ok'].stdout == 'my output'
+    assert results['hung'].returncode == TIMEOUT_RETURNCODE
+    assert 'timed out' in results['hung'].stderr
+
+
+def test_main_group(mock_transport, mock_hosts_from_dns, mock_socket, capsys):
+    main(['uname -r', '--group'])
+    out = capsys.readouterr().out.splitlines()
+    assert out[:2] == [out[0], 'my output']
+    assert out[0].startswith('==> #1 ')
+    assert out[2] == '==> hosts <=='
+    assert out[3] == '#1 (10): biglinux, bigmac, mini, octopi, pathfinder, plone-01, quark, raspy[2-3], raspykey'
+    assert len(out) == 4
+
+
+def test_result_groups():
+    groups = ResultGroups()
+    assert groups.add('h1', CommandResult('a', '', 0)) == 1
+    assert groups.add('h2', CommandResult('b', '', 0)) == 2
+    assert groups.add('h3', CommandResult('a', '', 0)) is None
+    assert groups.add('h4', CommandResult('a', '', 1)) == 3
+    assert list(groups.summary()) == ['#1 (2): h[1,3]', '#2 (1): h2', '#3 (1): h4']
+
+
+@pytest.fixture
+def local_file(tmp_path):
+    local_file = tmp_path / 'resolv.conf'
+    local_file.write_text('nameserver 192.168.19.222\n')
+    return local_file
+
+
+def remote_file(content: bytes):
+    def responder(host, command):
+        if 'stat -c' in command:
+            return f'{len(content)} 2026-10-18 10:00:00.0 +0000\n{hashlib.sha256(content).hexdigest()}  file\n'.encode()
+        assert command.startswith('cat')
+        return content
+
+    return responder
+
+
+def test_diff_identical_not_transferred(mock_transport, local_file):
+    mock_transport.responder = remote_file(local_file.read_bytes())
+    host, result = CommandRunner(f'diff {local_file}').run_remote_command('raspy2')
+    assert (host, result.stdout, result.returncode) == ('raspy2', '', 0)
+    assert [cmd.split()[0] for _, cmd in mock_transport.calls] == ['{']
+
+
+def test_diff_different(mock_transport, local_file):
+    mock_transport.responder = remote_file(b'nameserver 1.1.1.1\n')
+    host, result = CommandRunner(f'diff {local_file}').run_remote_command('raspy2')
+    assert f'+++ raspy2:{local_file}\t2026-10-18T10:00:00.0 +0000' in result.stdout
+    assert '-nameserver 192.168.19.222\n+nameserver 1.1.1.1' in result.stdout
+    assert [cmd.split()[0] for _, cmd in mock_transport.calls] == ['{', 'cat']
+
+
+def test_diff_digest_only(mock_transport, local_file):
+    mock_transport.responder = remote_file(b'nameserver 1.1.1.1\n')
+    host, result = CommandRunner(f'diff {local_file}', digest_only=True).run_remote_command('raspy2')
+    assert result.stdout.startswith(f'raspy2:{local_file} differs (size 19, sha256 ')
+    assert [cmd.split()[0] for _, cmd in mock_transport.calls] == ['{']
+
+
+def run_like_a_mac(tmp_path):
+    """ Runs the commands locally, with GNU stat and sha256sum replaced by (emulations of) the macOS ones """
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    (bin_dir / 'stat').write_text(
+        '#!/bin/sh\n'
+        '[ "$1" = -f ] || { echo "stat: illegal option -- c" >&2; exit 1; }\n'
+        'eval "f=\\${$#}"\n'
+        'echo "$(wc -c < "$f" | tr -d " ") 2026-10-18 10:00:00 +0000"\n'
+    )
+    (bin_dir / 'sha256sum').write_text('#!/bin/sh\nexit 127\n')
+    for tool in bin_dir.iterdir():
+        tool.chmod(0o755)
+    env = {'PATH': f'{bin_dir}:/usr/bin:/bin'}
+
+    def responder(host, command):
+        return subprocess.run(['sh', '-c', command], env=env, capture_output=True)
+
+    return responder
+
+
+def test_diff_mac(mock_transport, local_file, tmp_path):
+    mock_transport.responder = run_like_a_mac(tmp_path)
+    host, result = CommandRunner(f'diff {local_file}').run_remote_command('bigmac')
+    assert (result.stdout, result.stderr, result.returncode) == ('', '', 0)
+    # the same size and digest as a different file
+    other = tmp_path / 'other'
+    other.write_text('nameserver 192.168.19.111\n')
+    runner = CommandRunner(f'diff {local_file}', digest_only=True)
+    runner._local_digests[str(local_file)] = runner.local_digest(str(other))
+    host, result = runner.run_remote_command('bigmac')
+    assert result.stdout.startswith(f'bigmac:{local_file} differs (size 26, sha256 ')
+
+
+def remote_tree(files: dict):
+    """ Emulates the remote digest listing and tar stream for `files` ({relative name: content}) """
+
+    def responder(host, command):
+        if ' for f in ' in command:
+            patterns = shlex.split(command.split(' for f in ')[1].split(';')[0])
+            names = [name for name in files if any(fnmatch.fnmatch(name, pattern) for pattern in patterns)]
+            return ''.join(f'{hashlib.sha256(files[name]).hexdigest()}  {name}\n' for name in names).encode()
+        assert ' tar -cf - ' in command
+        patterns = shlex.split(command.split(' tar -cf - ')[1])
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode='w') as tar:
+            for name in files:
+                if any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+                    info = tarfile.TarInfo(name)
+                    info.size = len(files[name])
+                    tar.addfile(info, io.BytesIO(files[name]))
+        return buffer.getvalue()
+
+    return responder
+
+
+@pytest.fixture
+def local_tree(tmp_path):
+    conf_dir = tmp_path / 'keepalived.d'
+    conf_dir.mkdir()
+    (conf_dir / 'dns.conf').write_text('vrrp_instance DNS {\n  priority 100\n}\n')
+    (conf_dir / 'www.conf').write_text('vrrp_instance www {\n}\n')
+    (conf_dir / 'local.conf').write_text('only here\n')
+    return conf_dir
+
+
+def test_multi_diff(mock_transport, local_tree):
+    rel = str(local_tree).lstrip('/')
+    mock_transport.responder = remote_tree(
+        {
+            f'{rel}/dns.conf': b'vrrp_instance DNS {\n  priority 90\n}\n',
+            f'{rel}/www.conf': (local_tree / 'www.conf').read_bytes(),
+            f'{rel}/remote.conf': b'only there\n',
+        }
+    )
+    host, result = CommandRunner(f'diff {local_tree}/*.conf').run_remote_command('raspy2')
+    lines = result.stdout.splitlines()
+    assert lines[0] == f'Only local: /{rel}/local.conf'
+    assert f'+++ raspy2:/{rel}/dns.conf' in lines
+    assert '-  priority 100' in lines and '+  priority 90' in lines
+    assert f'+++ raspy2:/{rel}/remote.conf' in lines
+    assert not any('www.conf' in line for line in lines)
+    # digests first, then a single tar with the changed files only
+    assert len(mock_transport.calls) == 2
+    assert 'www.conf' not in mock_transport.calls[1][1]
+
+
+@pytest.mark.parametrize(
+    'returncode,stderr',
+    ((TIMEOUT_RETURNCODE, b'timed out after 10s'), (255, b''), (2, b'tar: etc/x: Cannot open: Permission denied')),
+)
+def test_multi_diff_tar_failure(mock_transport, local_tree, returncode, stderr):
+    rel = str(local_tree).lstrip('/')
+    listing = remote_tree({f'{rel}/dns.conf': b'changed\n'})
+
+    def responder(host, command):
+        if ' tar -cf - ' in command:
+            return subprocess.CompletedProcess(command, returncode, b'', stderr)
+        return listing(host, command)
+
+    mock_transport.responder = responder
+    host, result = CommandRunner(f'diff {local_tree}/dns.conf {local_tree}/www.conf').run_remote_command('raspy2')
+    assert result.returncode == returncode
+    assert result.stderr == (stderr.decode() or 'Unable to read the files from raspy2')
+    assert '+++ ' not in result.stdout
+
+
+def test_multi_diff_digest_only(mock_transport, local_tree):
+    rel = str(local_tree).lstrip('/')
+    mock_transport.responder = remote_tree({f'{rel}/www.conf': b'changed\n'})
+    cr = CommandRunner(f'diff {local_tree}/www.conf {local_tree}/dns.conf', digest_only=True)
+    host, result = cr.run_remote_command('raspy2')
+    assert result.stdout.splitlines() == [f'Only local: /{rel}/dns.conf', f'raspy2:/{rel}/www.conf differs']
+    assert len(mock_transport.calls) == 1
+
+
+def test_fetch(mock_transport, tmp_path):
+    mock_transport.responder = remote_tree({'etc/hosts': b'127.0.0.1 localhost\n', 'etc/hostname': b'raspy2\n'})
+    host, result = CommandRunner('fetch /etc/host*', fetch_dir=str(tmp_path)).run_remote_command('raspy2')
+    assert (tmp_path / 'raspy2' / 'etc' / 'hostname').read_text() == 'raspy2\n'
+    assert (tmp_path / 'raspy2' / 'etc' / 'hosts').read_text() == '127.0.0.1 localhost\n'
+    assert result.stdout.splitlines()[0] == f'raspy2:/etc/hostname -> {tmp_path}/raspy2/etc/hostname'
+    assert len(mock_transport.calls) == 1
+
+
+def test_fetch_partial(mock_transport, tmp_path):
+    tree = remote_tree({'etc/hostname': b'raspy2\n'})
+    stderr = b'tar: etc/shadow: Cannot open: Permission denied\n'
+    mock_transport.responder = lambda host, command: subprocess.CompletedProcess(
+        command, 2, tree(host, command), stderr
+    )
+    cr = CommandRunner('fetch /etc/hostname /etc/shadow', fetch_dir=str(tmp_path))
+    host, result = cr.run_remote_command('raspy2')
+    assert (tmp_path / 'raspy2' / 'etc' / 'hostname').read_text() == 'raspy2\n'
+    assert result.returncode == 2
+    assert result.stderr == stderr.decode().rstrip('\n')
+
+
+def test_main_canary_failure_aborts(mock_transport, mock_hosts_from_dns, mock_socket, monkeypatch):
+    monkeypatch.setattr('tools.bin.all.extend_if_not_me', lambda hosts, to_add: hosts.extend(sorted(to_add)))
+    mock_transport.returncodes = {'bigmac': 1}
+    assert main(['apt-get -y upgrade', '--mac', '--canary', '1', '--batch-size', '1']) == 1
+    assert mock_transport.calls == [('bigmac', 'apt-get -y upgrade')]
+
+
+def test_main_batches(mock_transport, mock_hosts_from_dns, mock_socket, monkeypatch):
+    monkeypatch.setattr('tools.bin.all.extend_if_not_me', lambda hosts, to_add: hosts.extend(sorted(to_add)))
+    mock_transport.delays = {'bigmac': 0.1}
+    mock_transport.returncodes = {'pathfinder': 1, 'mini': 1}
+    # the failure in the second batch stops the rollout before the third one
+    assert main(['uptime', '--linux', '--canary', '1', '--batch-percent', '25']) == 1
+    assert [host for host, _ in mock_transport.calls][0] == 'biglinux'
+    assert sorted(host for host, _ in mock_transport.calls[1:3]) == ['octopi', 'pathfinder']
+    assert len(mock_transport.calls) == 3
+    assert main(['uptime', '--mac', '--canary', '2']) == 1
+    assert sorted(host for host, _ in mock_transport.calls[3:]) == ['bigmac', 'mini']
+
+
+def test_adaptive_limiter():
+    limiter = AdaptiveLimiter(16)
+    assert limiter.limit == 4
+    limiter.observe(1.0)
+    limiter.observe(1.5)
+    assert limiter.limit == 6
+    limiter.observe(10)
+    assert limiter.limit == 3
+    for _ in range(20):
+        limiter.observe(1.0)
+    assert limiter.limit == 16
+
+
+def test_adaptive_limiter_baseline():
+    limiter = AdaptiveLimiter(16)
+    for _ in range(3):
+        limiter.observe(1.0)
+    assert limiter.limit == 7
+    # a fast failure (or skipped host) neither lowers the baseline nor changes the limit
+    limiter.observe(0.01, ok=False)
+    assert (limiter.baseline, limiter.limit) == (1.0, 7)
+    # nor does a single very fast host make all the others slow
+    limiter.observe(0.01)
+    limiter.observe(1.0)
+    assert limiter.limit == 9
+    # a failure that took too long (e.g. a timeout) is still slow
+    limiter.observe(10, ok=False)
+    assert (limiter.baseline, limiter.limit) == (1.0, 4.5)
+
+
+def test_main_canary_all_hosts(mock_transport, mock_hosts_from_dns, mock_socket):
+    assert main(['uptime', '--mac', '--canary', '20', '--batch-size', '1']) == 0
+    assert sorted(host for host, _ in mock_transport.calls) == sorted(HOSTS['mac'])
+
+
+def test_main_tag(mock_transport, mock_hosts_from_dns, mock_socket, capsys):
+    mock_hosts_from_dns.return_value = dict(HOSTS, printer={'octopi'}, pi={'raspy2', 'raspy3', 'octopi'})
+    cmd = 'uptime'
+    assert main(['--tag', 'printer', '-T', 'PI', cmd]) == 0
+    assert sorted(mock_transport.calls) == [('octopi', cmd), ('raspy2', cmd), ('raspy3', cmd)]
+    mock_transport.calls.clear()
+    assert main(['--tag', 'missing', cmd]) == 0
+    assert mock_transport.calls == []
+
+
+def test_main_jsonl(mock_transport, mock_hosts_from_dns, mock_socket, capsys):
+    mock_transport.delays = {'mini': 0.1}
+    mock_transport.returncodes = {'quark': 2}
+    assert main(['uptime', '--mac', '--jsonl']) == 0
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert sorted(line['host'] for line in lines[:2]) == ['bigmac', 'quark']
+    assert lines[2]['host'] == 'mini'
+    assert [line['returncode'] for line in lines[:2] if line['host'] == 'quark'] == [2]
+    assert lines[2]['stdout'] == 'my output'
+    assert lines[2]['timings']['completion'] >= 0.1
+    summary = lines[3]['summary']
+    assert summary['hosts'] == 3
+    assert summary['completion']['max'] == lines[2]['timings']['completion']
+    assert summary['slowest'][0]['host'] == 'mini'
+
+
+def test_latency_summary():
+    timings = {f'host{n}': Timings(0, 0.01, 0.02 * n, None, 0.1 * n) for n in range(1, 21)}
+    timings['down'] = Timings(0, 0.01)
+    summary = latency_summary(timings, slowest=2)
+    assert summary['hosts'] == 21
+    assert summary['completion'] == {'p50': pytest.approx(1.0), 'p95': pytest.approx(1.9), 'max': pytest.approx(2.0)}
+    assert 'first_byte' not in summary
+    assert [entry['host'] for entry in summary['slowest']] == ['host20', 'host19']
+
+
+def test_main_skips_down_hosts(mock_transport, mock_hosts_from_dns, mock_socket, monkeypatch, capsys, health_file):
+    mock_probe = mock.AsyncMock(name='probe', return_value=False)
+    monkeypatch.setattr('tools.bin.all.probe', mock_probe)
+    mock_transport.unreachable = {'mini'}
+    assert main(['uptime', '--mac']) == 0
+    assert 'mini' in json.loads(health_file.read_text())
+    capsys.readouterr()
+    mock_transport.calls.clear()
+    # mini is in backoff and does not answer on port 22
+    assert main(['uptime', '--mac', '--canary', '1']) == 0
+    assert sorted(host for host, _ in mock_transport.calls) == ['bigmac', 'quark']
+    mock_probe.assert_awaited_once_with('mini')
+    assert any(line.startswith('mini: skipped (down since ') for line in capsys.readouterr().out.splitlines())
+    assert json.loads(health_file.read_text())['mini']['consecutive_failures'] == 2
+    # unless forced, or it accepts connections again
+    mock_transport.calls.clear()
+    main(['uptime', '--mac', '--force-all'])
+    assert ('mini', 'uptime') in mock_transport.calls
+    mock_transport.calls.clear()
+    mock_transport.unreachable = set()
+    mock_probe.return_value = True
+    main(['uptime', '--mac'])
+    assert ('mini', 'uptime') in mock_transport.calls
+    assert json.loads(health_file.read_text())['mini']['consecutive_failures'] == 0
+
+
+def test_main_remote_exit_255_is_healthy(mock_transport, mock_hosts_from_dns, mock_socket, health_file):
+    # e.g. xargs or a nested ssh exiting 255: the host answered
+    mock_transport.returncodes = {'mini': 255}
+    main(['uptime', '--mac'])
+    health = json.loads(health_file.read_text())['mini']
+    assert (health['consecutive_failures'], health['backoff_until']) == (0, None)
@@ -0,0 +1,51 @@
+import os
+import threading
+import time
+
+import pytest
+
+from tools.libs.file_watch import FileWatcher
+
+
+def write_later(path, content, delay=0.1):
+    def write():
+        time.sleep(delay)
+        with open(path, 'w') as f:
+            f.write(content)
+
+    thread = threading.Thread(target=write)
+    thread.start()
+    return thread
+
+
+@pytest.mark.parametrize('poll', [False, True], ids=['inotify', 'poll'])
+def test_wait_for_change(tmp_path, poll):
+    path = tmp_path / 'keepalived.data'
+    path.write_text('one')
+    with FileWatcher(str(path), poll_interval=0.02, poll=poll) as watcher:
+        assert watcher.uses_inotify is not poll
+        assert watcher.wait(0.05) is False
+        thread = write_later(path, 'two, longer')
+        started = time.monotonic()
+        assert watcher.wait(2) is True
+        assert time.monotonic() - started < 1
+        thread.join()
+
+
+def test_ignores_other_files(tmp_path):
+    path = tmp_path / 'keepalived.data'
+    with FileWatcher(str(path)) as watcher:
+        write_later(tmp_path / 'other', 'x', delay=0).join()
+        assert watcher.wait(0.1) is False
+        # created after the watch started: the directory is watched
+        write_later(path, 'x', delay=0).join()
+        assert watcher.wait(0.1) is True
+
+
+def test_replaced_file(tmp_path):
+    path = tmp_path / 'keepalived.data'
+    path.write_text('one')
+    with FileWatcher(str(path)) as watcher:
+        (tmp_path / 'new').write_text('two')
+        os.replace(tmp_path / 'new', path)
+        assert watcher.wait(0.5) is True
@@ -0,0 +1,52 @@
+import asyncio
+import json
+import socket
+
+import pytest
+
+from tools.libs.host_health import HealthStore, HostHealth, probe
+
+
+@pytest.fixture
+def store(tmp_path):
+    return HealthStore.load(str(tmp_path / 'health.json'), base_backoff=10, max_backoff=30)
+
+
+def test_backoff(store):
+    assert not store.in_backoff('host', now=100)
+    store.record('host', False, now=100)
+    assert store.in_backoff('host', now=109)
+    assert not store.in_backoff('host', now=110)
+    store.record('host', False, now=110)
+    store.record('host', False, now=130)
+    # doubling, but capped at max_backoff
+    assert store.get('host') == HostHealth(None, 3, 100, 160)
+    store.record('host', True, now=140)
+    assert store.get('host') == HostHealth(140, 0, None, None)
+    assert not store.in_backoff('host', now=141)
+
+
+def test_save_load(store, tmp_path):
+    store.record('up', True, now=1)
+    store.record('down', False, now=2)
+    store.save()
+    loaded = HealthStore.load(store.path)
+    assert loaded.hosts == store.hosts
+    assert json.loads((tmp_path / 'health.json').read_text())['down']['down_since'] == 2
+
+
+def test_load_corrupt(tmp_path):
+    (tmp_path / 'health.json').write_text('{"host": [')
+    assert HealthStore.load(str(tmp_path / 'health.json')).hosts == {}
+
+
+def test_probe():
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen()
+    port = server.getsockname()[1]
+    try:
+        assert asyncio.run(probe('127.0.0.1', port))
+    finally:
+        server.close()
+    assert not asyncio.run(probe('127.0.0.1', port))
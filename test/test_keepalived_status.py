@@ -1,12 +1,39 @@
+import io
+import json as _json
 import os
+import sqlite3
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
 
 import pytest
 from click.testing import CliRunner
+from rich.console import Console
 
 from tools.bin import keepalived_status as ks
 
 FIXTURE = os.path.join(os.path.dirname(__file__), "fixtures", "keepalived.data")
 FIXTURE_V2 = os.path.join(os.path.dirname(__file__), "fixtures", "keepalived-v2.data")
+FIXTURE_JSON = os.path.join(os.path.dirname(__file__), "fixtures", "keepalived-dump.json")
+
+
+@pytest.fixture(autouse=True)
+def ptr_cache(tmp_path, monkeypatch):
+    path = tmp_path / "ptr.json"
+    monkeypatch.setattr(ks, "PTR_CACHE_FILE", str(path))
+    return path
+
+
+@pytest.fixture(autouse=True)
+def service_index_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr("tools.libs.service_index.INDEX_DIR", str(tmp_path / "service_index"))
+
+
+@pytest.fixture(autouse=True)
+def no_cached_pid(monkeypatch):
+    monkeypatch.setattr(ks, "_keepalived_pid", None)
 
 
 @pytest.fixture
@@ -121,6 +148,61 @@ def test_resolver_ignores_non_ip():
     assert resolve("unknown") == "unknown"
 
 
+def test_resolver_persists_cache(monkeypatch, ptr_cache):
+    calls = []
+
+    def fake_gethostbyaddr(ip):
+        calls.append(ip)
+        return ("nas.home.lan", [], [ip])
+
+    monkeypatch.setattr(ks.socket, "gethostbyaddr", fake_gethostbyaddr)
+    ks.make_resolver(enabled=True).prefetch(["192.168.19.226", "unknown"])
+    assert _json.loads(ptr_cache.read_text())["192.168.19.226"][0] == "nas"
+    # A new run is served from the file.
+    assert ks.make_resolver(enabled=True)("192.168.19.226") == "nas"
+    assert calls == ["192.168.19.226"]
+
+
+def test_resolver_refreshes_expired(monkeypatch, ptr_cache):
+    ptr_cache.write_text(_json.dumps({"10.0.0.1": ["old", time.time() - 1]}))
+    resolve = ks.make_resolver(enabled=True)
+    # Expired names are still used until refreshed.
+    assert resolve("10.0.0.1") == "old"
+    monkeypatch.setattr(ks.socket, "gethostbyaddr", lambda ip: ("new.lan", [], [ip]))
+    resolve.prefetch(["10.0.0.1"])
+    assert resolve("10.0.0.1") == "new"
+
+
+def test_resolver_prefetch_is_parallel_and_bounded(monkeypatch):
+    release = threading.Event()
+
+    def slow_gethostbyaddr(ip):
+        if ip == "10.0.0.9":
+            release.wait(5)
+        return (f"host{ip.rsplit('.', 1)[1]}", [], [ip])
+
+    monkeypatch.setattr(ks.socket, "gethostbyaddr", slow_gethostbyaddr)
+    resolve = ks.make_resolver(enabled=True)
+    resolve.timeout = 0.2
+    start = time.monotonic()
+    resolve.prefetch([f"10.0.0.{n}" for n in range(1, 10)])
+    assert time.monotonic() - start < 1
+    assert resolve("10.0.0.1") == "host1"
+    # The hung lookup shows the IP, without blocking again...
+    assert resolve("10.0.0.9") == "10.0.0.9"
+    # ...and its late answer is picked up once it arrives.
+    release.set()
+    for _ in range(50):
+        if resolve("10.0.0.9") != "10.0.0.9":
+            break
+        time.sleep(0.01)
+    assert resolve("10.0.0.9") == "host9"
+
+
+def test_instance_ips(instances):
+    assert ks.instance_ips(instances) == {"192.168.19.132", "192.168.19.120", "192.168.19.226"}
+
+
 def test_label_with_name(monkeypatch):
     monkeypatch.setattr(ks.socket, "gethostbyaddr", lambda ip: ("nas.home.lan", [], [ip]))
     resolve = ks.make_resolver(enabled=True)
@@ -155,23 +237,91 @@ def test_find_pid_none(monkeypatch):
     assert ks.find_keepalived_pid() is None
 
 
+def test_find_pid_cached(monkeypatch):
+    lookups = []
+    names = {os.getpid(): "keepalived"}
+    monkeypatch.setattr(ks, "PIDFILE_CANDIDATES", ())
+    monkeypatch.setattr(ks.subprocess, "check_output", lambda *a, **k: lookups.append(a) or f"{os.getpid()}\n")
+    monkeypatch.setattr(ks, "_process_name", names.get)
+    assert ks.find_keepalived_pid() == os.getpid()
+    assert ks.find_keepalived_pid() == os.getpid()
+    assert len(lookups) == 1
+    # A PID whose process is gone is looked up again.
+    monkeypatch.setattr(ks, "_keepalived_pid", 2**22 + 1)
+    assert ks.find_keepalived_pid() == os.getpid()
+    assert len(lookups) == 2
+    # So is one reused by another process after a restart.
+    names[os.getpid()] = "python3"
+    ks.find_keepalived_pid()
+    assert len(lookups) == 3
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self"), reason="needs /proc")
+def test_process_name():
+    with subprocess.Popen(["sleep", "5"]) as proc:
+        deadline = time.monotonic() + 5
+        # until it has exec'd, the child still has our name
+        while ks._process_name(proc.pid) != "sleep" and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert ks._process_name(proc.pid) == "sleep"
+        proc.kill()
+    assert ks._process_name(2**22 + 1) is None
+
+
 def test_refresh_data_file_signals(monkeypatch, tmp_path):
     data = tmp_path / "k.data"
     data.write_text("old")
-    monkeypatch.setattr(ks, "find_keepalived_pid", lambda: 99)
-    times = iter([100.0, 200.0])
-    monkeypatch.setattr(ks.os.path, "getmtime", lambda p: next(times))
+    monkeypatch.setattr(ks, "find_keepalived_pid", lambda **kwargs: 99)
     sent = {}
 
     def fake_kill(pid, sig):
         sent["pid"] = pid
         sent["sig"] = sig
+        data.write_text("new\n")
 
     monkeypatch.setattr(ks.os, "kill", fake_kill)
-    assert ks.refresh_data_file(str(data), wait=1.0) is True
+    start = time.monotonic()
+    assert ks.refresh_data_file(str(data), wait=5.0) is True
+    assert time.monotonic() - start < 1
     assert sent == {"pid": 99, "sig": ks.signal.SIGUSR1}
 
 
+def test_refresh_waits_for_complete_dump(monkeypatch, tmp_path, capsys):
+    data = tmp_path / "k.data"
+    data.write_text("old\n")
+    monkeypatch.setattr(ks, "find_keepalived_pid", lambda **kwargs: 99)
+
+    def finish():
+        time.sleep(0.2)
+        with open(data, "a") as f:
+            f.write("end\n")
+
+    def fake_kill(pid, sig):
+        data.write_text("------< VRRP Topology >------\n partial")
+        threading.Thread(target=finish).start()
+
+    monkeypatch.setattr(ks.os, "kill", fake_kill)
+    assert ks.refresh_data_file(str(data), wait=5.0) is True
+    assert data.read_text().endswith("end\n")
+    assert "did not update" not in capsys.readouterr().out
+
+
+def test_refresh_retries_stale_pid(monkeypatch, tmp_path):
+    data = tmp_path / "k.data"
+    monkeypatch.setattr(ks, "find_keepalived_pid", lambda use_cache=True: 99 if use_cache else 100)
+    sent = []
+
+    def fake_kill(pid, sig):
+        sent.append(pid)
+        if pid == 99:
+            raise ProcessLookupError()
+        data.write_text("new\n")
+
+    monkeypatch.setattr(ks.os, "kill", fake_kill)
+    assert ks.refresh_data_file(str(data), wait=5.0) is True
+    assert sent == [99, 100]
+
+
 def test_refresh_no_pid(monkeypatch):
     monkeypatch.setattr(ks, "find_keepalived_pid", lambda: None)
     assert ks.refresh_data_file("/tmp/whatever") is False
@@ -180,7 +330,7 @@ def test_refresh_no_pid(monkeypatch):
 def test_refresh_permission_denied(monkeypatch, tmp_path):
     data = tmp_path / "k.data"
     data.write_text("x")
-    monkeypatch.setattr(ks, "find_keepalived_pid", lambda: 5)
+    monkeypatch.setattr(ks, "find_keepalived_pid", lambda **kwargs: 5)
 
     def denied(pid, sig):
         raise PermissionError()
@@ -318,3 +468,578 @@ def test_v2_cli_runs():
     assert result.exit_code == 0
     assert "chk_www is BAD" in result.output
     assert "UP, RUNNING" not in result.output
+
+
+# ---- streaming parser ------------------------------------------------------
+
+
+def test_parse_file_matches_parse():
+    for path in (FIXTURE, FIXTURE_V2):
+        with open(path, "r") as f:
+            assert list(ks.parse_file(path)) == ks.parse(f.read())
+
+
+def test_parse_file_empty(tmp_path):
+    (tmp_path / "empty.data").write_bytes(b"")
+    assert list(ks.parse_file(str(tmp_path / "empty.data"))) == []
+
+
+def test_iter_parse_yields_as_blocks_close():
+    lines = iter(open(FIXTURE, "rb").read().splitlines(keepends=True))
+    consumed = []
+
+    class Reader:
+        def readline(self):
+            line = next(lines, b"")
+            consumed.append(line)
+            return line
+
+    parsed = ks.iter_parse(Reader())
+    first = next(parsed)
+    assert first.name == "DNS"
+    # only read up to the start of the next instance
+    assert consumed[-1].strip() == b"VRRP Instance = mysql"
+    assert [i.name for i in parsed] == ["mysql", "netdata"]
+
+
+def test_iter_parse_shares_scripts():
+    data = (
+        " VRRP Instance = a\n   Tracked scripts :\n     chk weight -10\n"
+        " VRRP Instance = b\n   Tracked scripts :\n     chk\n"
+        "------< VRRP Scripts >------\n VRRP Script = chk\n   Status = BAD\n"
+    )
+    a, b = ks.iter_parse(data.encode())
+    assert a.scripts[0] is b.scripts[0]
+    assert (a.scripts[0].status, a.scripts[0].weight) == ("BAD", -10)
+
+
+# ---- watch mode ------------------------------------------------------------
+
+
+class FakeWatcher:
+    """Rewrites the data file from ``frames`` at each wait, then interrupts the watch."""
+
+    def __init__(self, path, frames):
+        self.path = path
+        self.frames = list(frames)
+        self.timeouts = []
+
+    def wait(self, timeout=None):
+        self.timeouts.append(timeout)
+        if not self.frames:
+            raise KeyboardInterrupt
+        frame = self.frames.pop(0)
+        if frame is None:
+            return False
+        with open(self.path, "w") as f:
+            f.write(frame)
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+def test_watch_highlights_changes(tmp_path, monkeypatch):
+    path = tmp_path / "keepalived.data"
+    with open(FIXTURE) as f:
+        text = f.read()
+    path.write_text(text)
+    frames = []
+    monkeypatch.setattr(ks, "render_tables", lambda *args: frames.append(args) or "")
+    flipped = text.replace("State = BACKUP", "State = MASTER", 1)
+    watcher = FakeWatcher(str(path), [None, flipped])
+    assert ks.watch(str(path), lambda ip: ip, watcher=watcher) == 0
+    # parsed once at start and once per change, not on the timeout
+    assert len(frames) == 2
+    assert frames[0][3] == set()
+    assert frames[1][3] == {"DNS"}
+    assert watcher.timeouts == [None, None, None]
+
+
+def test_watch_signals_on_interval(tmp_path, monkeypatch):
+    path = tmp_path / "keepalived.data"
+    path.write_text("")
+    refreshed = []
+    monkeypatch.setattr(ks, "refresh_data_file", refreshed.append)
+    watcher = FakeWatcher(str(path), [None])
+    ks.watch(str(path), lambda ip: ip, signal_interval=5, watcher=watcher)
+    assert refreshed == [str(path)]
+    assert 4 < watcher.timeouts[0] <= 5
+
+
+def test_cli_watch(monkeypatch):
+    calls = []
+    monkeypatch.setattr(ks, "watch", lambda *args, **kwargs: calls.append(args) or 0)
+    result = CliRunner().invoke(ks.main, [FIXTURE, "--watch", "--no-resolve", "--signal", "-i", "3"])
+    assert result.exit_code == 0
+    assert calls[0][0] == FIXTURE and calls[0][2] == 3
+
+
+def test_render_tables_highlights(instances):
+    group = ks.render_tables(instances, None, changed={"mysql"})
+    table = group.renderables[0]
+    assert [row.style for row in table.rows] == [None, "reverse", None]
+
+
+# ---- JSON dump -------------------------------------------------------------
+
+
+def _fields(inst):
+    return (
+        inst.name,
+        inst.state,
+        inst.vrid,
+        inst.priority,
+        inst.master_router,
+        inst.master_priority,
+        inst.src_ip,
+        inst.vips,
+        inst.last_transition_epoch,
+        inst.script_names,
+    )
+
+
+def test_parse_json_matches_text(instances):
+    with open(FIXTURE_JSON, "rb") as f:
+        from_json = ks.parse_json(f.read())
+    assert [_fields(i) for i in from_json] == [_fields(i) for i in instances]
+    assert [i.owner for i in from_json] == [i.owner for i in instances]
+    assert [i.is_degraded for i in from_json] == [False, False, True]
+    # Plain script names carry no status: nothing to report as failing.
+    assert not any(i.scripts for i in from_json)
+
+
+def test_parse_json_script_status():
+    (inst,) = ks.parse_json(
+        '[{"data": {"iname": "www", "state": "fault", "track_script": [{"name": "chk_www", "status": "BAD"}]}}]'
+    )
+    assert inst.state == "FAULT"
+    assert [(s.name, s.status) for s in inst.failing_scripts] == [("chk_www", "BAD")]
+
+
+def test_parse_json_rejects_other_documents():
+    with pytest.raises(ValueError):
+        ks.parse_json('{"iname": "DNS"}')
+
+
+def test_pick_dump(tmp_path):
+    text = tmp_path / "keepalived.data"
+    text.write_text("")
+    assert ks.pick_dump(str(text)) == (str(text), "text")
+    js = tmp_path / "keepalived.json"
+    js.write_text("[]")
+    os.utime(text, (1000, 1000))
+    assert ks.pick_dump(str(text)) == (str(js), "json")
+    assert ks.pick_dump(str(text), "text") == (str(text), "text")
+    os.utime(js, (900, 900))
+    assert ks.pick_dump(str(text)) == (str(text), "text")
+    assert ks.pick_dump(str(text), "json") == (str(js), "json")
+    assert ks.pick_dump(str(js)) == (str(js), "json")
+
+
+def test_cli_format(tmp_path):
+    data = tmp_path / "keepalived.data"
+    data.write_text("------< VRRP Topology >------\n VRRP Instance = old\n   State = BACKUP\n")
+    os.utime(data, (1000, 1000))
+    with open(FIXTURE_JSON) as f:
+        (tmp_path / "keepalived.json").write_text(f.read())
+    for fmt, names in (("auto", ["DNS", "mysql", "netdata"]), ("text", ["old"])):
+        result = CliRunner().invoke(ks.main, [str(data), "--json", "--no-resolve", "--format", fmt])
+        assert result.exit_code == 0, result.output
+        assert [i["name"] for i in _json.loads(result.output)] == names
+
+
+def test_cli_format_json_bad_dump(tmp_path):
+    (tmp_path / "keepalived.json").write_text("[{")
+    result = CliRunner().invoke(ks.main, [str(tmp_path / "keepalived.data"), "-f", "json"])
+    assert result.exit_code == 1
+    assert "Cannot parse" in result.output
+
+
+def test_refresh_dump_json(monkeypatch):
+    calls = []
+    monkeypatch.setattr(ks, "json_signal", lambda: 36)
+    monkeypatch.setattr(ks, "refresh_data_file", lambda path, **kwargs: calls.append((path, kwargs)) or True)
+    assert ks.refresh_dump("/tmp/keepalived.data", "json") is True
+    assert ks.refresh_dump("/tmp/keepalived.data", "auto") is True
+    assert calls == [("/tmp/keepalived.json", {"signum": 36}), ("/tmp/keepalived.data", {})]
+    monkeypatch.setattr(ks, "json_signal", lambda: None)
+    assert ks.refresh_dump("/tmp/keepalived.data", "json") is False
+
+
+# ---- diff ------------------------------------------------------------------
+
+
+def _diff(before, after):
+    return {(c.name, c.kind): c.changes for c in ks.diff_instances(before, after)}
+
+
+def test_diff_identical(instances):
+    assert ks.diff_instances(instances, ks.parse_file(FIXTURE)) == []
+
+
+def test_diff_changes():
+    before = [
+        ks.Instance(
+            name="DNS",
+            vrid=222,
+            state="MASTER",
+            priority=100,
+            effective_priority=100,
+            src_ip="10.0.0.1",
+            vips=["10.0.0.222/24"],
+            scripts=[ks.Script("chk_dns", "GOOD"), ks.Script("chk_old", "GOOD")],
+        ),
+        ks.Instance(name="www", vrid=66),
+        ks.Instance(name="mail", vrid=25),
+    ]
+    after = [
+        ks.Instance(
+            name="DNS",
+            vrid=222,
+            state="BACKUP",
+            priority=100,
+            effective_priority=0,
+            master_router="10.0.0.2",
+            vips=["10.0.0.222/24", "10.0.0.223/24"],
+            scripts=[ks.Script("chk_dns", "BAD")],
+        ),
+        # same name, another VRID: a different group
+        ks.Instance(name="www", vrid=67),
+        ks.Instance(name="mail", vrid=25),
+    ]
+    assert _diff(before, after) == {
+        ("DNS", "changed"): {
+            "state": ("MASTER", "BACKUP"),
+            "effective_priority": (100, 0),
+            "owner": ("10.0.0.1", "10.0.0.2"),
+            "vips": (["10.0.0.222/24"], ["10.0.0.222/24", "10.0.0.223/24"]),
+            "script:chk_dns": ("GOOD", "BAD"),
+            "script:chk_old": ("GOOD", None),
+        },
+        ("www", "added"): {},
+        ("www", "removed"): {},
+    }
+    text = _render_text(ks.render_diff(ks.diff_instances(before, after)))
+    assert "effective priority 100 → 0 (-100)" in text
+    assert "VIPs +10.0.0.223/24" in text
+    assert "script chk_dns GOOD → BAD" in text
+
+
+def _render_text(renderable):
+    console = Console(file=io.StringIO(), width=200)
+    console.print(renderable)
+    return console.file.getvalue()
+
+
+def test_cli_diff(tmp_path):
+    new = tmp_path / "new.data"
+    with open(FIXTURE) as f:
+        new.write_text(f.read().replace("Priority = 100", "Priority = 90"))
+    result = CliRunner().invoke(ks.main, ["diff", FIXTURE, str(new), "--json"])
+    assert result.exit_code == 1
+    assert _json.loads(result.output) == [
+        {"name": "mysql", "vrid": 72, "kind": "changed", "changes": {"priority": {"old": 100, "new": 90}}}
+    ]
+    result = CliRunner().invoke(ks.main, ["diff", FIXTURE, FIXTURE])
+    assert result.exit_code == 0
+    assert "No differences." in result.output
+    assert CliRunner().invoke(ks.main, ["diff", FIXTURE, str(tmp_path / "missing")]).exit_code == 2
+
+
+# ---- history ---------------------------------------------------------------
+
+
+def _snapshot(state, epoch, effective=100):
+    return [
+        ks.Instance(name="DNS", state=state, priority=100, effective_priority=effective, last_transition_epoch=epoch)
+    ]
+
+
+def test_history_records_changes_only(instances, tmp_path):
+    with ks.History(str(tmp_path / "h.sqlite")) as history:
+        assert history.record(instances, now=2_000_000_000) == 3
+        assert history.record(instances, now=2_000_000_060) == 0
+        assert history.flaps(24, now=2_000_000_060) == {"DNS": 0, "mysql": 0, "netdata": 0}
+
+
+def test_history_flaps(tmp_path):
+    now = 2_000_000_000
+    with ks.History(str(tmp_path / "h.sqlite")) as history:
+        history.record(_snapshot("BACKUP", now - 7200), now=now - 3600)
+        history.record(_snapshot("MASTER", now - 1800), now=now - 1790)
+        history.record(_snapshot("BACKUP", now - 1700), now=now - 1690)
+        # back to BACKUP in between two snapshots: still a new transition
+        history.record(_snapshot("BACKUP", now - 600), now=now - 590)
+        history.record(_snapshot("BACKUP", now - 600), now=now)
+        assert history.flaps(1, now=now) == {"DNS": 3}
+        assert history.flaps(0.25, now=now) == {"DNS": 1}
+        assert history.db.execute("SELECT COUNT(*) FROM transitions").fetchone() == (4,)
+
+
+def test_history_degraded_time(tmp_path):
+    now = 2_000_000_000
+    with ks.History(str(tmp_path / "h.sqlite")) as history:
+        history.record(_snapshot("MASTER", now - 7200), now=now - 7200)
+        history.record(_snapshot("MASTER", now - 7200, effective=0), now=now - 3000)
+        history.record(_snapshot("MASTER", now - 7200), now=now - 1000)
+        history.record(_snapshot("MASTER", now - 7200, effective=0), now=now - 100)
+        assert history.degraded_time(24, now=now) == {"DNS": 2100.0}
+        # only the part within the window counts
+        assert history.degraded_time(0.5, now=now) == {"DNS": 900.0}
+
+
+def test_history_retention(tmp_path):
+    now = 2_000_000_000
+    with ks.History(str(tmp_path / "h.sqlite"), retention_days=1) as history:
+        history.record(_snapshot("BACKUP", now - 5 * 86400), now=now - 5 * 86400)
+        history.record(_snapshot("MASTER", now - 3 * 86400), now=now - 3 * 86400)
+        history.record(
+            [ks.Instance(name="old", state="BACKUP", last_transition_epoch=now - 4 * 86400)], now=now - 4 * 86400
+        )
+        history.record(_snapshot("MASTER", now - 3 * 86400), now=now)
+        # the latest row of an instance is kept, instances not seen in a while are dropped
+        assert history.db.execute("SELECT name, state FROM transitions").fetchall() == [("DNS", "MASTER")]
+        assert history.flaps(1, now=now) == {"DNS": 0}
+
+
+def test_cli_record_and_history(tmp_path):
+    db = str(tmp_path / "h.sqlite")
+    result = CliRunner().invoke(ks.main, [FIXTURE, "--no-resolve", "--record", "--db", db])
+    assert result.exit_code == 0, result.output
+    result = CliRunner().invoke(ks.main, ["--history", "1", "--json", "--db", db])
+    assert result.exit_code == 0, result.output
+    assert _json.loads(result.output)["netdata"] == {"flaps": 0, "degraded_seconds": 3600.0, "flapping": False}
+
+
+def test_cli_history_flapping(tmp_path):
+    db = str(tmp_path / "h.sqlite")
+    now = int(time.time())
+    with ks.History(db) as history:
+        for n, state in enumerate(["BACKUP", "MASTER", "BACKUP", "MASTER"]):
+            history.record(_snapshot(state, now - 1000 + n * 100), now=now - 1000 + n * 100)
+    result = CliRunner().invoke(ks.main, ["--history", "1", "--db", db])
+    assert result.exit_code == 1
+    assert "DNS: flapping (3 transitions in 1h)" in result.output
+
+
+# ---- metrics exporter ------------------------------------------------------
+
+
+def test_metrics_text(instances):
+    lines = ks.metrics_text(instances)
+    assert 'keepalived_vrrp_state{vrrp_instance="DNS",vrid="222",state="BACKUP"} 1' in lines
+    assert 'keepalived_vrrp_state{vrrp_instance="DNS",vrid="222",state="MASTER"} 0' in lines
+    assert 'keepalived_vrrp_effective_priority{vrrp_instance="netdata",vrid="71"} -20' in lines
+    assert 'keepalived_vrrp_script_ok{vrrp_instance="netdata",script="chk_netdata",status="BAD"} 0' in lines
+    assert 'keepalived_vips{owner="192.168.19.120"} 1' in lines
+    assert "# TYPE keepalived_vrrp_priority gauge" in lines
+
+
+def test_exporter_reload(tmp_path):
+    path = tmp_path / "keepalived.data"
+    with open(FIXTURE) as f:
+        path.write_text(f.read())
+    exporter = ks.MetricsExporter(str(path))
+    assert exporter.reload() is None
+    text = exporter.render(now=1782250931)
+    assert 'keepalived_vrrp_last_transition_seconds{vrrp_instance="DNS"} 100' in text
+    assert "keepalived_status_up 1" in text
+    assert text.endswith("\n# EOF\n")
+    # a dump that cannot be read keeps the last metrics, with up = 0
+    path.unlink()
+    assert "Cannot read" in exporter.reload()
+    text = exporter.render()
+    assert "keepalived_status_up 0" in text
+    assert 'vrrp_instance="DNS"' in text
+
+
+def test_exporter_follow(tmp_path, monkeypatch):
+    path = tmp_path / "keepalived.data"
+    path.write_text("")
+    exporter = ks.MetricsExporter(str(path))
+    exporter.reload()
+    refreshed = []
+    monkeypatch.setattr(ks, "refresh_data_file", refreshed.append)
+    with open(FIXTURE) as f:
+        watcher = FakeWatcher(str(path), [None, f.read()])
+    with pytest.raises(KeyboardInterrupt):
+        exporter.follow(watcher, signal_interval=0)
+    assert 'vrrp_instance="mysql"' in exporter.render()
+    assert len(refreshed) == 2
+
+
+def test_exporter_records_from_follow_thread(tmp_path, capsys):
+    path = tmp_path / "keepalived.data"
+    with open(FIXTURE) as f:
+        dump = f.read()
+    path.write_text(dump)
+    with ks.History(str(tmp_path / "h.sqlite")) as history:
+        exporter = ks.MetricsExporter(str(path), history=history)
+        # serve() reloads in the main thread first, then follow() reloads in its own thread
+        exporter.reload()
+        path.write_text(dump.replace("State = BACKUP", "State = MASTER", 1))
+        thread = threading.Thread(target=exporter.reload)
+        thread.start()
+        thread.join(5)
+        assert history.db.execute("SELECT SUM(changed) FROM transitions").fetchone() == (1,)
+    assert "Cannot record" not in capsys.readouterr().out
+
+
+@pytest.fixture
+def metrics_server(tmp_path):
+    exporter = ks.MetricsExporter(FIXTURE)
+    exporter.reload()
+    server = ks._MetricsServer(("127.0.0.1", 0), exporter)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _scrape(server, path="/metrics"):
+    host, port = server.server_address[:2]
+    try:
+        with urllib.request.urlopen(f"http://{host}:{port}{path}", timeout=5) as response:
+            return response.status, response.headers["Content-Type"], response.read().decode()
+    except urllib.error.HTTPError as e:
+        return e.code, None, None
+
+
+def test_metrics_server(metrics_server):
+    status, content_type, body = _scrape(metrics_server)
+    assert status == 200
+    assert content_type.startswith("application/openmetrics-text")
+    assert 'keepalived_vrrp_priority{vrrp_instance="mysql",vrid="72"} 100' in body
+    assert _scrape(metrics_server, "/nothing")[0] == 404
+
+
+def test_metrics_server_bounds_scrapes(metrics_server):
+    slots = metrics_server.exporter._slots
+    for _ in range(ks.MAX_SCRAPES):
+        slots.acquire()
+    assert _scrape(metrics_server)[0] == 503
+    slots.release()
+    assert _scrape(metrics_server)[0] == 200
+
+
+def test_cli_serve(monkeypatch):
+    calls = []
+    monkeypatch.setattr(ks, "serve", lambda *args: calls.append(args) or 0)
+    result = CliRunner().invoke(ks.main, [FIXTURE, "--serve", ":9650", "--signal", "-i", "30"])
+    assert result.exit_code == 0, result.output
+    assert calls == [(":9650", FIXTURE, "auto", 30, None)]
+
+
+def test_cli_serve_closes_history(monkeypatch, tmp_path):
+    connections = []
+
+    def fake_serve(*args):
+        connections.append(args[-1].db)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(ks, "serve", fake_serve)
+    CliRunner().invoke(ks.main, [FIXTURE, "--serve", ":9650", "--record", "--db", str(tmp_path / "h.sqlite")])
+    with pytest.raises(sqlite3.ProgrammingError):
+        connections[0].execute("SELECT 1")
+
+
+# ---- cluster mode ----------------------------------------------------------
+
+
+class FakeTransport:
+    """Answers with the given dump (bytes), or an exit code / timeout per host."""
+
+    def __init__(self, dumps):
+        self.dumps = dumps
+        self.calls = []
+
+    async def run_async(self, host, command, extra_args=(), timeout=None):
+        self.calls.append((host, command))
+        answer = self.dumps[host]
+        if answer is None:
+            raise subprocess.TimeoutExpired(command, timeout)
+        if isinstance(answer, int):
+            return subprocess.CompletedProcess(command, answer, b"", b"ssh: connect to host: No route to host\n")
+        return subprocess.CompletedProcess(command, 0, answer, b"")
+
+
+def _dump(name, vrid, state, priority):
+    return (
+        f" VRRP Instance = {name}\n   State = {state}\n   Virtual Router ID = {vrid}\n"
+        f"   Priority = {priority}\n   Virtual IP = 1\n     192.168.19.{vrid}/24 dev eth0 scope global\n"
+    ).encode()
+
+
+@pytest.fixture
+def cluster_transport(monkeypatch):
+    transport = FakeTransport(
+        {
+            "raspy2": _dump("DNS", 222, "MASTER", 100) + _dump("www", 66, "MASTER", 100),
+            "raspy3": _dump("DNS", 222, "BACKUP", 80) + _dump("www", 66, "MASTER", 90),
+            "octopi": 255,
+            "phoenix": None,
+        }
+    )
+    monkeypatch.setattr(ks, "get_transport", lambda: transport)
+    monkeypatch.setattr(ks, "ip_if_not_local", lambda host: "10.0.0.1")
+    yield transport
+    print(transport.calls)
+
+
+def test_fetch_cluster(cluster_transport):
+    view = ks.fetch_cluster(["raspy2", "raspy3", "octopi", "phoenix"], "/tmp/keepalived.data", do_signal=True)
+    assert view.nodes == ["raspy2", "raspy3"]
+    assert sorted(view.errors) == ["octopi", "phoenix"]
+    assert "No route to host" in view.errors["octopi"]
+    assert view.errors["phoenix"].startswith("no answer within")
+    dns, www = view.rows
+    assert (dns.names, dns.vrid, dns.vips, dns.masters) == (["DNS"], 222, ["192.168.19.222/24"], ["raspy2"])
+    assert dns.members["raspy3"].priority == 80
+    assert www.is_split_brain
+    assert view.split_brains == [www]
+    assert all(command.startswith("killall -USR1 keepalived") for _, command in cluster_transport.calls)
+
+
+def test_fetch_cluster_local_node(cluster_transport, monkeypatch):
+    monkeypatch.setattr(ks, "ip_if_not_local", lambda host: None if host == "here" else "10.0.0.1")
+    view = ks.fetch_cluster(["here", "raspy2"], FIXTURE)
+    assert view.nodes == ["here", "raspy2"]
+    assert len(view.rows) == 4
+    assert cluster_transport.calls == [("raspy2", f"cat {FIXTURE}")]
+
+
+def test_cli_cluster(cluster_transport, monkeypatch):
+    monkeypatch.setattr(ks, "load_candidate_hosts", lambda: {"DNS": ["raspy2", "raspy3"], "www": ["raspy3", "octopi"]})
+    result = CliRunner().invoke(ks.main, ["--cluster"])
+    assert result.exit_code == 0, result.output
+    assert "split brain, MASTER on raspy2, raspy3" in result.output
+    assert "octopi: did not answer" in result.output
+    assert [host for host, _ in cluster_transport.calls] == ["raspy2", "raspy3", "octopi"]
+
+
+def test_cli_cluster_json(cluster_transport):
+    result = CliRunner().invoke(ks.main, ["--cluster", "--json", "-H", "raspy2", "-H", "raspy3"])
+    data = _json.loads(result.output)
+    assert data["nodes"] == ["raspy2", "raspy3"]
+    assert [row["split_brain"] for row in data["rows"]] == [False, True]
+    assert data["rows"][0]["members"]["raspy3"] == {"state": "BACKUP", "priority": 80, "effective_priority": None}
+
+
+def test_cli_cluster_no_hosts(monkeypatch):
+    monkeypatch.setattr(ks, "load_candidate_hosts", lambda: {})
+    assert CliRunner().invoke(ks.main, ["--cluster"]).exit_code == 1
+
+
+def test_fetch_cluster_json(cluster_transport):
+    with open(FIXTURE_JSON, "rb") as f:
+        cluster_transport.dumps["raspy2"] = f.read()
+    view = ks.fetch_cluster(["raspy2"], "/tmp/keepalived.data", do_signal=True, fmt="json")
+    assert [row.names for row in view.rows] == [["DNS"], ["mysql"], ["netdata"]]
+    ((_, command),) = cluster_transport.calls
+    assert command.startswith("killall -s $(keepalived --signum=JSON) keepalived")
+    assert command.endswith("cat /tmp/keepalived.json")
@@ -0,0 +1,127 @@
+"""Parser throughput and peak memory on synthetic keepalived.data dumps.
+
+Thresholds are loose on purpose: they catch regressions in complexity (e.g.
+quadratic behaviour, or the whole dump held in memory), not machine speed.
+The throughput depends on the machine anyway, so it is only checked with
+TOOLS_BENCHMARK=1 in the environment.
+"""
+
+import os
+import time
+import tracemalloc
+
+import pytest
+
+from tools.bin import keepalived_status as ks
+
+INSTANCES = 2000
+benchmark = pytest.mark.skipif(
+    not os.environ.get("TOOLS_BENCHMARK"), reason="timing benchmark: set TOOLS_BENCHMARK=1 to run it"
+)
+
+
+def v1_dump(instances: int) -> str:
+    """A keepalived v1 dump: each instance followed by its script."""
+    lines = []
+    for n in range(instances):
+        lines += [
+            f" VRRP Instance = inst{n}",
+            " VRRP Version = 2",
+            f"   State = {'MASTER' if n % 2 else 'BACKUP'}",
+            "   Master router = 192.168.19.132",
+            "   Master priority = 100",
+            f"   Last transition = {1782250831 + n} (Tue Jun 23 22:40:31 2026)",
+            "   Using src_ip = 192.168.19.120",
+            f"   Virtual Router ID = {n % 255}",
+            "   Priority = 80",
+            "   Tracked scripts = 1",
+            f" VRRP Script = chk_{n}",
+            f"   Command = /etc/keepalived/bin/check_{n}.sh",
+            "   Interval = 60 sec",
+            "   Weight = -100",
+            f"   Status = {'BAD' if n % 7 == 0 else 'GOOD'}",
+            "   Virtual IP = 1",
+            f"     10.{n // 65536 % 256}.{n // 256 % 256}.{n % 256}/24 dev eth0 scope global",
+        ]
+    return "\n".join(lines) + "\n"
+
+
+def v2_dump(instances: int) -> str:
+    """A keepalived v2 dump: instances first, then the VRRP Scripts section."""
+    lines = ["------< Global definitions >------", " Router ID = bench", "------< VRRP Topology >------"]
+    for n in range(instances):
+        lines += [
+            f" VRRP Instance = inst{n}",
+            "   VRRP Version = 2",
+            f"   State = {'MASTER' if n % 2 else 'BACKUP'}",
+            "   Wantstate = MASTER",
+            f"   Last transition = {1782548192 + n}.710903 (Sat Jun 27 09:16:32.710903 2026)",
+            "   Interface = wlan0",
+            "   Using src_ip = 192.168.19.226",
+            f"   Virtual Router ID = {n % 255}",
+            "   Priority = 100",
+            f"   Effective priority = {1 if n % 7 == 0 else 100}",
+            "   Virtual IP (1):",
+            f"     10.{n // 65536 % 256}.{n // 256 % 256}.{n % 256}/24 dev wlan0 scope global",
+            "   Tracked scripts :",
+            f"     chk_{n} weight -100",
+        ]
+    lines.append("------< VRRP Scripts >------")
+    for n in range(instances):
+        lines += [
+            f" VRRP Script = chk_{n}",
+            f"   Command = '/etc/keepalived/bin/check_{n}.sh'",
+            "   Weight = -100",
+            f"   Status = {'BAD' if n % 7 == 0 else 'GOOD'}",
+            "   Tracking instances :",
+            f"     inst{n}, weight -100",
+            "   State = idle",
+        ]
+    lines += ["------< Interfaces >------", " Name = wlan0", "   State = UP, RUNNING"]
+    return "\n".join(lines) + "\n"
+
+
+@pytest.fixture(params=[v1_dump, v2_dump], ids=["v1", "v2"])
+def dump_file(request, tmp_path):
+    path = tmp_path / "keepalived.data"
+    text = request.param(INSTANCES)
+    path.write_text(text)
+    return str(path), len(text.splitlines())
+
+
+def _peak_memory(func):
+    tracemalloc.start()
+    try:
+        return func(), tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@benchmark
+def test_parse_file_throughput(dump_file):
+    path, lines = dump_file
+    started = time.perf_counter()
+    instances = list(ks.parse_file(path))
+    elapsed = time.perf_counter() - started
+    assert len(instances) == INSTANCES
+    assert sum(1 for i in instances if i.failing_scripts) == len(range(0, INSTANCES, 7))
+    print(f"{lines / elapsed:,.0f} lines/s ({elapsed * 1000:.0f}ms for {lines} lines)")
+    assert lines / elapsed > 50_000
+
+
+def test_parse_file_peak_memory(dump_file):
+    path, _ = dump_file
+
+    def count_streamed():
+        return sum(1 for _ in ks.parse_file(path))
+
+    def read_and_parse():
+        with open(path, "r") as f:
+            return len(ks.parse(f.read()))
+
+    count, streamed_peak = _peak_memory(count_streamed)
+    assert count == INSTANCES
+    _, text_peak = _peak_memory(read_and_parse)
+    print(f"peak memory: {streamed_peak / 1e6:.1f}MB streamed, {text_peak / 1e6:.1f}MB reading the whole text")
+    # the instances themselves are kept (scripts may refer to them): only the text is saved
+    assert streamed_peak < text_peak
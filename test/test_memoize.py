@@ -0,0 +1,82 @@
+import subprocess
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from tools.libs.memoize import ttl_cache
+
+
+def test_ttl_cache_expiry(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('tools.libs.memoize.time.monotonic', lambda: now[0])
+    func = mock.Mock(side_effect=lambda host, cmd: f'{host}: {cmd}')
+    cached = ttl_cache(ttl=10)(func)
+    assert cached('a', 'ls') == 'a: ls'
+    assert cached('a', 'ls') == 'a: ls'
+    assert func.call_count == 1
+    now[0] += 11
+    assert cached('a', 'ls') == 'a: ls'
+    assert func.call_count == 2
+    assert cached.stats == {'hits': 1, 'misses': 2, 'waits': 0, 'in_flight': 0, 'entries': 1}
+
+
+def test_ttl_cache_maxsize():
+    func = mock.Mock(side_effect=lambda x: x)
+    cached = ttl_cache(maxsize=2)(func)
+    for x in (1, 2, 1, 3):
+        cached(x)
+    # 2 was the least recently used
+    cached(1)
+    cached(2)
+    assert [c.args[0] for c in func.mock_calls] == [1, 2, 3, 2]
+
+
+def test_ttl_cache_errors(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('tools.libs.memoize.time.monotonic', lambda: now[0])
+    func = mock.Mock(side_effect=subprocess.CalledProcessError(1, 'check'))
+    cached = ttl_cache(error_ttl=5, errors=(subprocess.CalledProcessError,))(func)
+    for _ in range(2):
+        with pytest.raises(subprocess.CalledProcessError):
+            cached('host')
+    assert func.call_count == 1
+    now[0] += 6
+    func.side_effect = None
+    func.return_value = 'ok'
+    assert cached('host') == 'ok'
+    # other exceptions are not cached
+    uncached = ttl_cache()(mock.Mock(side_effect=[OSError('boom'), 'ok']))
+    with pytest.raises(OSError):
+        uncached()
+    assert uncached() == 'ok'
+
+
+def test_ttl_cache_single_flight():
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow(key):
+        calls.append(key)
+        started.set()
+        release.wait(5)
+        return key * 2
+
+    cached = ttl_cache()(slow)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cached(21))) for _ in range(5)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    while cached.waits < 4:
+        time.sleep(0.001)
+    assert cached.stats['in_flight'] == 1
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == [42] * 5
+    assert calls == [21]
+    assert cached.stats == {'hits': 0, 'misses': 1, 'waits': 4, 'in_flight': 0, 'entries': 1}
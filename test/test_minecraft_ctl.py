@@ -88,6 +88,15 @@ def mock_subprocess(monkeypatch):
     print(f'{mock_obj} {mock_obj.mock_calls}')
 
 
+@pytest.fixture
+def mock_transport(monkeypatch):
+    mock_obj = mock.MagicMock(name='transport')
+    mock_obj.check_output.return_value = b''
+    monkeypatch.setattr('tools.bin.minecraft_ctl.get_transport', lambda: mock_obj)
+    yield mock_obj
+    print(f'{mock_obj} {mock_obj.mock_calls}')
+
+
 @pytest.fixture
 def mock_log():
     return mock.Mock(name='Logger')
@@ -161,30 +170,21 @@ def test_parse_args_exc():
         parse_args([], 'minecraft_ctl.py')
 
 
-def test_main_on(mock_os_chmod, mock_subprocess):
+def test_main_on(mock_os_chmod, mock_subprocess, mock_transport):
     main(['on'], prog_name='minecraft_ctl')
     mock_os_chmod.assert_has_calls([mock.call('/Applications/Minecraft.app/Contents/MacOS/launcher', 0o755)])
-    mock_subprocess.assert_has_calls(
+    mock_transport.check_output.assert_has_calls(
         [
-            mock.call.check_output(
-                [
-                    'ssh',
-                    '-i',
-                    '/Users/nicola/.ssh/mt_remote',
-                    'manage_internet@mt',
-                    '/ip firewall address-list disable numbers=(10, 11)',
-                ],
+            mock.call(
+                'manage_internet@mt',
+                '/ip firewall address-list disable numbers=(10, 11)',
+                ('-i', '/Users/nicola/.ssh/mt_remote'),
                 stderr=mock_subprocess.PIPE,
             ),
-            mock.call.check_output(
-                [
-                    'ssh',
-                    '-t',
-                    '-i',
-                    '/Users/nicola/.ssh/id_rsa',
-                    'phoenix',
-                    '/usr/local/bin/manage_discord.py enable && /etc/init.d/e2guardian restart || true',
-                ],
+            mock.call(
+                'phoenix',
+                '/usr/local/bin/manage_discord.py enable && /etc/init.d/e2guardian restart || true',
+                ('-t', '-i', '/Users/nicola/.ssh/id_rsa'),
                 stderr=mock_subprocess.PIPE,
             ),
         ],
@@ -193,30 +193,21 @@ def test_main_on(mock_os_chmod, mock_subprocess):
 
 
 @pytest.mark.xfail(reason='mock_os_kill.assert_called_with(15) not called')
-def test_main_off(mock_os_chmod, mock_os_kill, mock_subprocess):
+def test_main_off(mock_os_chmod, mock_os_kill, mock_subprocess, mock_transport):
     main(['off'], prog_name='minecraft_ctl')
     mock_os_chmod.assert_has_calls([mock.call('/Applications/Minecraft.app/Contents/MacOS/launcher', 0)])
-    mock_subprocess.assert_has_calls(
+    mock_transport.check_output.assert_has_calls(
         [
-            mock.call.check_output(
-                [
-                    'ssh',
-                    '-i',
-                    '/Users/nicola/.ssh/mt_remote',
-                    'manage_internet@mt',
-                    '/ip firewall address-list enable numbers=(10, 11)',
-                ],
+            mock.call(
+                'manage_internet@mt',
+                '/ip firewall address-list enable numbers=(10, 11)',
+                ('-i', '/Users/nicola/.ssh/mt_remote'),
                 stderr=mock_subprocess.PIPE,
             ),
-            mock.call.check_output(
-                [
-                    'ssh',
-                    '-t',
-                    '-i',
-                    '/Users/nicola/.ssh/id_rsa',
-                    'phoenix',
-                    '/usr/local/bin/manage_discord.py disable && /etc/init.d/e2guardian restart || true',
-                ],
+            mock.call(
+                'phoenix',
+                '/usr/local/bin/manage_discord.py disable && /etc/init.d/e2guardian restart || true',
+                ('-t', '-i', '/Users/nicola/.ssh/id_rsa'),
                 stderr=mock_subprocess.PIPE,
             ),
         ],
@@ -225,41 +216,22 @@ def test_main_off(mock_os_chmod, mock_os_kill, mock_subprocess):
     mock_os_kill.assert_called_with(15)
 
 
-def test_main_status(mock_os_chmod, mock_subprocess, monkeypatch):
+def test_main_status(mock_os_chmod, mock_subprocess, mock_transport, monkeypatch):
     with monkeypatch.context() as m:
         mock_os_stat = mock.MagicMock(name='stat')
         mock_os_stat.side_effect = os_stat
         m.setattr('tools.bin.minecraft_ctl.os.stat', mock_os_stat)
         main(['status'], prog_name='minecraft_ctl')
     mock_os_chmod.assert_not_called()
-    mock_subprocess.check_output.assert_has_calls(
-        [
-            mock.call(['ps', 'auxwww'], stderr=mock_subprocess.PIPE),
-            mock.call(
-                [
-                    'ssh',
-                    '-i',
-                    '/Users/nicola/.ssh/mt_remote',
-                    'manage_internet@mt',
-                    '/ip firewall address-list print from=10,11',
-                ],
-                stderr=mock_subprocess.PIPE,
-            ),
-        ]
-    )
     for launcher in DEFAULTS['minecraft_ctl']['launcher']:
         mock_os_stat.assert_has_calls([mock.call(launcher)])
     mock_subprocess.check_output.assert_has_calls([mock.call(['ps', 'auxwww'], stderr=mock_subprocess.PIPE)])
-    mock_subprocess.check_output.assert_has_calls(
+    mock_transport.check_output.assert_has_calls(
         [
             mock.call(
-                [
-                    'ssh',
-                    '-i',
-                    '/Users/nicola/.ssh/mt_remote',
-                    'manage_internet@mt',
-                    '/ip firewall address-list print from=10,11',
-                ],
+                'manage_internet@mt',
+                '/ip firewall address-list print from=10,11',
+                ('-i', '/Users/nicola/.ssh/mt_remote'),
                 stderr=mock_subprocess.PIPE,
             )
         ]
@@ -1,11 +1,23 @@
+import logging
 import socket
 from unittest import mock
 
+import dns.zone
 import pytest
 
 from tools.libs import net_utils
 
 
+ADDRESSES = {'a': '10.0.0.1', 'b': '10.0.0.2', 'other': '1.1.1.1', 'more': '1.1.1.2'}
+
+
+def fake_gethostbyname(name):
+    try:
+        return ADDRESSES[name]
+    except KeyError:
+        raise socket.gaierror(f'{name} not found')
+
+
 @pytest.fixture
 def mock_socket(monkeypatch):
     mock_socket = mock.Mock(name='socket')
@@ -13,6 +25,7 @@ def mock_socket(monkeypatch):
     mock_socket.gethostname.return_value = 'local_host'
     monkeypatch.setattr('tools.libs.net_utils.socket', mock_socket)
     mock_socket.gaierror = socket.gaierror
+    net_utils.resolver.cache_clear()
     yield mock_socket
     print(f'{mock_socket} {mock_socket.mock_calls}')
 
@@ -24,20 +37,122 @@ def test_hosts_if_not_me(mock_socket):
 
 
 def test_hosts_if_not_me_exc(mock_socket):
-    net_utils.gethostbyname.cache_clear()
     mock_socket.gethostname.return_value = 'myfqdn'
-    # mock_socket.gethostbyname.side_effect = [socket.gaierror]
     assert list(net_utils.hosts_if_not_me(['myfqdn'])) == []
-    net_utils.gethostbyname.cache_clear()
     mock_socket.gethostbyname.side_effect = socket.gaierror
     assert list(net_utils.hosts_if_not_me(['other', 'myfqdn'])) == []
-    net_utils.gethostbyname.cache_clear()
-    mock_socket.gethostbyname.side_effect = [socket.gaierror, '1.1.1.1']
-    assert list(net_utils.hosts_if_not_me(['this', 'other', 'myfqdn'])) == [
-        net_utils.Host(hostname='other', ip='1.1.1.1')
+    net_utils.resolver.cache_clear()
+    mock_socket.gethostbyname.side_effect = fake_gethostbyname
+    assert list(net_utils.hosts_if_not_me(['this', 'other', 'myfqdn', 'more'])) == [
+        net_utils.Host(hostname='other', ip='1.1.1.1'),
+        net_utils.Host(hostname='more', ip='1.1.1.2'),
     ]
 
 
-def test_ip_if_not_local(mock_socket):
+def test_ip_if_not_local(mock_socket, monkeypatch):
+    monkeypatch.setattr(net_utils.local_addresses, '_read', lambda: frozenset({'192.168.19.65'}))
+    mock_socket.gethostbyname.side_effect = ['1.1.1.1', '2.2.2.2', '192.168.19.65', '127.0.1.1']
     assert net_utils.ip_if_not_local('local_host') is None
     assert net_utils.ip_if_not_local('test') == '2.2.2.2'
+    assert net_utils.ip_if_not_local('vip') is None
+    assert net_utils.ip_if_not_local('loopback') is None
+
+
+def test_resolver_cache(mock_socket, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('tools.libs.net_utils.time.monotonic', lambda: now[0])
+    resolver = net_utils.Resolver(ttl=10, negative_ttl=1, max_entries=2)
+    mock_socket.gethostbyname.side_effect = fake_gethostbyname
+    assert resolver.resolve('a') == '10.0.0.1'
+    with pytest.raises(socket.gaierror):
+        resolver.resolve('missing')
+    # negative answers are cached too
+    with pytest.raises(socket.gaierror):
+        resolver.resolve('missing')
+    assert mock_socket.gethostbyname.call_count == 2
+    assert resolver.stats == {'hits': 1, 'misses': 2, 'entries': 2}
+    now[0] += 2
+    answers = resolver.resolve_many(['a', 'b', 'missing', 'a'])
+    assert answers['a'] == '10.0.0.1' and answers['b'] == '10.0.0.2'
+    assert isinstance(answers['missing'], socket.gaierror)
+    assert mock_socket.gethostbyname.call_count == 4
+    # bounded: 'a' was the least recently used
+    assert resolver.stats['entries'] == 2
+    now[0] += 10
+    assert resolver.resolve('b') == '10.0.0.2'
+    assert mock_socket.gethostbyname.call_count == 5
+
+
+ZONE = """
+@ 3600 IN SOA ns.canne. admin.canne. {serial} 3600 600 86400 300
+@ 3600 IN NS ns
+ns 3600 IN A 10.0.0.1
+raspy2 3600 IN A 10.0.0.2
+raspy2 3600 IN TXT "linux" "Pi"
+bigmac 3600 IN A 10.0.0.3
+bigmac 3600 IN TXT "mac"
+{extra}
+"""
+
+
+@pytest.fixture
+def mock_dns(monkeypatch):
+    """ A zone server: ``mock_dns.serial``/``mock_dns.extra`` change the zone, transfers are recorded in ``xfrs`` """
+    mock_dns = mock.Mock(name='dns', serial=1, extra='', xfrs=[])
+
+    def resolve(name, rdtype):
+        if rdtype == 'SOA':
+            return [mock.Mock(serial=mock_dns.serial, mname='ns.canne.')]
+        return [mock.Mock(address='10.0.0.1')]
+
+    def inbound_xfr(where, zone, query):
+        rdtype = dns.rdatatype.to_text(query.question[0].rdtype)
+        mock_dns.xfrs.append(rdtype)
+        served = dns.zone.from_text(ZONE.format(serial=mock_dns.serial, extra=mock_dns.extra), origin='canne')
+        with zone.writer(replacement=True) as txn:
+            for name, node in served.items():
+                for rdataset in node:
+                    txn.replace(name, rdataset)
+
+    monkeypatch.setattr('tools.libs.net_utils.dns.resolver.resolve', resolve)
+    monkeypatch.setattr('tools.libs.net_utils.dns.query.inbound_xfr', inbound_xfr)
+    yield mock_dns
+    print(mock_dns.xfrs)
+
+
+def test_hosts_from_dns_tags(mock_dns, tmp_path):
+    all_hosts = net_utils.hosts_from_dns('canne', logging.getLogger(), str(tmp_path))
+    assert all_hosts == {'linux': {'raspy2'}, 'mac': {'bigmac'}, 'pi': {'raspy2'}}
+    assert mock_dns.xfrs == ['AXFR']
+
+
+def test_hosts_from_dns_no_tags(mock_dns):
+    with mock.patch.object(net_utils.Inventory, 'from_zone', return_value=net_utils.Inventory('canne', 1, '')):
+        assert net_utils.hosts_from_dns('canne', logging.getLogger(), None) == {'linux': set(), 'mac': set()}
+
+
+def test_load_inventory_cache(mock_dns, tmp_path):
+    log = logging.getLogger()
+    inventory = net_utils.load_inventory('canne', log, str(tmp_path))
+    assert inventory.serial == 1
+    assert net_utils.Inventory.load(net_utils.inventory_path('canne', str(tmp_path))) == inventory
+    # same serial: no transfer at all
+    assert net_utils.load_inventory('canne', log, str(tmp_path)) == inventory
+    assert mock_dns.xfrs == ['AXFR']
+    # new serial: incremental transfer on top of the cached zone
+    mock_dns.serial = 2
+    mock_dns.extra = 'octopi 3600 IN TXT "linux" "printer"'
+    inventory = net_utils.load_inventory('canne', log, str(tmp_path))
+    assert mock_dns.xfrs == ['AXFR', 'IXFR']
+    assert inventory.serial == 2
+    assert inventory.hosts('linux') == {'raspy2', 'octopi'}
+    assert inventory.hosts('printer', 'mac') == {'octopi', 'bigmac'}
+
+
+def test_load_inventory_soa_failure(mock_dns, tmp_path, monkeypatch):
+    log = logging.getLogger()
+    inventory = net_utils.load_inventory('canne', log, str(tmp_path))
+    monkeypatch.setattr('tools.libs.net_utils.dns.resolver.resolve', mock.Mock(side_effect=dns.resolver.NoNameservers))
+    assert net_utils.load_inventory('canne', log, str(tmp_path)) == inventory
+    with pytest.raises(dns.resolver.NoNameservers):
+        net_utils.load_inventory('canne', log, None)
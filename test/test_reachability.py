@@ -0,0 +1,75 @@
+import socket
+from unittest import mock
+
+import pytest
+
+from tools.libs import reachability
+from tools.libs.reachability import Reachability, icmp_probe, probe, probe_many, tcp_probe
+
+
+@pytest.fixture
+def mock_ping(monkeypatch):
+    mock_obj = mock.Mock(name='ping')
+    monkeypatch.setattr(reachability.ping3, 'ping', mock_obj)
+    yield mock_obj
+    print(f'{mock_obj} {mock_obj.mock_calls}')
+
+
+@pytest.fixture
+def server():
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen()
+    yield server.getsockname()[1]
+    server.close()
+
+
+def test_icmp_probe_stops_at_first_reply(mock_ping):
+    mock_ping.side_effect = [None, 0.002, 0.001]
+    result = icmp_probe('host', count=3)
+    assert result == Reachability('host', rtt=0.002, sent=2, lost=1)
+    assert result.loss == 0.5
+    assert str(result) == 'host: 2.0ms (icmp, 50% loss)'
+    assert mock_ping.call_count == 2
+
+
+def test_icmp_probe_no_reply(mock_ping):
+    mock_ping.return_value = None
+    result = icmp_probe('host', count=2)
+    assert not result.reachable
+    assert result.loss == 1.0
+    # a single echo by default: a down host costs one timeout
+    mock_ping.reset_mock()
+    assert icmp_probe('host').sent == 1
+    assert mock_ping.call_count == 1
+
+
+@pytest.mark.parametrize('answer', (False, PermissionError(1, 'Operation not permitted')))
+def test_icmp_probe_unavailable(mock_ping, answer):
+    mock_ping.side_effect = [answer]
+    assert icmp_probe('host') is None
+
+
+def test_tcp_probe(server):
+    assert tcp_probe('127.0.0.1', server).reachable
+    closed = socket.socket()
+    closed.bind(('127.0.0.1', 0))
+    port = closed.getsockname()[1]
+    closed.close()
+    result = tcp_probe('127.0.0.1', port)
+    assert (result.reachable, result.method, result.loss) == (False, 'tcp', 1.0)
+
+
+def test_probe_falls_back_to_tcp(mock_ping, server):
+    mock_ping.return_value = False
+    result = probe('127.0.0.1', port=server)
+    assert (result.reachable, result.method) == (True, 'tcp')
+
+
+def test_probe_many(mock_ping):
+    mock_ping.side_effect = lambda host, timeout: 0.001 if host == 'up' else None
+    with mock.patch.object(reachability, 'tcp_probe', lambda host, port, timeout: Reachability(host, sent=1, lost=1)):
+        results = probe_many(['up', 'down', 'up'], count=2)
+    assert list(results) == ['up', 'down']
+    assert results['up'].rtt == 0.001
+    assert not results['down'].reachable
@@ -0,0 +1,95 @@
+import json
+import os
+from unittest import mock
+
+import pytest
+
+from tools.libs import service_index
+from tools.libs.service_index import DecodeFirstLineException, ServiceIndex, load_services, parse_service
+
+FLASK = '''# {"vrrp": ["phoenix", "raspy2"], "id": 69}
+vrrp_instance FLASK {  # the web app
+  virtual_router_id 69
+  virtual_ipaddress {
+    "192.168.19.69/24" dev eth0
+  }
+  track_script {
+    script "/usr/local/bin/check_flask.sh"
+  }
+}
+'''
+
+
+@pytest.fixture
+def config_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(service_index, 'INDEX_DIR', str(tmp_path / 'index'))
+    path = tmp_path / 'keepalived.d'
+    path.mkdir()
+    (path / 'flask.conf').write_text(FLASK)
+    (path / 'dns.conf').write_text('# {"vrrp": ["raspy3"], "id": 53}\nvrrp_instance DNS {\n}\n')
+    (path / 'notes.txt').write_text('not a config')
+    return path
+
+
+@pytest.fixture
+def mock_parse(monkeypatch):
+    mock_obj = mock.Mock(name='parse_service', side_effect=parse_service)
+    monkeypatch.setattr(service_index, 'parse_service', mock_obj)
+    yield mock_obj
+    print(f'{mock_obj} {mock_obj.mock_calls}')
+
+
+def test_parse_service(config_dir):
+    entry = parse_service(str(config_dir / 'flask.conf'))
+    assert (entry.name, entry.vrid, entry.ip, entry.hosts) == ('FLASK', '69', '192.168.19.69/24', ['phoenix', 'raspy2'])
+    assert entry.check_script == '/usr/local/bin/check_flask.sh'
+    assert parse_service(str(config_dir / 'dns.conf')).check_script == '/etc/keepalived/bin/check_dns.sh'
+
+
+def test_parse_service_bad_header(tmp_path):
+    conf = tmp_path / 'bad.conf'
+    conf.write_text('vrrp_instance BAD {\n}\n')
+    with pytest.raises(DecodeFirstLineException):
+        parse_service(str(conf))
+
+
+def test_load_services_incremental(config_dir, mock_parse):
+    assert [s.name for s in load_services(str(config_dir))] == ['DNS', 'FLASK']
+    assert mock_parse.call_count == 2
+    # unchanged: read from the index only
+    assert [s.ip for s in load_services(str(config_dir))] == ['192.168.19.53/24', '192.168.19.69/24']
+    assert mock_parse.call_count == 2
+    (config_dir / 'dns.conf').write_text('# {"vrrp": ["raspy3", "octopi"], "id": 53}\nvrrp_instance DNS {\n}\n')
+    os.remove(config_dir / 'flask.conf')
+    assert [(s.name, s.hosts) for s in load_services(str(config_dir))] == [('DNS', ['raspy3', 'octopi'])]
+    assert [c.args[0] for c in mock_parse.mock_calls[2:]] == [str(config_dir / 'dns.conf')]
+
+
+def test_load_services_broken_file(config_dir, mock_parse):
+    (config_dir / 'bad.conf').write_text('no header\n')
+    index = ServiceIndex.load(str(config_dir))
+    index.update()
+    assert list(index.errors) == [str(config_dir / 'bad.conf')]
+    assert len(load_services(str(config_dir))) == 2
+    # not parsed again until it changes
+    assert mock_parse.call_count == 3
+    (config_dir / 'bad.conf').write_text('# {"vrrp": ["octopi"]}\nvrrp_instance GOOD {\n}\n')
+    assert [s.name for s in load_services(str(config_dir))] == ['GOOD', 'DNS', 'FLASK']
+
+
+def test_load_services_stale_index(config_dir, mock_parse):
+    load_services(str(config_dir))
+    path = service_index.index_path(str(config_dir))
+    with open(path) as f:
+        data = json.load(f)
+    data['version'] = 0
+    with open(path, 'w') as f:
+        json.dump(data, f)
+    assert len(load_services(str(config_dir))) == 2
+    assert mock_parse.call_count == 4
+
+
+def test_load_services_missing_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(service_index, 'INDEX_DIR', str(tmp_path / 'index'))
+    assert load_services(str(tmp_path / 'missing')) == []
+    assert not os.path.exists(tmp_path / 'index')
@@ -71,6 +71,15 @@ def mock_subprocess(monkeypatch):
     print(f'{mock_obj} {mock_obj.mock_calls}')
 
 
+@pytest.fixture
+def mock_transport(monkeypatch):
+    mock_obj = mock.Mock(name='transport')
+    mock_obj.check_output.return_value.decode.return_value = 'my_content'
+    monkeypatch.setattr('tools.bin.service_map.get_transport', lambda: mock_obj)
+    yield mock_obj
+    print(f'{mock_obj} {mock_obj.mock_calls}')
+
+
 @pytest.fixture
 def mock_walk(monkeypatch):
     mock_obj = mock.Mock(name='os.walk')
@@ -96,10 +105,10 @@ def test_ServiceCatalog(mock_ip_if_not_local, mock_open, mock_subprocess, mock_w
     mock_open.assert_called_with('base_dir.d/zzz.conf', 'r')
 
 
-def test_ServiceConfig(mock_ip_if_not_local, mock_open, mock_subprocess, mock_walk):
+def test_ServiceConfig(mock_ip_if_not_local, mock_open, mock_transport, mock_walk):
     sc = ServiceConfig('testhost', 'keepalived')
     assert sc['base_dir/testfile.conf'] == 'my_content'
-    mock_subprocess.check_output.assert_called_with(['ssh', 'testhost', 'cat', 'base_dir/testfile.conf'])
+    mock_transport.check_output.assert_called_with('testhost', ['cat', 'base_dir/testfile.conf'])
 
 
 def test_main(mock_open, mock_subprocess, mock_walk):
@@ -1,4 +1,8 @@
+import json
 import os
+import re
+import subprocess
+import time
 from unittest import mock
 
 import click
@@ -6,19 +10,43 @@ import pytest
 from click.testing import CliRunner
 
 from conftest import mapped_mock_open
-from tools.bin.simple_service_map import main, show_services, Host
+from tools.libs.reachability import Reachability
+from tools.libs.service_index import parse_service
+from tools.bin import simple_service_map
+from tools.bin.simple_service_map import (
+    _remote_command, format_age, main, parse_probe_output, probe_script, show_services, Host, Service, StatusCache,
+    PROBE_MARKER
+)
+
+
+def fake_probe(script):
+    """ What probe_script would print: AAA is MASTER, the rest BACKUP, all the checks pass """
+    output = []
+    for kind, name in re.findall(rf"'{PROBE_MARKER} (state|check) (\S+)'", script):
+        output.append(f"{PROBE_MARKER} {kind} {name}")
+        if kind == "state":
+            output.append(f"now - {'MASTER' if name == 'AAA' else 'BACKUP'} - INSTANCE")
+        output.append(f"{PROBE_MARKER} rc 0")
+    return "\n".join(output) + "\n"
 
 
 def my_check_output(*args, **kwargs):
-    if args[0][0] == "ping":
-        if args[0][-1] != "phoenix":
-            raise Exception(args, kwargs)
     if args[0][0] == "bash":
+        if PROBE_MARKER in args[0][-1]:
+            return fake_probe(args[0][-1])
         if "AAA.state" in args[0][-1]:
             return "now - MASTER - INSTANCE"
     return '20240226084734 - BACKUP - INSTANCE'
 
 
+@pytest.fixture(autouse=True)
+def status_cache_file(monkeypatch, tmp_path):
+    path = str(tmp_path / "service_map_status.json")
+    monkeypatch.setattr(simple_service_map, "STATUS_CACHE_FILE", path)
+    monkeypatch.setattr(Host, "status_cache", StatusCache())
+    yield path
+
+
 @pytest.fixture
 def mock_check_output(monkeypatch):
     mock_obj = mock.Mock(name='check_output')
@@ -28,15 +56,29 @@ def mock_check_output(monkeypatch):
     print(f'{mock_obj} {mock_obj.mock_calls}')
 
 
+def fake_reachability(host, *args, **kwargs):
+    if host == "phoenix":
+        return Reachability(host, rtt=0.001, sent=1)
+    return Reachability(host, sent=3, lost=3)
+
+
 @pytest.fixture
-def mock_glob(monkeypatch):
-    mock_obj = mock.Mock(name='glob')
-    mock_obj.return_value = [
-        '/etc/keepalived/keepalived.d/aaa.conf',
-        '/etc/keepalived/keepalived.d/foobar.conf',
-        '/etc/keepalived/keepalived.d/zzz.conf',
-    ]
-    monkeypatch.setattr('tools.bin.simple_service_map.glob', mock_obj)
+def mock_probe(monkeypatch):
+    mock_obj = mock.Mock(name='probe')
+    mock_obj.side_effect = fake_reachability
+    monkeypatch.setattr('tools.bin.simple_service_map.probe', mock_obj)
+    mock_obj.many = mock.Mock(name='probe_many')
+    mock_obj.many.side_effect = lambda hosts: {host: fake_reachability(host) for host in hosts}
+    monkeypatch.setattr('tools.bin.simple_service_map.probe_many', mock_obj.many)
+    yield mock_obj
+    print(f'{mock_obj} {mock_obj.mock_calls} {mock_obj.many.mock_calls}')
+
+
+@pytest.fixture
+def mock_index(monkeypatch):
+    mock_obj = mock.Mock(name='load_services')
+    mock_obj.side_effect = lambda config_dir: [parse_service(fname) for fname in sorted(KA_CONFS)]
+    monkeypatch.setattr('tools.bin.simple_service_map.load_services', mock_obj)
     yield mock_obj
     print(f'{mock_obj} {mock_obj.mock_calls}')
 
@@ -47,19 +89,22 @@ def mock_ip_if_not_local(monkeypatch):
     resolve_dict = {"phoenix": None, "raspy2": "127.0.0.1", "other": "127.0.0.2"}
     mock_obj.side_effect = resolve_dict.get
     monkeypatch.setattr('tools.bin.simple_service_map.ip_if_not_local', mock_obj)
+    mock_obj.resolver = mock.Mock(name='resolver')
+    monkeypatch.setattr('tools.bin.simple_service_map.resolver', mock_obj.resolver)
     yield mock_obj
     print(f'{mock_obj} {mock_obj.mock_calls}')
 
 
+KA_CONFS = {
+    '/etc/keepalived/keepalived.d/aaa.conf': '# {"vrrp": ["phoenix"]}\nvrrp_instance AAA {\n state MASTER}',
+    '/etc/keepalived/keepalived.d/foobar.conf': '# {"vrrp": ["raspy2"]}\nvrrp_instance foobar {\n}',
+    '/etc/keepalived/keepalived.d/zzz.conf': '# {"vrrp": ["other", "phoenix"]}\nvrrp_instance zzz {',
+}
+
+
 @pytest.fixture
 def mock_open(monkeypatch):
-    mock_obj = mapped_mock_open(
-        {
-            '/etc/keepalived/keepalived.d/aaa.conf': '# {"vrrp": ["phoenix"]}\nvrrp_instance AAA {\n state MASTER}',
-            '/etc/keepalived/keepalived.d/foobar.conf': '# {"vrrp": ["raspy2"]}\nvrrp_instance foobar {\n}',
-            '/etc/keepalived/keepalived.d/zzz.conf': '# {"vrrp": ["other", "phoenix"]}\nvrrp_instance zzz {',
-        }
-    )
+    mock_obj = mapped_mock_open(KA_CONFS)
     monkeypatch.setattr('builtins.open', mock_obj)
     yield mock_obj
     print(f'{mock_obj} {mock_obj.mock_calls}')
@@ -87,15 +132,24 @@ def test_show_services(input_dict, output_list):
     assert list(show_services(input_dict)) == output_list
 
 
-def test_main(mock_open, mock_check_output, mock_glob, mock_ip_if_not_local, mock_os):
+def test_main(mock_open, mock_check_output, mock_index, mock_ip_if_not_local, mock_os, mock_probe):
     Host.status_cache.clear()
     runner = CliRunner()
     result = runner.invoke(main, [])
     assert result.output == "phoenix: +AAA, zzz\nLegend: +active, running\n"
     assert result.exit_code == 0
+    assert sorted(mock_ip_if_not_local.resolver.resolve_many.call_args[0][0]) == [
+        "other", "phoenix", "phoenix", "raspy2"
+    ]
+    # all the hosts pinged at once, then a single probe for all the services of phoenix
+    assert mock_probe.many.call_count == 1
+    assert mock_probe.call_count == 0
+    bash_calls = [c.args[0][-1] for c in mock_check_output.mock_calls]
+    assert len(bash_calls) == 1
+    assert "/tmp/AAA.state" in bash_calls[0] and "check_zzz.sh" in bash_calls[0]
 
 
-def test_main_per_service(mock_open, mock_check_output, mock_glob, mock_ip_if_not_local, mock_os):
+def test_main_per_service(mock_open, mock_check_output, mock_index, mock_ip_if_not_local, mock_os, mock_probe):
     Host.status_cache.clear()
     runner = CliRunner()
     result = runner.invoke(main, ["-s"])
@@ -103,13 +157,131 @@ def test_main_per_service(mock_open, mock_check_output, mock_glob, mock_ip_if_no
     assert result.exit_code == 0
 
 
-def test_is_reachable(mock_check_output, mock_ip_if_not_local):
+def test_is_reachable(mock_check_output, mock_ip_if_not_local, mock_probe):
     Host.status_cache.clear()
 
-    assert Host("phoenix").is_reachable
+    host = Host("phoenix")
+    assert host.is_reachable
+    assert host.reachability.rtt == 0.001
+    # no ssh round trip just to check the host
+    assert mock_check_output.call_count == 0
 
 
-def test_is_reachable_exc(mock_check_output):
+def test_is_reachable_exc(mock_check_output, mock_probe):
     Host.status_cache.clear()
 
     assert Host("some_host").is_reachable is False
+
+
+def test_probe_script_runs(mock_open, mock_os, tmp_path):
+    service = Service('/etc/keepalived/keepalived.d/foobar.conf')
+    service.check_script
+    service._check_script = "exit 3"
+    output = subprocess.check_output(['bash', '-c', probe_script([service])], universal_newlines=True)
+    assert parse_probe_output(output) == {("state", "foobar"): (1, ""), ("check", "foobar"): (3, "")}
+
+
+def test_parse_probe_output():
+    output = (
+        f"{PROBE_MARKER} state AAA\n20240226084734 - MASTER - INSTANCE\n\n{PROBE_MARKER} rc 0\n"
+        f"{PROBE_MARKER} check AAA\n{PROBE_MARKER} rc 1\n"
+        f"{PROBE_MARKER} state zzz\n"  # cut short
+    )
+    assert parse_probe_output(output) == {
+        ("state", "AAA"): (0, "20240226084734 - MASTER - INSTANCE"),
+        ("check", "AAA"): (1, ""),
+    }
+
+
+def test_probe_services(mock_open, mock_check_output, mock_index, mock_ip_if_not_local, mock_os):
+    Host.status_cache.clear()
+    _remote_command.cache_clear()
+    services = [Service(f'/etc/keepalived/keepalived.d/{name}.conf') for name in ("aaa", "zzz", "foobar")]
+    host = Host("phoenix")
+    host.probe_services(services)
+    assert Host.status_cache["phoenix"] == {"+AAA": True, "AAA": True, "+zzz": False, "zzz": True}
+    assert mock_check_output.call_count == 1
+    # served from the cache
+    assert host.check_active_services(services) == ["+AAA", "zzz"]
+    assert mock_check_output.call_count == 1
+
+
+def test_probe_services_ssh_failure(mock_open, mock_index, mock_ip_if_not_local, mock_os, mock_probe, monkeypatch):
+    Host.status_cache.clear()
+    _remote_command.cache_clear()
+
+    def ssh_failure(host, cmd):
+        raise subprocess.CalledProcessError(255, cmd, "ssh: connect to host raspy2 port 22: Connection refused")
+
+    monkeypatch.setattr('tools.bin.simple_service_map._remote_command', ssh_failure)
+    host = Host("raspy2")
+    host.reachability = Reachability("raspy2", rtt=0.001, sent=1)
+    assert host.is_reachable
+    assert host.check_active_services([Service('/etc/keepalived/keepalived.d/foobar.conf')]) is None
+    assert not host.is_reachable
+
+
+def test_status_cache_expiry():
+    cache = StatusCache(max_age={"ping": 60, "state": 10, "check": 0})
+    cache["host"]["ping"] = True
+    cache["host"]["+AAA"] = True
+    cache["host"]["AAA"] = True
+    cache.entries["host"]["+AAA"][1] -= 11
+    assert dict(cache["host"]) == {"ping": True}
+    with pytest.raises(KeyError):
+        cache["host"]["+AAA"]
+    # probed by this run: no age to show
+    assert cache.age("host", "ping") is None
+
+
+def test_status_cache_save_merges(status_cache_file):
+    now = time.time()
+    first = StatusCache.load()
+    first["phoenix"]["ping"] = True
+    second = StatusCache.load()
+    second["raspy2"]["ping"] = False
+    first.save()
+    second.save()
+    with open(status_cache_file) as f:
+        saved = json.load(f)
+    assert sorted(saved) == ["phoenix", "raspy2"]
+    # a result older than the one on disk does not replace it
+    stale = StatusCache(status_cache_file, entries={"phoenix": {"ping": [False, now - 5]}}, dirty=True)
+    stale.save()
+    later = StatusCache.load(started=time.time() + 1)
+    assert later["phoenix"]["ping"] is True
+    assert 0 <= later.age("phoenix", "ping") < 2
+    assert StatusCache.load(refresh=True, started=time.time() + 1).age("phoenix", "ping") is None
+
+
+@pytest.mark.parametrize("seconds,text", ((5, "5s"), (75, "1m"), (7300, "2h")))
+def test_format_age(seconds, text):
+    assert format_age(seconds) == text
+
+
+def test_main_cached(
+    mock_check_output, mock_index, mock_ip_if_not_local, mock_os, mock_probe, status_cache_file, monkeypatch
+):
+    builtin_open = open
+
+    def opener(fname, *args, **kwargs):
+        if fname == status_cache_file:
+            return builtin_open(fname, *args, **kwargs)
+        # fresh file objects for each run
+        return mapped_mock_open(KA_CONFS)(fname, *args, **kwargs)
+
+    monkeypatch.setattr('builtins.open', opener)
+    runner = CliRunner()
+    assert runner.invoke(main, []).output == "phoenix: +AAA, zzz\nLegend: +active, running\n"
+    _remote_command.cache_clear()
+    # a later run
+    mock_check_output.reset_mock()
+    mock_probe.many.reset_mock()
+    result = runner.invoke(main, [])
+    assert result.exit_code == 0
+    assert click.unstyle(result.output) == "phoenix: +AAA (cached 0s), zzz (cached 0s)\nLegend: +active, running\n"
+    assert mock_check_output.call_count == 0
+    assert list(mock_probe.many.call_args[0][0]) == []
+    result = runner.invoke(main, ["--refresh"])
+    assert click.unstyle(result.output) == "phoenix: +AAA, zzz\nLegend: +active, running\n"
+    assert mock_check_output.call_count == 1
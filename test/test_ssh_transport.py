@@ -0,0 +1,137 @@
+import asyncio
+import subprocess
+import time
+from unittest import mock
+
+import pytest
+
+from tools.libs.ssh_transport import CONNECTION_ERROR, SSHTransport, Timings
+
+
+@pytest.fixture
+def transport(tmp_path):
+    return SSHTransport(control_dir=str(tmp_path / 'cm'))
+
+
+@pytest.fixture
+def mock_subprocess_run(monkeypatch):
+    mock_obj = mock.Mock(name='run')
+    mock_obj.return_value.returncode = 0
+    monkeypatch.setattr('tools.libs.ssh_transport.subprocess.run', mock_obj)
+    yield mock_obj
+    print(f'{mock_obj} {mock_obj.mock_calls}')
+
+
+def test_ssh_args(transport, tmp_path):
+    args = transport.ssh_args('host', 'ls -l', ['-i', 'key'])
+    assert args[:3] == ['ssh', '-i', 'key']
+    assert f'ControlPath={tmp_path}/cm/%C' in args
+    assert 'ControlPersist=60' in args
+    assert args[-2:] == ['host', 'ls -l']
+    assert (tmp_path / 'cm').is_dir()
+
+
+def test_ssh_args_list_no_multiplex(tmp_path):
+    transport = SSHTransport(control_dir=str(tmp_path / 'cm'), multiplex=False)
+    assert transport.ssh_args('host', ['cat', 'file']) == ['ssh', '-o', 'ConnectTimeout=5', 'host', 'cat', 'file']
+
+
+STALE_MASTER = b'mux_client_request_session: read from master failed: Broken pipe\r\n'
+
+
+def test_run_retries_stale_master(transport, mock_subprocess_run):
+    failed = mock.Mock(returncode=CONNECTION_ERROR, stderr=STALE_MASTER)
+    mock_subprocess_run.side_effect = [failed, mock.Mock(returncode=0), mock.Mock(returncode=0)]
+    assert transport.run('host', 'ls', stderr=subprocess.PIPE).returncode == 0
+    assert mock_subprocess_run.call_args_list[1][0][0][-3:] == ['-O', 'exit', 'host']
+    assert mock_subprocess_run.call_count == 3
+
+
+def test_run_retries_stale_master_merged_output(transport, mock_subprocess_run):
+    failed = mock.Mock(returncode=CONNECTION_ERROR, stdout=STALE_MASTER.decode(), stderr=None)
+    mock_subprocess_run.side_effect = [failed, mock.Mock(returncode=0), mock.Mock(returncode=0)]
+    assert transport.run('host', 'ls', stdout=subprocess.PIPE, stderr=subprocess.STDOUT).returncode == 0
+
+
+@pytest.mark.parametrize(
+    'stderr',
+    (
+        b'ssh: connect to host host port 22: Connection refused\r\n',
+        b'E: Could not get lock /var/lib/dpkg/lock-frontend\n',  # the remote command exited 255
+    ),
+)
+def test_run_no_retry(transport, mock_subprocess_run, stderr):
+    mock_subprocess_run.return_value = mock.Mock(returncode=CONNECTION_ERROR, stderr=stderr)
+    assert transport.run('host', 'apt-get -y upgrade', stderr=subprocess.PIPE).returncode == CONNECTION_ERROR
+    assert mock_subprocess_run.call_count == 1
+
+
+@pytest.mark.parametrize(
+    'check_stderr,reset',
+    (
+        (b'Control socket connect(/home/u/.ssh/cm/abc): Connection refused\r\n', True),
+        (b'mux_client_hello_exchange: read packet failed: Broken pipe\r\n', True),
+        (b'Control socket connect(/home/u/.ssh/cm/abc): No such file or directory\r\n', False),
+        (b'Master running (pid=4242)\r\n', False),
+    ),
+)
+def test_run_uncaptured_checks_master(transport, mock_subprocess_run, check_stderr, reset):
+    check = mock.Mock(returncode=0 if check_stderr.startswith(b'Master') else CONNECTION_ERROR, stderr=check_stderr)
+    mock_subprocess_run.side_effect = [check, mock.Mock(returncode=0), mock.Mock(returncode=CONNECTION_ERROR)]
+    # not captured: can't tell a stale master from the command failing afterwards, so it is never retried
+    assert transport.run('host', 'apt-get -y upgrade').returncode == (CONNECTION_ERROR if reset else 0)
+    commands = [c[0][0] for c in mock_subprocess_run.call_args_list]
+    assert commands[0][-3:] == ['-O', 'check', 'host']
+    assert [c[-3:] == ['-O', 'exit', 'host'] for c in commands[1:]] == ([True, False] if reset else [False])
+
+
+def test_check_output(transport, mock_subprocess_run):
+    mock_subprocess_run.return_value.stdout = 'out'
+    assert transport.check_output('host', 'ls') == 'out'
+    mock_subprocess_run.return_value.returncode = 1
+    with pytest.raises(subprocess.CalledProcessError):
+        transport.check_output('host', 'ls')
+
+
+def test_run_async_kills_on_timeout(transport, monkeypatch):
+    monkeypatch.setattr(transport, 'ssh_args', lambda *args: ['sh', '-c', 'exec sleep 5'])
+    started = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired):
+        asyncio.run(transport.run_async('host', 'sleep 5', timeout=0.2))
+    assert time.monotonic() - started < 2
+
+
+def test_run_async(transport, monkeypatch):
+    monkeypatch.setattr(transport, 'ssh_args', lambda *args: ['sh', '-c', 'echo out; echo err >&2'])
+    result = asyncio.run(transport.run_async('host', 'echo'))
+    assert (result.returncode, result.stdout, result.stderr) == (0, b'out\n', b'err\n')
+
+
+def test_run_async_retries_stale_master(transport, monkeypatch):
+    commands = iter([
+        ['sh', '-c', f"printf '{STALE_MASTER.decode().strip()}' >&2; exit {CONNECTION_ERROR}"],
+        ['sh', '-c', 'echo out'],
+    ])
+    monkeypatch.setattr(transport, 'ssh_args', lambda *args: next(commands))
+    monkeypatch.setattr(transport, 'reset', mock.Mock(name='reset'))
+    result = asyncio.run(transport.run_async('host', 'echo'))
+    assert (result.returncode, result.stdout) == (0, b'out\n')
+    assert transport.reset.call_count == 1
+
+
+def test_run_async_no_retry_after_remote_exit(transport, monkeypatch):
+    monkeypatch.setattr(transport, 'ssh_args', lambda *args: ['sh', '-c', f'echo done; exit {CONNECTION_ERROR}'])
+    monkeypatch.setattr(transport, 'reset', mock.Mock(name='reset'))
+    result = asyncio.run(transport.run_async('host', 'echo'))
+    assert (result.returncode, result.stdout) == (CONNECTION_ERROR, b'done\n')
+    assert transport.reset.call_count == 0
+
+
+def test_run_async_timings(transport, monkeypatch):
+    # run the command locally, session marker included
+    monkeypatch.setattr(transport, 'ssh_args', lambda host, command, extra_args: ['sh', '-c', command])
+    timings = Timings()
+    result = asyncio.run(transport.run_async('localhost', 'sleep 0.1; echo out; echo err >&2', timings=timings))
+    assert (result.returncode, result.stdout, result.stderr) == (0, b'out\n', b'err\n')
+    assert timings.resolution <= timings.connect < timings.first_byte <= timings.completion
+    assert timings.first_byte - timings.connect >= 0.1
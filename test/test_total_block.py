@@ -44,8 +44,10 @@ def test_main_unsafe(mock_run, mock_getpass, mock_ip_if_not_local):
     # name, args, kwargs = mock_run.mock_calls[0]
     cmd = mock_run.mock_calls[0][1][0]
     name, args, kwargs = mock_run.mock_calls[0]
-    assert cmd[0] == 'ssh'
+    assert cmd[-3:] == ['-O', 'check', 'admin@mt']
     cmd = mock_run.mock_calls[1][1][0]
+    assert cmd[0] == 'ssh'
+    cmd = mock_run.mock_calls[2][1][0]
     assert cmd[0] == 'sudo'
     mock_getpass.getuser.return_value = 'root'
 
@@ -53,8 +55,8 @@ def test_main_unsafe(mock_run, mock_getpass, mock_ip_if_not_local):
 def test_main_unsafe_root(mock_run, mock_getpass, mock_ip_if_not_local):
     mock_getpass.getuser.return_value = 'root'
     main(['--unsafe', 'off'])
-    cmd = mock_run.mock_calls[0][1][0]
-    assert cmd[0] == 'ssh'
     cmd = mock_run.mock_calls[1][1][0]
+    assert cmd[0] == 'ssh'
+    cmd = mock_run.mock_calls[2][1][0]
     assert cmd[0] == 'bash'
     assert cmd[2].startswith('grep')
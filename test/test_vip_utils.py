@@ -2,6 +2,7 @@ from unittest import mock
 
 import pytest
 
+from tools.libs.net_utils import LocalAddresses
 from tools.libs.vip_utils import is_proxy
 
 
@@ -14,29 +15,56 @@ def mock_socket(monkeypatch):
 
 
 @pytest.fixture
-def mock_subprocess(monkeypatch):
-    mock_subprocess = mock.MagicMock(name='subprocess')
-    mock_subprocess.check_output.return_value = b'''
-    2: eth0    inet 192.168.19.65/24 scope global secondary eth0\\       valid_lft forever preferred_lft forever
-    2: eth0    inet 192.168.19.66/24 scope global secondary eth0\\       valid_lft forever preferred_lft forever
-    2: eth0    inet 192.168.19.67/24 scope global secondary eth0\\       valid_lft forever preferred_lft forever
-    '''
-    monkeypatch.setattr('tools.libs.vip_utils.subprocess', mock_subprocess)
-    yield mock_subprocess
-
-
-def test_is_proxy_false(mock_socket, mock_subprocess):
+def mock_netifaces(monkeypatch):
+    mock_netifaces = mock.MagicMock(name='netifaces')
+    mock_netifaces.interfaces.return_value = ['lo', 'eth0']
+    mock_netifaces.ifaddresses.side_effect = lambda interface: {
+        'lo': {mock_netifaces.AF_INET: [{'addr': '127.0.0.1'}], mock_netifaces.AF_INET6: [{'addr': '::1'}]},
+        'eth0': {
+            mock_netifaces.AF_INET: [{'addr': f'192.168.19.{n}'} for n in (65, 66, 67)],
+            mock_netifaces.AF_INET6: [{'addr': 'fe80::1%eth0'}],
+        },
+    }[interface]
+    monkeypatch.setattr('tools.libs.net_utils.netifaces', mock_netifaces)
+    monkeypatch.setattr('tools.libs.vip_utils.local_addresses', LocalAddresses())
+    yield mock_netifaces
+
+
+def test_is_proxy_false(mock_socket, mock_netifaces):
     assert not is_proxy()
 
 
-def test_is_proxy_false2(mock_socket, mock_subprocess):
+def test_is_proxy_false2(mock_socket, mock_netifaces):
     mock_socket.gethostbyname.return_value = '192.168.19.80'
     assert not is_proxy()
 
 
-def test_is_proxy(mock_socket, mock_subprocess):
-    mock_subprocess.check_output.return_value = (
-        b'2: eth0    inet 192.168.19.80/24 scope global secondary eth0\\       valid_lft forever preferred_lft forever'
-    )
+def test_is_proxy(mock_socket, mock_netifaces):
+    mock_netifaces.interfaces.return_value = ['lo', 'eth0', 'vip0']
+    mock_netifaces.ifaddresses.side_effect = lambda interface: {mock_netifaces.AF_INET: [{'addr': '192.168.19.80'}]}
     mock_socket.gethostbyname.return_value = '192.168.19.80'
     assert is_proxy()
+
+
+def test_local_addresses_cached(mock_netifaces, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('tools.libs.net_utils.time.monotonic', lambda: now[0])
+    local_addresses = LocalAddresses(ttl=10)
+    assert local_addresses.addresses == {
+        '127.0.0.1', '::1', '192.168.19.65', '192.168.19.66', '192.168.19.67', 'fe80::1'
+    }
+    assert local_addresses.is_local('127.0.1.1')
+    assert not local_addresses.is_local('192.168.19.80')
+    assert not local_addresses.is_local('proxy')
+    assert mock_netifaces.interfaces.call_count == 1
+    # a VIP moving here is noticed when the cache expires
+    mock_netifaces.ifaddresses.side_effect = lambda interface: {mock_netifaces.AF_INET: [{'addr': '192.168.19.80'}]}
+    now[0] += 9
+    assert not local_addresses.is_local('192.168.19.80')
+    now[0] += 1
+    assert local_addresses.is_local('192.168.19.80')
+    assert mock_netifaces.interfaces.call_count == 2
+    # or right away when the interfaces change
+    mock_netifaces.ifaddresses.side_effect = lambda interface: {}
+    monkeypatch.setattr('tools.libs.net_utils.socket.if_nameindex', lambda: [(1, 'lo')])
+    assert not local_addresses.is_local('192.168.19.80')